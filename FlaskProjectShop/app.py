@@ -1,6 +1,6 @@
 import os
 import secrets
-from flask import Flask, render_template, send_from_directory, request, flash, url_for, redirect, jsonify
+from flask import Flask, render_template, send_from_directory, request, flash, url_for, redirect, jsonify, session, abort
 from flask_sqlalchemy import SQLAlchemy
 from sqlalchemy.sql import func
 from sqlalchemy.exc import IntegrityError
@@ -11,22 +11,47 @@ from wtforms import StringField, TextAreaField, SelectField, SubmitField, Decima
 from wtforms.validators import DataRequired, Length, NumberRange, ValidationError
 from PIL import Image
 from cloudipsp import Api, Checkout
+from cloudipsp.helpers import is_approved
+from compression import CompressionMiddleware
+from cart_store import make_store
+from catalog import CatalogIndex, SORTS
 
 app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'database.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or 'sqlite:///' + os.path.join(basedir, 'database.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SECRET_KEY'] = 'hard to guess'
 UPLOAD_FOLDER = 'uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['JSON_AS_ASCII'] = False
+app.config['COMPRESS_MIN_SIZE'] = 500  # ответы меньше этого размера (байт) не сжимаются
+app.config['COMPRESS_GZIP_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['COMPRESS_CACHE_MAX_BYTES'] = 16 * 1024 * 1024  # 0 - не кэшировать сжатые ответы
+app.config['CART_STORE'] = 'memory'  # 'sqlite' - общее хранилище корзин для нескольких процессов
+app.config['CART_STORE_PATH'] = os.path.join(basedir, 'carts.db')
+app.config['CART_TTL'] = 7 * 24 * 3600  # корзина посетителя живет неделю с последнего обращения
+app.config['GUEST_USER_ID'] = 1  # на этого пользователя оформляются заказы без входа (как и раньше)
+app.config['PAYMENT_MERCHANT_ID'] = 1396424
+app.config['PAYMENT_SECRET_KEY'] = 'test'
+app.config['PAYMENT_CURRENCY'] = 'BYN'
 db = SQLAlchemy(app)
+carts = make_store(app.config)
+app.wsgi_app = CompressionMiddleware(app.wsgi_app,
+                                     min_size=app.config['COMPRESS_MIN_SIZE'],
+                                     gzip_level=app.config['COMPRESS_GZIP_LEVEL'],
+                                     brotli_quality=app.config['COMPRESS_BROTLI_QUALITY'],
+                                     cache_max_bytes=app.config['COMPRESS_CACHE_MAX_BYTES'])
 
 
 """################################# M O D E L S ##################################"""
 
 
 class Product(db.Model):
+    __table_args__ = (db.Index('ix_product_category_price', 'id_category', 'price'),
+                      db.Index('ix_product_action_created', 'in_action', 'created_at'),
+                      db.Index('ix_product_new_created', 'new', 'created_at'),
+                      db.Index('ix_product_stock_price', 'in_stock', 'price'))
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), unique=True, nullable=False)
     id_creator = db.Column(db.Integer, db.ForeignKey('creator.id'), nullable=False)
@@ -89,6 +114,68 @@ class Cart(db.Model):
         return f'<Cart {self.quantity} - {self.id_product}>'
 
 
+class Order(db.Model):  # заказы и архив оплаченных корзин, в Cart остаются только открытые
+    __table_args__ = (db.Index('ix_order_user_created', 'id_user', 'created_at'),)
+    id = db.Column(db.Integer, primary_key=True)
+    id_user = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    created_at = db.Column(db.DateTime(timezone=True), server_default=func.now())  # у перенесенных из Cart даты нет
+    total = db.Column(db.Float, nullable=False, default=0)
+    paid_for = db.Column(db.Boolean, default=False)  # ставится по подтверждению платежной системы
+    received = db.Column(db.Boolean, default=False)
+    cart_key = db.Column(db.String(40), index=True)  # корзина сессии, из которой гость оформил заказ: только ей он и виден
+    lines = db.relationship('OrderLine', backref='order', lazy=True)
+
+    def __repr__(self):
+        return f'<Order {self.id} - {self.total}>'
+
+
+class OrderLine(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    id_order = db.Column(db.Integer, db.ForeignKey('order.id'), nullable=False, index=True)
+    id_product = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    price = db.Column(db.Float, nullable=False)  # цена на момент покупки
+    discount = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<OrderLine {self.quantity} - {self.id_product}>'
+
+
+class CatalogVersion(db.Model):  # одна строка: счетчик изменений таблицы product, его увеличивают триггеры
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+
+class RelatedProduct(db.Model):  # заполняется офлайн скриптом related.py
+    id_product = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    rank = db.Column(db.Integer, primary_key=True)
+    id_related = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
+    score = db.Column(db.Float)
+
+    def __repr__(self):
+        return f'<RelatedProduct {self.id_product} #{self.rank} - {self.id_related}>'
+
+
+def init_db():
+    """Создает недостающие таблицы и индексы. Вызывается командой flask init-db, офлайн скриптами и при запуске app.py."""
+    db.create_all()  # создает только отсутствующие в базе таблицы, существующие не трогает
+    for index in Product.__table__.indexes:  # индексы к уже существующей таблице create_all не добавляет
+        index.create(db.engine, checkfirst=True)
+    with db.engine.begin() as conn:
+        conn.execute(db.text('INSERT OR IGNORE INTO catalog_version (id, version) VALUES (1, 0)'))
+        # триггеры (синтаксис SQLite) видят любые изменения товаров: из других процессов, массовые UPDATE, правки руками
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            conn.execute(db.text(f'CREATE TRIGGER IF NOT EXISTS product_version_{event.lower()} AFTER {event} ON product '
+                                 f'BEGIN UPDATE catalog_version SET version = version + 1 WHERE id = 1; END'))
+
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Создать недостающие таблицы и индексы."""
+    init_db()
+    print('База готова')
+
+
 """################################# F O R M S ##################################"""
 
 
@@ -146,32 +233,220 @@ class Quantity(FlaskForm):
     submit = SubmitField('Добавить в корзину')
 
 
+"""################################# O R D E R S ##################################"""
+
+
+def create_order(id_user, lines, paid_for=False, received=False, cart_key=None):
+    """Создает заказ из строк (id товара, количество, скидка). Коммит - на вызывающей стороне."""
+    prices = dict(db.session.query(Product.id, Product.price).filter(Product.id.in_([id_product for id_product, _, _ in lines])))
+    order = Order(id_user=id_user, paid_for=paid_for, received=received, total=0, cart_key=cart_key)
+    for id_product, quantity, discount in lines:
+        price = prices.get(id_product) or 0
+        order.lines.append(OrderLine(id_product=id_product, quantity=quantity, price=price, discount=discount))
+        order.total += price * quantity * (1 - (discount or 0))
+    db.session.add(order)
+    return order
+
+
+def archive_cart_rows(id_user, rows, received=False):
+    """Переносит оплаченные строки Cart в новый заказ. Коммит - на вызывающей стороне."""
+    order = create_order(id_user, [(r.id_product, r.quantity, r.discount) for r in rows], paid_for=True, received=received)
+    order.created_at = db.null()  # когда оплачены строки Cart, неизвестно - не выдаем их за сегодняшний заказ
+    Cart.query.filter(Cart.id.in_([r.id for r in rows])).delete(synchronize_session=False)
+    return order
+
+
+def place_order(id_user, key):
+    """Оформление: из корзины хранилища создается неоплаченный заказ. Корзина остается до подтверждения оплаты."""
+    cart = carts.get(key)
+    if not cart:
+        return None
+    try:
+        order = create_order(id_user, [(id_product, quantity, None) for id_product, quantity in cart.items()],
+                             cart_key=key if key.startswith('s:') else None)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return order
+
+
+def confirm_order(order, key):
+    """Оплата подтверждена: заказ помечается оплаченным, его товары убираются из корзины key.
+
+    Сохраненные строки Cart пользователя уже слиты в эту корзину при входе и удаляются.
+    Возвращает False, если заказ уже был подтвержден (платежная система уведомляет и сервер, и браузер)."""
+    try:
+        confirmed = Order.query.filter(Order.id == order.id, Order.paid_for.isnot(True))\
+            .update({'paid_for': True}, synchronize_session='fetch')
+        if confirmed and key.startswith('u:'):
+            Cart.query.filter(Cart.id_user == order.id_user).delete(synchronize_session=False)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if not confirmed:
+        return False
+    ordered = {line.id_product: line.quantity for line in order.lines}
+
+    def take_ordered(cart):  # добавленное в корзину после оформления остается в ней
+        for id_product, quantity in ordered.items():
+            if cart.get(id_product, 0) > quantity:
+                cart[id_product] -= quantity
+            else:
+                cart.pop(id_product, None)
+    carts.update(key, take_ordered)
+    return True
+
+
+def order_amount(order):
+    """Сумма заказа для платежной системы - в копейках."""
+    return int(round(order.total * 100))
+
+
+def payment_response():
+    """Разбирает ответ платежной системы с проверкой подписи: (заказ, ключ корзины, одобрена ли оплата).
+
+    Сумма и валюта платежа должны совпасть с заказом, иначе оплата не засчитывается."""
+    data = request.form.to_dict()
+    try:
+        approved = is_approved(dict(data), app.config['PAYMENT_SECRET_KEY'], '1.0')
+        id_order = int(data['order_id'].split('-')[0])
+        amount = int(data['amount'])
+    except Exception:  # нет подписи, статуса или суммы, подпись не сошлась, чужой номер заказа
+        abort(400)
+    order = Order.query.get_or_404(id_order)
+    if amount != order_amount(order) or data.get('currency') != app.config['PAYMENT_CURRENCY']:
+        abort(400)
+    return order, data.get('merchant_data', ''), approved
+
+
+"""################################ C A T A L O G #################################"""
+
+
+catalog = CatalogIndex(lambda: db.session.query(Product.id, Product.id_category, Product.price, Product.in_action,
+                                                Product.new, Product.in_stock, Product.created_at).all(),
+                       version=lambda: db.session.query(CatalogVersion.version).filter(CatalogVersion.id == 1).scalar())
+
+
+def catalog_filters():
+    """Фильтры каталога из строки запроса."""
+    sort = request.args.get('sort', 'new', type=str)
+    return {
+        'price_min': request.args.get('price_min', None, type=float),
+        'price_max': request.args.get('price_max', None, type=float),
+        'category': request.args.get('category', None, type=int),
+        'in_action': request.args.get('in_action', 0, type=int) == 1,
+        'new': request.args.get('new', 0, type=int) == 1,
+        'in_stock': request.args.get('in_stock', 0, type=int) == 1,
+        'sort': sort if sort in SORTS else 'new',
+    }
+
+
+"""################################# C A R T S ##################################"""
+
+
+def cart_key(create=False):
+    """Ключ корзины в хранилище: пользователя после входа или анонимной сессии."""
+    if 'id_user' in session:
+        return f'u:{session["id_user"]}'
+    if 'cart_id' not in session:
+        if not create:
+            return None
+        session['cart_id'] = secrets.token_hex(16)
+    return 's:' + session['cart_id']
+
+
+def cart_items_count():
+    key = cart_key()
+    return sum(carts.get(key).values()) if key else 0
+
+
+def login_cart(id_user):
+    """Вызывается при входе пользователя: его сохраненная корзина и корзина сессии сливаются в хранилище,
+    а заказы, оформленные в этой сессии без входа, переходят к пользователю."""
+    anonymous = {}
+    if 'cart_id' in session:
+        key = cart_key()
+        anonymous = carts.pop(key)
+        Order.query.filter(Order.cart_key == key).update({'id_user': id_user}, synchronize_session=False)
+        db.session.commit()
+    saved = Cart.query.filter(Cart.id_user == id_user).all()
+
+    def merge(cart):
+        if not cart:
+            for r in saved:
+                cart[r.id_product] = r.quantity
+        for id_product, quantity in anonymous.items():
+            cart[id_product] = cart.get(id_product, 0) + quantity
+    session.pop('cart_id', None)
+    session['id_user'] = id_user
+    carts.update(cart_key(), merge)
+
+
 """################################# R O U T E S ##################################"""
 
 
+@app.after_request
+def add_etag(response):
+    # ETag по содержимому: браузер получает 304, а сжатое тело берется из кэша прослойки
+    if request.method == 'GET' and response.status_code == 200 and not response.direct_passthrough \
+            and response.mimetype in ('text/html', 'application/json'):
+        response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
 @app.route('/payment')
 def payment():
-    amount = request.args.get('amount', '', type=str)
-    if int(amount) == 0:
-        return render_template('shop_cart.html')
-    api = Api(merchant_id=1396424,
-              secret_key='test')
+    # сумма берется из заказа, а не из запроса: иначе посетитель сам назначил бы цену
+    key = cart_key(create=True)
+    order = place_order(session.get('id_user', app.config['GUEST_USER_ID']), key)
+    if order is None:
+        return redirect(url_for('shop_cart'))
+    api = Api(merchant_id=app.config['PAYMENT_MERCHANT_ID'],
+              secret_key=app.config['PAYMENT_SECRET_KEY'])
     checkout = Checkout(api=api)
     dt = {
-        "currency": "BYN",
-        "amount": amount
+        "currency": app.config['PAYMENT_CURRENCY'],
+        "amount": order_amount(order),
+        "order_id": f'{order.id}-{secrets.token_hex(4)}',  # номер должен быть уникален для мерчанта, а не только в нашей базе
+        "merchant_data": key,  # возвращается в ответе: обратный вызов сервера приходит без сессии посетителя
+        "response_url": url_for('payment_result', _external=True),
+        "server_callback_url": url_for('payment_callback', _external=True)
     }
     url = checkout.url(dt).get('checkout_url')
     return redirect(url)
 
 
+@app.route('/payment/result', methods=['POST'])
+def payment_result():
+    # сюда платежная система возвращает браузер посетителя
+    order, key, approved = payment_response()
+    if not approved:
+        return redirect(url_for('shop_cart'))  # заказ остается неоплаченным, корзина - нетронутой
+    confirm_order(order, key)
+    return redirect(url_for('orders'))
+
+
+@app.route('/payment/callback', methods=['POST'])
+def payment_callback():
+    # уведомление сервер-сервер: приходит, даже если посетитель закрыл страницу оплаты
+    order, key, approved = payment_response()
+    if approved:
+        confirm_order(order, key)
+    return ''
+
+
 @app.route('/')
 def index():
     category = Category.query.all()
-    product = Product.query.all()
-    action = Product.query.filter_by(in_action=1).limit(4).all()
-    cart_items_count = Cart.query.with_entities(func.sum(Cart.quantity).label('quantity')).filter_by(id_user=1).all()[0][0]
-    return render_template('index.html', product=product, action=action, category=category, cart_items_count=cart_items_count)
+    filters = catalog_filters()
+    ids = catalog.search(**filters)
+    found = {p.id: p for p in Product.query.filter(Product.id.in_(ids))} if ids else {}
+    product = [found[i] for i in ids if i in found]
+    action = Product.query.filter_by(in_action=1).order_by(Product.created_at.desc()).limit(4).all()
+    return render_template('index.html', product=product, action=action, category=category, filters=filters, cart_items_count=cart_items_count())
 
 
 @app.route('/contact')
@@ -186,18 +461,22 @@ def send_file(filename):
 
 @app.route('/delete/<int:id_product>')
 def delete(id_product):
-    record = Cart.query.filter(Cart.id_user == 1, Cart.id_product == id_product).first()
-    db.session.delete(record)
-    db.session.commit()
+    key = cart_key()
+    if key:
+        carts.update(key, lambda cart: cart.pop(id_product, None))
     return ''
 
 
 @app.route('/change/<int:id_product>')
 def change(id_product):
     q = request.args.get('q', 0, type=int)
-    cur_quantity = Cart.query.filter(Cart.id_user == 1, Cart.id_product == id_product).first()
-    Cart.query.filter(Cart.id_user == 1, Cart.id_product == id_product).update({'quantity': cur_quantity.quantity + q})
-    db.session.commit()
+
+    def change_quantity(cart):
+        if id_product in cart and cart[id_product] + q > 0:
+            cart[id_product] += q
+    key = cart_key()
+    if key:
+        carts.update(key, change_quantity)
     return ''
 
 
@@ -207,31 +486,52 @@ def item(id_product):
     form = Quantity()
     category = Category.query.filter(Category.id == prod.id_category).first()  # без .first() был бы кортеж, а так - запись БД
     creator = Creator.query.filter(Creator.id == prod.id_creator).first()  # без .first() был бы кортеж, а так - запись БД
-    cart_items_count = Cart.query.with_entities(func.sum(Cart.quantity).label('quantity')).filter_by(id_user=1).all()[0][0]
-    return render_template('item.html', form=form, product=prod, category=category, creator=creator, cart_items_count=cart_items_count)
+    related = db.session.query(Product).join(RelatedProduct, RelatedProduct.id_related == Product.id)\
+        .filter(RelatedProduct.id_product == id_product).order_by(RelatedProduct.rank).all()  # K строк по первичному ключу
+    return render_template('item.html', form=form, product=prod, category=category, creator=creator, cart_items_count=cart_items_count(), related=related)
 
 
 @app.route('/add/<int:id_product>')
 def add(id_product):
     add_quantity = request.args.get('add_quantity', 0, type=int)
-    exist_record = Cart.query.filter(Cart.id_user == 1, Cart.id_product == id_product).first()
-    if exist_record:
-        Cart.query.filter(Cart.id_user == 1, Cart.id_product == id_product).update({'quantity': exist_record.quantity + add_quantity})
-        db.session.commit()
-    else:
-        new_record = Cart(id_user=1, id_product=id_product, quantity=add_quantity)
-        db.session.add(new_record)
-        db.session.commit()
+
+    def add_to_cart(cart):
+        cart[id_product] = cart.get(id_product, 0) + add_quantity
+    if db.session.query(Product.id).filter(Product.id == id_product).first() is None:
+        abort(404)  # иначе в хранилище попадет товар, которого нет: корзина его не покажет, а оформление сломается
+    if add_quantity > 0:
+        carts.update(cart_key(create=True), add_to_cart)
     return ''
 
 
+@app.route('/orders')
+def orders():
+    if 'id_user' in session:
+        query = Order.query.filter(Order.id_user == session['id_user'])
+    else:  # гостю - только заказы его сессии, а не всех гостей
+        key = cart_key()
+        query = Order.query.filter(Order.cart_key == key, Order.id_user == app.config['GUEST_USER_ID']) if key else None
+    history = query.order_by(Order.created_at.desc()).limit(50).all() if query is not None else []
+    lines = db.session.query(OrderLine, Product).join(Product, OrderLine.id_product == Product.id)\
+        .filter(OrderLine.id_order.in_([o.id for o in history])).all()
+    order_lines = {}
+    for line in lines:
+        order_lines.setdefault(line.OrderLine.id_order, []).append(line)
+    return render_template('orders.html', orders=history, order_lines=order_lines)
+
+
 @app.route('/shop_cart')
 def shop_cart():
-    cart = db.session.query(Cart, Product, Category).join(Product, Cart.id_product == Product.id).join(Category, Product.id_category == Category.id)
-    return render_template('shop_cart.html', cart=cart)
+    key = cart_key()
+    quantities = carts.get(key) if key else {}
+    cart = db.session.query(Product, Category).join(Category, Product.id_category == Category.id)\
+        .filter(Product.id.in_(list(quantities))).all()
+    return render_template('shop_cart.html', cart=cart, quantities=quantities)
 
 
 """#################################  L A U N C H  ##################################"""
 
 if __name__ == '__main__':
+    with app.app_context():
+        init_db()
     app.run(debug=True)
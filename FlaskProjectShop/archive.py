@@ -0,0 +1,70 @@
+"""Перенос исторических оплаченных строк Cart в архив заказов Order/OrderLine.
+
+Строки обрабатываются порциями по (пользователь, id), каждая порция - отдельная
+транзакция, поэтому скрипт можно прервать и запустить снова с того же места.
+Живое приложение при этом блокируется только на время одной порции.
+
+Номера оформления и даты у строк Cart нет. Оформлением считается серия
+идущих подряд (по id) строк одного пользователя с одинаковым признаком
+received: строки оформления добавлялись в корзину до оплаты, а следующая
+корзина начиналась уже после нее. Серия становится одним заказом без даты
+(created_at = NULL), а не заказом "от сегодня". Две оплаченные подряд корзины
+с одинаковым received по строкам неразличимы и становятся одним заказом.
+Строки одного пользователя никогда не делятся между порциями, чтобы серия
+не стала двумя заказами.
+
+Запуск:  python archive.py [--chunk 500]
+"""
+import argparse
+from itertools import groupby
+from app import app, db, init_db, Cart, archive_cart_rows
+
+
+def checkouts(rows):
+    """Делит строки (по возрастанию пользователя и id) на серии-оформления."""
+    for (id_user, received), group in groupby(rows, key=lambda r: (r.id_user, bool(r.received))):
+        yield id_user, received, list(group)
+
+
+def next_chunk(last_user, chunk):
+    """Оплаченные строки пользователей после last_user: не меньше одного пользователя целиком, обычно не больше chunk строк."""
+    rows = Cart.query.filter(Cart.paid_for.is_(True), Cart.id_user > last_user)\
+        .order_by(Cart.id_user, Cart.id).limit(chunk + 1).all()
+    if len(rows) <= chunk:
+        return rows
+    last = rows[-1].id_user
+    complete = [r for r in rows if r.id_user != last]
+    if complete:
+        return complete  # строки последнего пользователя уйдут в следующую порцию целиком
+    return Cart.query.filter(Cart.paid_for.is_(True), Cart.id_user == last).order_by(Cart.id).all()
+
+
+def archive_paid(chunk=500):
+    archived = orders = 0
+    last_user = 0
+    while True:
+        rows = next_chunk(last_user, chunk)
+        if not rows:
+            break
+        last_user = rows[-1].id_user
+        try:
+            for id_user, received, group in checkouts(rows):
+                archive_cart_rows(id_user, group, received=received)
+                orders += 1
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        archived += len(rows)
+        print(f'... перенесено строк: {archived}')
+    return archived, orders
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Архивация оплаченных корзин')
+    parser.add_argument('--chunk', type=int, default=500, help='сколько строк Cart переносить за одну транзакцию')
+    args = parser.parse_args()
+    with app.app_context():
+        init_db()
+        archived, orders = archive_paid(args.chunk)
+    print(f'Готово: строк {archived}, заказов {orders}')
@@ -0,0 +1,153 @@
+"""Серверное хранилище корзин посетителей.
+
+Корзина - это словарь {id товара: количество}, хранящийся по ключу сессии.
+Пока посетитель выбирает товары, в основную базу ничего не пишется. При
+оформлении из корзины создаются строки Order и OrderLine, а после подтверждения
+оплаты оплаченные товары убираются из корзины. Таблица Cart хранит только
+сохраненные корзины пользователей: при входе они сливаются в хранилище, а после
+оплаты удаляются. Корзины, к которым давно не обращались, удаляются по
+истечении TTL.
+"""
+import json
+import sqlite3
+import threading
+import time
+
+
+class MemoryCartStore:
+    """Корзины в памяти процесса. Подходит для одного процесса сервера."""
+
+    def __init__(self, ttl=7 * 24 * 3600, sweep_interval=300):
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._carts = {}
+        self._expires = {}
+        self._lock = threading.Lock()
+        self._next_sweep = time.monotonic() + sweep_interval
+
+    def _alive(self, key, now):
+        if key in self._carts and self._expires[key] <= now:
+            del self._carts[key], self._expires[key]
+        return self._carts.get(key)
+
+    def _sweep(self, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        for key in [k for k, exp in self._expires.items() if exp <= now]:
+            del self._carts[key], self._expires[key]
+
+    def get(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            cart = self._alive(key, now)
+            if cart is None:
+                return {}
+            self._expires[key] = now + self.ttl
+            return dict(cart)
+
+    def update(self, key, func):
+        """Атомарно применяет func к корзине (словарю) и сохраняет результат."""
+        with self._lock:
+            now = time.monotonic()
+            self._sweep(now)
+            cart = self._alive(key, now) or {}
+            func(cart)
+            if cart:
+                self._carts[key] = cart
+                self._expires[key] = now + self.ttl
+            else:
+                self._carts.pop(key, None)
+                self._expires.pop(key, None)
+            return dict(cart)
+
+    def pop(self, key):
+        with self._lock:
+            self._expires.pop(key, None)
+            return self._carts.pop(key, None) or {}
+
+    def __len__(self):
+        return len(self._carts)
+
+
+class SQLiteCartStore:
+    """Корзины в отдельном файле SQLite - общие для нескольких процессов сервера."""
+
+    def __init__(self, path, ttl=7 * 24 * 3600, sweep_interval=300):
+        self.path = path
+        self.ttl = ttl
+        self.sweep_interval = sweep_interval
+        self._local = threading.local()
+        self._next_sweep = time.time() + sweep_interval
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS cart_session '
+                         '(key TEXT PRIMARY KEY, data TEXT NOT NULL, expires REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_cart_session_expires ON cart_session (expires)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _sweep(self, conn, now):
+        if now < self._next_sweep:
+            return
+        self._next_sweep = now + self.sweep_interval
+        conn.execute('DELETE FROM cart_session WHERE expires <= ?', (now,))
+
+    @staticmethod
+    def _decode(data):
+        return {int(k): v for k, v in json.loads(data).items()}
+
+    def get(self, key):
+        conn = self._connect()
+        now = time.time()
+        self._sweep(conn, now)
+        row = conn.execute('SELECT data FROM cart_session WHERE key = ? AND expires > ?', (key, now)).fetchone()
+        if row is None:
+            return {}
+        conn.execute('UPDATE cart_session SET expires = ? WHERE key = ?', (now + self.ttl, key))
+        return self._decode(row[0])
+
+    def update(self, key, func):
+        conn = self._connect()
+        now = time.time()
+        self._sweep(conn, now)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute('SELECT data FROM cart_session WHERE key = ? AND expires > ?', (key, now)).fetchone()
+            cart = self._decode(row[0]) if row else {}
+            func(cart)
+            if cart:
+                conn.execute('INSERT OR REPLACE INTO cart_session (key, data, expires) VALUES (?, ?, ?)',
+                             (key, json.dumps(cart), now + self.ttl))
+            else:
+                conn.execute('DELETE FROM cart_session WHERE key = ?', (key,))
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+        return dict(cart)
+
+    def pop(self, key):
+        cart = {}
+
+        def take(current):
+            cart.update(current)
+            current.clear()
+        self.update(key, take)
+        return cart
+
+    def __len__(self):
+        return self._connect().execute('SELECT count(*) FROM cart_session WHERE expires > ?', (time.time(),)).fetchone()[0]
+
+
+def make_store(config):
+    if config.get('CART_STORE') == 'sqlite':
+        return SQLiteCartStore(config['CART_STORE_PATH'], ttl=config['CART_TTL'])
+    return MemoryCartStore(ttl=config['CART_TTL'])
@@ -0,0 +1,93 @@
+"""Индекс каталога в памяти для фильтров по цене, флагам и сортировки.
+
+Для всего каталога и для каждой категории и флага хранится свой массив товаров,
+отсортированный по цене. Диапазон цен находится двоичным поиском (bisect) в
+массиве самого узкого фасета; если фасетов несколько, найденные диапазоны
+пересекаются как множества, и сортируется только результат. Построчного
+просмотра товаров при поиске нет.
+
+Индекс перестраивается целиком (каталог читается одним запросом), когда
+меняется версия каталога в базе: ее увеличивают триггеры на таблице product,
+поэтому изменение из другого процесса или массовым UPDATE тоже заметно.
+"""
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import datetime
+
+SORTS = ('price', '-price', 'new')
+
+
+class _Snapshot:
+    def __init__(self):
+        self.facets = {}  # ключ фасета -> (цены по возрастанию, id товаров в том же порядке)
+        self.rank = {}  # id -> место в общем порядке по цене
+        self.recency = {}  # id -> место в порядке от новых к старым
+
+
+class CatalogIndex:
+    def __init__(self, loader, version=None):
+        self.loader = loader  # функция, возвращающая строки (id, id_category, price, in_action, new, in_stock, created_at)
+        self.version = version  # функция, возвращающая версию каталога в базе, или None
+        self.stale = True
+        self._loaded_version = None
+        self._lock = threading.Lock()
+        self._build([])
+
+    def _build(self, rows):
+        # новый снимок собирается целиком и подменяется одним присваиванием
+        snap = _Snapshot()
+        by_price = sorted(rows, key=lambda r: (r[2] or 0, r[0]))
+        snap.rank = {r[0]: pos for pos, r in enumerate(by_price)}
+        by_created = sorted(rows, key=lambda r: (r[6] or datetime.min, r[0]), reverse=True)
+        snap.recency = {r[0]: pos for pos, r in enumerate(by_created)}
+        facets = {}
+        for r in by_price:
+            keys = [('all',), ('category', r[1])]
+            if r[3]:
+                keys.append(('in_action',))
+            if r[4]:
+                keys.append(('new',))
+            if (r[5] or 0) > 0:
+                keys.append(('in_stock',))
+            for key in keys:
+                prices, ids = facets.setdefault(key, ([], []))
+                prices.append(r[2] or 0)
+                ids.append(r[0])
+        snap.facets = facets
+        self._snap = snap
+
+    def invalidate(self):
+        self.stale = True
+
+    def refresh(self, version=None):
+        with self._lock:
+            if self.stale or version != self._loaded_version:
+                self.stale = False  # сброс до чтения: изменение во время загрузки снова пометит индекс
+                self._loaded_version = version  # версия прочитана до строк, поэтому более новая перезагрузит их
+                self._build(self.loader())
+
+    def search(self, price_min=None, price_max=None, category=None, in_action=False, new=False,
+               in_stock=False, sort='new'):
+        """Возвращает id товаров, подходящих под фильтры, в нужном порядке."""
+        version = self.version() if self.version is not None else None
+        if self.stale or version != self._loaded_version:
+            self.refresh(version)
+        snap = self._snap
+        keys = [('category', category)] if category is not None else []
+        keys += [(name,) for name, wanted in (('in_action', in_action), ('new', new), ('in_stock', in_stock)) if wanted]
+        ranges = []
+        for key in keys or [('all',)]:
+            prices, ids = snap.facets.get(key, ((), ()))
+            lo = 0 if price_min is None else bisect_left(prices, price_min)
+            hi = len(prices) if price_max is None else bisect_right(prices, price_max)
+            ranges.append(ids[lo:hi])
+        ranges.sort(key=len)
+        ids = ranges[0]
+        if len(ranges) > 1:
+            ids = sorted(set(ids).intersection(*ranges[1:]), key=snap.rank.__getitem__)
+        ids = list(ids)
+        if sort == '-price':
+            ids.reverse()
+        elif sort == 'new':
+            ids.sort(key=snap.recency.__getitem__)
+        return ids
@@ -0,0 +1,275 @@
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import brotli
+except ImportError:  # brotli необязателен - без него работает только gzip
+    brotli = None
+
+
+COMPRESSIBLE_TYPES = ('text/', 'application/json', 'application/javascript', 'application/xml', 'image/svg+xml')
+
+
+def parse_accept_encoding(header):
+    """Разбирает Accept-Encoding в словарь {кодировка: q}."""
+    result = {}
+    for part in (header or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        name, _, params = part.partition(';')
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        result[name.strip().lower()] = q
+    return result
+
+
+class CompressedBodyCache:
+    """LRU-кэш сжатых тел ответов, ограниченный суммарным размером в байтах."""
+
+    def __init__(self, max_bytes=16 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            body = self._data.get(key)
+            if body is not None:
+                self._data.move_to_end(key)
+            return body
+
+    def put(self, key, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self._data[key] = body
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, evicted = self._data.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
+
+
+class CompressionMiddleware:
+    """WSGI-прослойка: сжимает HTML/JSON ответы в brotli или gzip.
+
+    Ответы с известной длиной сжимаются целиком, и если у ответа есть ETag,
+    сжатое тело кэшируется - повторный запрос той же страницы не сжимается заново.
+    Ответы-генераторы (без Content-Length) сжимаются потоково, по частям.
+    """
+
+    def __init__(self, app, min_size=500, gzip_level=6, brotli_quality=5,
+                 cache_max_bytes=16 * 1024 * 1024, types=COMPRESSIBLE_TYPES):
+        self.app = app
+        self.min_size = min_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+        self.types = types
+        self.cache = CompressedBodyCache(cache_max_bytes) if cache_max_bytes else None
+
+    def choose_encoding(self, environ):
+        accepted = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        candidates = ['br', 'gzip'] if brotli is not None else ['gzip']
+        best, best_q = None, 0.0
+        for name in candidates:
+            q = accepted.get(name, accepted.get('*', 0.0))
+            if q > best_q:
+                best, best_q = name, q
+        return best
+
+    def __call__(self, environ, start_response):
+        encoding = self.choose_encoding(environ)
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD' or 'HTTP_RANGE' in environ:
+            def vary(status, headers, exc_info=None):
+                # несжатый ответ тоже зависит от Accept-Encoding - иначе прокси отдаст его и тем, кто принимает gzip
+                if status.startswith('304') or \
+                        any(k.lower() == 'content-type' and v.startswith(self.types) for k, v in headers):
+                    _add_vary(headers)
+                return start_response(status, headers, exc_info)
+            return self.app(environ, vary)
+
+        if 'HTTP_IF_NONE_MATCH' in environ:
+            environ['HTTP_IF_NONE_MATCH'] = _decoded_etags(environ['HTTP_IF_NONE_MATCH'])
+        captured = {}
+        buffered = []
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return buffered.append  # write() накапливаем и отдаем перед телом
+
+        app_iter = self.app(environ, capture)
+        if 'status' not in captured:
+            # приложение вправе вызвать start_response только при выдаче первой части тела
+            app_iter = _prefetch(app_iter)
+            if 'status' not in captured:  # тело кончилось, а start_response так и не был вызван
+                app_iter.close()
+                raise RuntimeError('WSGI-приложение не вызвало start_response')
+        status = captured['status']
+        headers = captured['headers']
+        header_map = {k.lower(): v for k, v in headers}
+
+        if status.startswith('304') and 'etag' in header_map:
+            headers = [(k, _encoded_etag(v, encoding) if k.lower() == 'etag' else v) for k, v in headers]
+        if status.startswith('304') or header_map.get('content-type', '').startswith(self.types):
+            # представление зависит от Accept-Encoding, даже если именно этот ответ не сжат (мал, 304)
+            headers = list(headers)
+            _add_vary(headers)
+        plain_headers = headers
+        if not self.should_compress(status, header_map):
+            start_response(status, headers, captured['exc_info'])
+            return _chain(buffered, app_iter)
+
+        headers = [(k, v) for k, v in headers if k.lower() not in ('content-length', 'content-encoding')]
+        headers.append(('Content-Encoding', encoding))
+        etag = header_map.get('etag')
+        if etag:
+            headers = [(k, v) for k, v in headers if k.lower() != 'etag']
+            headers.append(('ETag', _encoded_etag(etag, encoding)))
+
+        if 'content-length' not in header_map:
+            start_response(status, headers, captured['exc_info'])
+            return self.stream(encoding, _chain(buffered, app_iter))
+
+        cacheable = etag and not _no_store(header_map.get('cache-control', ''))
+        key = (environ.get('PATH_INFO', ''), etag, encoding)
+        body = self.cache.get(key) if cacheable and self.cache is not None else None
+        if body is None:
+            try:
+                raw = b''.join(buffered) + b''.join(app_iter)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            if len(raw) < self.min_size:
+                headers = [(k, v) for k, v in plain_headers if k.lower() != 'content-length']
+                headers.append(('Content-Length', str(len(raw))))
+                start_response(status, headers, captured['exc_info'])
+                return [raw]
+            body = self.compress(encoding, raw)
+            if cacheable and self.cache is not None:
+                self.cache.put(key, body)
+        elif hasattr(app_iter, 'close'):
+            app_iter.close()
+        headers.append(('Content-Length', str(len(body))))
+        start_response(status, headers, captured['exc_info'])
+        return [body]
+
+    def should_compress(self, status, header_map):
+        if not status.startswith('200'):
+            return False
+        if 'content-encoding' in header_map or 'no-transform' in header_map.get('cache-control', ''):
+            return False
+        content_type = header_map.get('content-type', '')
+        if not content_type.startswith(self.types):
+            return False
+        length = header_map.get('content-length')
+        if length is not None and int(length) < self.min_size:
+            return False
+        return True
+
+    def compress(self, encoding, data):
+        if encoding == 'br':
+            return brotli.compress(data, quality=self.brotli_quality)
+        compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+
+    def stream(self, encoding, chunks):
+        """Потоковое сжатие: каждая часть генератора сразу уходит клиенту."""
+        if encoding == 'br':
+            compressor = brotli.Compressor(quality=self.brotli_quality)
+            flush = compressor.flush
+            finish = compressor.finish
+            process = compressor.process
+        else:
+            compressor = zlib.compressobj(self.gzip_level, zlib.DEFLATED, 31)
+            process = compressor.compress
+            flush = lambda: compressor.flush(zlib.Z_SYNC_FLUSH)  # noqa: E731
+            finish = compressor.flush
+        try:
+            for chunk in chunks:
+                if not chunk:
+                    continue
+                data = process(chunk) + flush()
+                if data:
+                    yield data
+            yield finish()
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+class _chain:
+    """Итератор по write()-буферу и телу ответа, сохраняющий close() исходного.
+
+    rest - уже начатый итератор по app_iter, если часть тела была прочитана заранее."""
+
+    def __init__(self, head, app_iter, rest=None):
+        self.head = head
+        self.app_iter = app_iter
+        self.rest = rest
+
+    def __iter__(self):
+        yield from self.head
+        yield from self.app_iter if self.rest is None else self.rest
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+
+def _prefetch(app_iter):
+    """Читает первую непустую часть тела, чтобы приложение успело вызвать start_response."""
+    rest = iter(app_iter)
+    try:
+        for chunk in rest:
+            if chunk:
+                return _chain([chunk], app_iter, rest)
+    except BaseException:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+        raise
+    return _chain([], app_iter, rest)
+
+
+def _add_vary(headers):
+    for i, (k, v) in enumerate(headers):
+        if k.lower() == 'vary':
+            if 'accept-encoding' not in v.lower():
+                headers[i] = (k, v + ', Accept-Encoding')
+            return
+    headers.append(('Vary', 'Accept-Encoding'))
+
+
+def _encoded_etag(etag, encoding):
+    # у сжатого и несжатого представлений должны быть разные ETag
+    if etag.endswith('"'):
+        return etag[:-1] + '-' + encoding + '"'
+    return etag + '-' + encoding
+
+
+def _decoded_etags(header):
+    # клиент присылает ETag сжатого представления, приложение знает только исходный
+    for encoding in ('gzip', 'br'):
+        header = header.replace('-' + encoding + '"', '"')
+    return header
+
+
+def _no_store(cache_control):
+    cache_control = cache_control.lower()
+    return 'no-store' in cache_control or 'private' in cache_control
@@ -0,0 +1,213 @@
+"""Офлайн-расчет таблицы "похожие товары" для страницы товара.
+
+Похожесть складывается из общей категории, общего производителя и того,
+насколько часто товары оказываются в одной корзине. Корзина - это заказ,
+еще не перенесенная в архив серия оплаченных строк Cart одного оформления или
+открытая корзина пользователя, но не покупатель: все заказы без входа
+оформлены на одного гостя, и по покупателю он связал бы между собой все, что
+покупали гости. Оценки считаются векторно NumPy по одной строке (товару) за
+раз: совместные покупки строки - это bincount по корзинам с этим товаром,
+поэтому матрица n x n в памяти не строится. Страница товара потом читает
+готовые K строк по первичному ключу.
+
+Запуск:  python related.py [--k 8] [--full] [--state related_state.npz]
+После расчета каталог и пары (покупатель, товар) сохраняются в файл состояния.
+Без --full они сравниваются с сохраненными, и пересчитываются только строки
+товаров, которых изменения касаются: у самого товара или у товара из той же
+категории/производителя поменялись данные, или у него или товара, купленного
+вместе с ним, поменялись корзины. В базу пишутся только изменившиеся списки.
+"""
+import argparse
+import os
+import numpy as np
+from app import app, db, init_db, Product, Cart, Order, OrderLine, RelatedProduct
+from archive import checkouts
+
+WEIGHT_CATEGORY = 1.0
+WEIGHT_CREATOR = 0.5
+WEIGHT_COOCCURRENCE = 2.0
+STATE_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'related_state.npz')
+
+
+def load_catalog():
+    rows = db.session.query(Product.id, Product.id_category, Product.id_creator).order_by(Product.id).all()
+    ids = np.array([r[0] for r in rows], dtype=np.int64)
+    categories = np.array([r[1] if r[1] is not None else -1 for r in rows], dtype=np.int64)
+    creators = np.array([r[2] if r[2] is not None else -1 for r in rows], dtype=np.int64)
+    return ids, categories, creators
+
+
+def load_baskets():
+    """Различные пары (корзина, товар).
+
+    Корзина заказа - его id, корзина из строк Cart - минус id первой ее строки, так что номера не пересекаются
+    и не меняются от запуска к запуску, пока строки не перенесены в архив. Открытые строки гостя не берутся:
+    это корзины разных посетителей, оставшиеся от старой схемы."""
+    pairs = db.session.query(OrderLine.id_order, OrderLine.id_product).join(Order, Order.id == OrderLine.id_order)\
+        .filter(Order.paid_for.is_(True)).all()
+    rows = db.session.query(Cart.id, Cart.id_user, Cart.id_product, Cart.paid_for, Cart.received)\
+        .filter(Cart.id_user.isnot(None)).order_by(Cart.id_user, Cart.id).all()
+    for _, _, group in checkouts([r for r in rows if r.paid_for]):
+        pairs += [(-group[0].id, r.id_product) for r in group]
+    open_carts = {}
+    for r in rows:
+        if not r.paid_for and r.id_user != app.config['GUEST_USER_ID']:
+            open_carts.setdefault(r.id_user, []).append(r)
+    for group in open_carts.values():
+        pairs += [(-group[0].id, r.id_product) for r in group]
+    return unique_pairs(np.array([p[0] for p in pairs], dtype=np.int64), np.array([p[1] for p in pairs], dtype=np.int64))
+
+
+def unique_pairs(keys, products):
+    if len(keys) == 0:
+        return keys, products
+    pairs = np.unique(np.stack([keys, products], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+
+class Baskets:
+    """Пары (корзина, товар) в виде двух разреженных индексов: товары корзины и корзины с товаром."""
+
+    def __init__(self, ids, basket_ids, products):
+        known = np.isin(products, ids)
+        self.cols = np.searchsorted(ids, products[known])  # номер товара в каталоге
+        self.basket_index, self.rows = np.unique(basket_ids[known], return_inverse=True)
+        self.by_basket = _csr(self.rows, self.cols, len(self.basket_index))
+        self.by_product = _csr(self.cols, self.rows, len(ids))
+        self.popularity = np.diff(self.by_product[0]).astype(np.float64)  # в скольких корзинах есть товар
+
+    def containing(self, cols):
+        return np.unique(_gather(*self.by_product, cols))
+
+    def products_of(self, rows):
+        return _gather(*self.by_basket, rows)
+
+
+def _csr(keys, values, n):
+    order = np.argsort(keys, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=n), out=indptr[1:])
+    return indptr, values[order]
+
+
+def _gather(indptr, values, keys):
+    """Склеенные значения строк keys разреженного индекса (без цикла по строкам)."""
+    keys = np.asarray(keys, dtype=np.int64)
+    starts, lengths = indptr[keys], indptr[keys + 1] - indptr[keys]
+    total = int(lengths.sum())
+    if total == 0:
+        return values[:0]
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return values[offsets + np.arange(total)]
+
+
+def score_row(i, categories, creators, baskets):
+    """Оценки похожести товара i на все товары каталога."""
+    score = WEIGHT_CATEGORY * (categories == categories[i]) + WEIGHT_CREATOR * (creators == creators[i])
+    rows = baskets.containing([i])
+    if len(rows):
+        co = np.bincount(baskets.products_of(rows), minlength=len(categories))  # в скольких корзинах с i есть и j
+        norm = np.sqrt(baskets.popularity[i] * baskets.popularity)
+        score = score + WEIGHT_COOCCURRENCE * np.divide(co, norm, out=np.zeros(len(co)), where=norm > 0)
+    score[i] = -np.inf  # товар не похож сам на себя
+    return score
+
+
+def top_k(ids, score, k):
+    """K лучших [(id похожего, оценка), ...] строки по убыванию оценки, при равенстве - по id."""
+    k = min(k, len(ids) - 1)
+    if k <= 0:
+        return []
+    kth = np.partition(score, len(score) - k)[len(score) - k]
+    candidates = np.flatnonzero(score >= kth)  # все равные k-й оценке, чтобы порядок не зависел от argpartition
+    candidates = candidates[np.lexsort((ids[candidates], -score[candidates]))][:k]
+    return [(int(ids[j]), round(float(score[j]), 4)) for j in candidates if score[j] > 0]
+
+
+def load_state(path):
+    if not path or not os.path.exists(path):
+        return None
+    with np.load(path) as state:
+        return {name: state[name] for name in state.files}
+
+
+def save_state(path, k, ids, categories, creators, basket_ids, products):
+    np.savez(path, k=np.array(k), ids=ids, categories=categories, creators=creators, baskets=basket_ids,
+             products=products)
+
+
+def affected_rows(state, ids, categories, creators, basket_ids, products, baskets):
+    """Номера товаров текущего каталога, чьи списки похожих могли измениться с прошлого расчета."""
+    old_ids = state['ids']
+    old = dict(zip(old_ids.tolist(), zip(state['categories'].tolist(), state['creators'].tolist())))
+    new = dict(zip(ids.tolist(), zip(categories.tolist(), creators.tolist())))
+    changed = {p for p in old.keys() | new.keys() if old.get(p) != new.get(p)}
+    touched_categories = {attrs[0] for p in changed for attrs in (old.get(p), new.get(p)) if attrs}
+    touched_creators = {attrs[1] for p in changed for attrs in (old.get(p), new.get(p)) if attrs}
+    rows = np.isin(ids, list(changed)) | np.isin(categories, list(touched_categories)) \
+        | np.isin(creators, list(touched_creators))
+
+    # у товаров из изменившихся пар меняется число корзин, а значит и совместные покупки
+    # со всеми товарами этих корзин - и по старым парам, и по новым
+    old_pairs = set(zip(state['baskets'].tolist(), state['products'].tolist()))
+    new_pairs = set(zip(basket_ids.tolist(), products.tolist()))
+    dirty = {p for _, p in old_pairs ^ new_pairs} | changed
+    if dirty:
+        old_baskets = {b for b, p in old_pairs if p in dirty}
+        neighbours = {p for b, p in old_pairs if b in old_baskets}
+        dirty_cols = np.searchsorted(ids, [p for p in dirty if p in new])
+        neighbours.update(ids[baskets.products_of(baskets.containing(dirty_cols))].tolist())
+        rows |= np.isin(ids, list(dirty | neighbours))
+    return np.flatnonzero(rows)
+
+
+def stored_table(product_ids=None):
+    stored = {}
+    query = RelatedProduct.query
+    if product_ids is not None:
+        query = query.filter(RelatedProduct.id_product.in_(product_ids))
+    for rec in query.order_by(RelatedProduct.id_product, RelatedProduct.rank):
+        stored.setdefault(rec.id_product, []).append((rec.id_related, round(rec.score, 4)))
+    return stored
+
+
+def refresh(k=8, full=False, state_path=STATE_PATH):
+    ids, categories, creators = load_catalog()
+    basket_ids, products = load_baskets()
+    baskets = Baskets(ids, basket_ids, products)
+    state = None if full else load_state(state_path)
+    if state is not None and ('baskets' not in state or int(state['k']) != k
+                              or (len(ids) and RelatedProduct.query.first() is None)):
+        state = None  # файл от расчета по покупателям, другой K или таблицу очистили - состояние к ней не относится
+    rows = np.arange(len(ids)) if state is None else affected_rows(state, ids, categories, creators, basket_ids, products, baskets)
+    related = {int(ids[i]): top_k(ids, score_row(i, categories, creators, baskets), k) for i in rows.tolist()}
+
+    if full:
+        RelatedProduct.query.delete()
+        stored = {}
+    else:
+        RelatedProduct.query.filter(RelatedProduct.id_product.notin_(ids.tolist())).delete(synchronize_session=False)
+        stored = stored_table(list(related))
+    changed = [product_id for product_id, lst in related.items() if stored.get(product_id, []) != lst]
+    if changed and not full:
+        RelatedProduct.query.filter(RelatedProduct.id_product.in_(changed)).delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(RelatedProduct, [
+        {'id_product': product_id, 'rank': rank, 'id_related': id_related, 'score': score}
+        for product_id in changed
+        for rank, (id_related, score) in enumerate(related[product_id])])
+    db.session.commit()
+    if state_path:
+        save_state(state_path, k, ids, categories, creators, basket_ids, products)
+    return len(ids), len(rows), len(changed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Пересчет таблицы похожих товаров')
+    parser.add_argument('--k', type=int, default=8, help='сколько похожих товаров хранить для каждого')
+    parser.add_argument('--full', action='store_true', help='пересчитать все товары и переписать таблицу целиком')
+    parser.add_argument('--state', default=STATE_PATH, help='файл состояния прошлого расчета')
+    args = parser.parse_args()
+    with app.app_context():
+        init_db()
+        total, computed, changed = refresh(args.k, args.full, args.state)
+    print(f'Товаров: {total}, пересчитано: {computed}, обновлено списков: {changed}')
@@ -0,0 +1,168 @@
+"""Офлайн-отчет по продажам и остаткам магазина.
+
+Отчет никогда не читает рабочую базу напрямую: сначала через backup API SQLite
+делается копия файла (запись в живую базу при этом не блокируется дольше, чем
+копирование одной порции страниц), и все запросы идут к этой копии, открытой
+только для чтения. Данные читаются порциями в колонки NumPy.
+
+Запуск:  python report.py [--db database.db] [--out reports] [--format csv|parquet] [--window 30] [--date ГГГГ-ММ-ДД]
+
+Результаты:
+  revenue_by_category, revenue_by_creator, revenue_by_day - выручка
+  products - продажи, остаток, sell-through и прогноз дней до окончания товара
+"""
+import argparse
+import csv
+import os
+import shutil
+import sqlite3
+import tempfile
+from datetime import date
+import numpy as np
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+CHUNK = 10000
+BACKUP_PAGES = 256  # страниц за шаг копирования - между шагами живая база доступна для записи
+
+
+def snapshot(src, dst):
+    source = sqlite3.connect(f'file:{src}?mode=ro', uri=True)
+    target = sqlite3.connect(dst)
+    with target:
+        source.backup(target, pages=BACKUP_PAGES)
+    target.close()
+    source.close()
+    return sqlite3.connect(f'file:{dst}?mode=ro', uri=True)
+
+
+def read_columns(conn, sql, dtypes):
+    """Читает результат запроса порциями и возвращает список массивов-колонок."""
+    cursor = conn.execute(sql)
+    parts = [[] for _ in dtypes]
+    while True:
+        rows = cursor.fetchmany(CHUNK)
+        if not rows:
+            break
+        for i, col in enumerate(zip(*rows)):
+            parts[i].append(np.array([v if v is not None else _empty(dtypes[i]) for v in col], dtype=dtypes[i]))
+    return [np.concatenate(p) if p else np.array([], dtype=d) for p, d in zip(parts, dtypes)]
+
+
+def _empty(dtype):
+    return '' if dtype is object else 0
+
+
+def has_table(conn, name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (name,)).fetchone() is not None
+
+
+def load(conn):
+    product_id, category_id, creator_id, price, in_stock = read_columns(
+        conn, 'SELECT id, id_category, id_creator, price, in_stock FROM product ORDER BY id',
+        [np.int64, np.int64, np.int64, np.float64, np.float64])
+    category_names = dict(conn.execute('SELECT id, category FROM category'))
+    creator_names = dict(conn.execute('SELECT id, brand FROM creator'))
+
+    # оплаченные строки, еще не перенесенные в архив: даты у них нет, цена - текущая, скидка - как у строк заказов
+    cart_product, cart_quantity, cart_discount = read_columns(
+        conn, 'SELECT id_product, quantity, coalesce(discount, 0) FROM cart WHERE paid_for = 1',
+        [np.int64, np.float64, np.float64])
+    positions = np.minimum(np.searchsorted(product_id, cart_product), max(len(product_id) - 1, 0))
+    cart_price = (price[positions] if len(product_id) else np.zeros(len(cart_product))) * (1 - cart_discount)
+    sales = [(cart_product, cart_quantity, cart_price, np.full(len(cart_product), '', dtype=object))]
+    if has_table(conn, 'order_line'):
+        sales.append(read_columns(
+            conn, 'SELECT l.id_product, l.quantity, l.price * (1 - coalesce(l.discount, 0)), date(o.created_at) '
+                  'FROM order_line l JOIN "order" o ON o.id = l.id_order WHERE o.paid_for = 1',
+            [np.int64, np.float64, np.float64, object]))
+    sold_product, sold_quantity, sold_price, sold_day = (np.concatenate(c) for c in zip(*sales))
+    known = np.isin(sold_product, product_id)
+    return {
+        'product_id': product_id, 'category_id': category_id, 'creator_id': creator_id,
+        'in_stock': in_stock, 'category_names': category_names, 'creator_names': creator_names,
+        'sold_product': sold_product[known], 'sold_quantity': sold_quantity[known],
+        'sold_revenue': (sold_quantity * sold_price)[known], 'sold_day': sold_day[known],
+    }
+
+
+def group_sum(keys, values):
+    """Сумма values по группам keys (векторно, через np.unique + bincount)."""
+    if len(keys) == 0:
+        return np.array([]), np.array([])
+    groups, inverse = np.unique(keys, return_inverse=True)
+    return groups, np.bincount(inverse, weights=values, minlength=len(groups))
+
+
+def build(data, window, today=None):
+    idx = np.searchsorted(data['product_id'], data['sold_product'])
+    revenue = data['sold_revenue']
+    tables = {}
+
+    groups, sums = group_sum(data['category_id'][idx], revenue)
+    tables['revenue_by_category'] = (['category', 'revenue'],
+                                     [[data['category_names'].get(g, g) for g in groups.tolist()], np.round(sums, 2)])
+    groups, sums = group_sum(data['creator_id'][idx], revenue)
+    tables['revenue_by_creator'] = (['creator', 'revenue'],
+                                    [[data['creator_names'].get(g, g) for g in groups.tolist()], np.round(sums, 2)])
+    dated = data['sold_day'] != ''
+    groups, sums = group_sum(data['sold_day'][dated].astype(str), revenue[dated])
+    tables['revenue_by_day'] = (['day', 'revenue'], [groups, np.round(sums, 2)])
+
+    n = len(data['product_id'])
+    sold = np.bincount(idx, weights=data['sold_quantity'], minlength=n)
+    stock = data['in_stock']
+    total = sold + stock
+    sell_through = np.divide(sold, total, out=np.zeros(n), where=total > 0)
+
+    # прогноз: остаток / средние продажи в день за window календарных дней, заканчивающихся датой отчета,
+    # а не последней продажей - иначе товар, который давно не продается, выглядел бы ходовым
+    rate = np.zeros(n)
+    if dated.any():
+        end = np.datetime64(today or date.today(), 'D')
+        days = data['sold_day'][dated].astype('datetime64[D]')
+        recent = (days > end - np.timedelta64(window, 'D')) & (days <= end)
+        span = min(window, max(int((end - days.min()) / np.timedelta64(1, 'D')) + 1, 1))  # магазин моложе окна
+        rate = np.bincount(idx[dated][recent], weights=data['sold_quantity'][dated][recent], minlength=n) / span
+    days_left = np.divide(stock, rate, out=np.full(n, np.inf), where=rate > 0)
+    tables['products'] = (['id_product', 'sold', 'in_stock', 'sell_through', 'daily_rate', 'days_to_stock_out'],
+                          [data['product_id'], sold, stock, np.round(sell_through, 4), np.round(rate, 4),
+                           np.round(days_left, 1)])
+    return tables
+
+
+def write(tables, out, fmt):
+    os.makedirs(out, exist_ok=True)
+    for name, (header, columns) in tables.items():
+        if fmt == 'parquet':
+            import pandas as pd  # нужен только для Parquet (и pyarrow или fastparquet)
+            pd.DataFrame({h: np.asarray(c) for h, c in zip(header, columns)}).to_parquet(os.path.join(out, name + '.parquet'))
+        else:
+            with open(os.path.join(out, name + '.csv'), 'w', newline='', encoding='utf-8') as f:
+                writer = csv.writer(f)
+                writer.writerow(header)
+                writer.writerows(zip(*(np.asarray(c).tolist() for c in columns)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Отчет по продажам и остаткам')
+    parser.add_argument('--db', default=os.path.join(basedir, 'database.db'), help='рабочая база (копируется перед чтением)')
+    parser.add_argument('--out', default=os.path.join(basedir, 'reports'), help='каталог для результатов')
+    parser.add_argument('--format', choices=('csv', 'parquet'), default='csv')
+    parser.add_argument('--window', type=int, default=30, help='за сколько дней до даты отчета брать продажи для прогноза')
+    parser.add_argument('--date', type=date.fromisoformat, default=None, help='дата отчета, по умолчанию сегодня')
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    try:
+        conn = snapshot(args.db, os.path.join(tmp, 'snapshot.db'))
+        tables = build(load(conn), args.window, args.date)
+        conn.close()
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+    write(tables, args.out, args.format)
+    for name, (_, columns) in tables.items():
+        print(f'{name}: {len(columns[0])} строк')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,552 @@
+#!/usr/bin/env python
+import csv
+import gzip
+import os
+import shutil
+from datetime import datetime
+import tempfile
+import unittest
+from unittest import mock
+
+os.environ['DATABASE_URL'] = 'sqlite://'  # до импорта приложения: рабочая база database.db не затрагивается
+
+import brotli
+import numpy as np
+import sqlalchemy as sa
+from cloudipsp.helpers import get_signature
+import app as shop
+import archive
+import related
+import report
+from app import app, db, Cart, Category, Creator, Order, OrderLine, Product, RelatedProduct, User
+from cart_store import MemoryCartStore, SQLiteCartStore
+from compression import CompressionMiddleware
+
+
+class ShopCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['WTF_CSRF_ENABLED'] = False
+        self.app_context = app.app_context()
+        self.app_context.push()
+        shop.init_db()
+        shop.carts = MemoryCartStore(ttl=app.config['CART_TTL'])
+        shop.catalog.invalidate()
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.app_context.pop()
+
+    def add_products(self, *products):
+        db.session.add_all([Category(id=1, category='Телефоны', clr='red'), Category(id=2, category='Ноутбуки', clr='blue'),
+                            Creator(id=1, brand='Acme'), Creator(id=2, brand='Globex')])
+        for i, fields in enumerate(products, 1):
+            fields.setdefault('name', f'Товар номер {i}')
+            fields.setdefault('id_creator', 1)
+            db.session.add(Product(id=i, **fields))
+        db.session.commit()
+
+
+class CompressionCase(ShopCase):
+    def test_negotiation(self):
+        # на главной странице "старая" цена случайна, поэтому берется страница, которая не меняется
+        plain = self.client.get('/contact', headers={'Accept-Encoding': 'identity'})
+        self.assertEqual(plain.status_code, 200)
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        self.assertEqual(gzip.decompress(rv.data), plain.data)
+        self.assertLess(int(rv.headers['Content-Length']), len(plain.data))
+
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'gzip;q=0.5, br'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(rv.data), plain.data)
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'br;q=0, gzip'})
+        self.assertEqual(rv.headers['Content-Encoding'], 'gzip')
+
+    def test_etag(self):
+        plain = self.client.get('/contact', headers={'Accept-Encoding': 'identity'})
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'gzip'})
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.endswith('-gzip"'))
+        self.assertNotEqual(etag, plain.headers['ETag'])
+
+        # повторный запрос берет сжатое тело из кэша прослойки
+        cache = app.wsgi_app.cache
+        size = cache.size
+        self.assertGreater(size, 0)
+        self.assertEqual(self.client.get('/contact', headers={'Accept-Encoding': 'gzip'}).data, rv.data)
+        self.assertEqual(cache.size, size)
+
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+        self.assertEqual(rv.status_code, 304)
+        self.assertEqual(rv.headers['ETag'], etag)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+        rv = self.client.get('/contact', headers={'Accept-Encoding': 'identity', 'If-None-Match': plain.headers['ETag']})
+        self.assertEqual(rv.status_code, 304)
+        self.assertIn('Accept-Encoding', rv.headers['Vary'])
+
+    def test_vary_uncompressed(self):
+        # и короткий ответ, и 304 не сжимаются, но прокси должен различать их по Accept-Encoding
+        def small_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html'), ('Content-Length', '2')])
+            return [b'ok']
+
+        def not_modified_app(environ, start_response):
+            start_response('304 NOT MODIFIED', [('ETag', '"x"')])
+            return []
+
+        for wsgi_app in (small_app, not_modified_app):
+            headers = {}
+
+            def start_response(status, response_headers, exc_info=None):
+                headers.update(response_headers)
+            b''.join(CompressionMiddleware(wsgi_app)({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                                                     start_response))
+            self.assertNotIn('Content-Encoding', headers)
+            self.assertEqual(headers['Vary'], 'Accept-Encoding')
+
+    def test_streaming(self):
+        parts = [b'<p>%d</p>' % i * 50 for i in range(5)]
+        sent = []
+
+        def generator_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/html')])
+            for part in parts:
+                sent.append(part)
+                yield part
+
+        wrapped = CompressionMiddleware(generator_app)
+        headers = {}
+
+        def start_response(status, response_headers, exc_info=None):
+            headers.update(response_headers)
+        body = wrapped({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'}, start_response)
+        chunks = []
+        for chunk in body:
+            chunks.append(chunk)
+            if len(chunks) == 1:
+                self.assertEqual(len(sent), 1)  # первая часть ушла до того, как приложение выдало остальные
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertNotIn('Content-Length', headers)
+        self.assertEqual(gzip.decompress(b''.join(chunks)), b''.join(parts))
+
+    def test_lazy_start_response(self):
+        # start_response вызывается только при первой итерации тела
+        def lazy_app(environ, start_response):
+            def body():
+                start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '1000')])
+                yield b'a' * 600
+                yield b'b' * 400
+            return body()
+
+        wrapped = CompressionMiddleware(lazy_app)
+        statuses = []
+        body = wrapped({'REQUEST_METHOD': 'GET', 'HTTP_ACCEPT_ENCODING': 'gzip'},
+                       lambda status, headers, exc_info=None: statuses.append((status, dict(headers))))
+        self.assertEqual(statuses[0][0], '200 OK')
+        self.assertEqual(statuses[0][1]['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(body)), b'a' * 600 + b'b' * 400)
+
+
+class RelatedCase(ShopCase):
+    def setUp(self):
+        super().setUp()
+        self.state = os.path.join(tempfile.mkdtemp(), 'related_state.npz')
+        self.add_products(*({'id_category': 1 if i <= 3 else 2, 'id_creator': 1 if i % 2 else 2, 'price': 10.0 * i}
+                            for i in range(1, 7)))
+        # пользователь 1 - гость, на него оформляются заказы без входа
+        db.session.add_all([User(id=u, email=f'user{u}@example.com', nickname=f'user{u}', password='x') for u in range(1, 6)])
+        self.buy(2, 1, 4)
+        self.buy(3, 1, 4, 5)
+        self.buy(4, 2, 3)
+
+    def tearDown(self):
+        if os.path.exists(self.state):
+            os.remove(self.state)
+        os.rmdir(os.path.dirname(self.state))
+        super().tearDown()
+
+    def buy(self, id_user, *products):
+        db.session.add_all([Cart(id_user=id_user, id_product=p, quantity=1) for p in products])
+        db.session.commit()
+
+    def table(self):
+        return {p: [r for r, _ in lst] for p, lst in related.stored_table().items()}
+
+    def test_refresh(self):
+        total, computed, changed = related.refresh(k=3, state_path=self.state)
+        self.assertEqual((total, computed, changed), (6, 6, 6))
+        table = self.table()
+        # товар 4 из другой категории, но его покупают вместе с 1
+        self.assertEqual(table[1][0], 4)
+        self.assertIn(1, table[4])
+        self.assertEqual(len(table[1]), 3)
+        self.assertNotIn(1, table[1])
+        rank = [r.rank for r in RelatedProduct.query.filter_by(id_product=1).order_by(RelatedProduct.rank)]
+        self.assertEqual(rank, [0, 1, 2])
+
+        # ничего не изменилось - ничего не пересчитывается
+        self.assertEqual(related.refresh(k=3, state_path=self.state), (6, 0, 0))
+
+    def test_incremental_refresh(self):
+        related.refresh(k=3, state_path=self.state)
+        self.buy(5, 6, 3)
+        total, computed, changed = related.refresh(k=3, state_path=self.state)
+        self.assertLess(computed, total)
+        incremental = self.table()
+        self.assertIn(3, incremental[6])
+        related.refresh(k=3, full=True, state_path=None)
+        self.assertEqual(self.table(), incremental)
+
+        # смена категории затрагивает товары обеих категорий
+        Product.query.get(5).id_category = 1
+        db.session.commit()
+        total, computed, changed = related.refresh(k=3, state_path=self.state)
+        self.assertEqual(computed, 6)
+        incremental = self.table()
+        related.refresh(k=3, full=True, state_path=None)
+        self.assertEqual(self.table(), incremental)
+
+    def test_guest_orders(self):
+        # два гостевых заказа - две разные корзины, а не один покупатель, купивший все
+        for products in ((2,), (6,)):
+            shop.create_order(app.config['GUEST_USER_ID'], [(p, 1, None) for p in products], paid_for=True)
+        db.session.add_all([Cart(id_user=app.config['GUEST_USER_ID'], id_product=p, quantity=1, paid_for=True,
+                                 received=received) for p, received in ((2, False), (6, True))])
+        db.session.commit()
+        basket_ids, products = related.load_baskets()
+        baskets = {}
+        for b, p in zip(basket_ids.tolist(), products.tolist()):
+            baskets.setdefault(b, set()).add(p)
+        self.assertNotIn({2, 6}, list(baskets.values()))
+        self.assertEqual(sorted(map(sorted, baskets.values())).count([2]), 2)
+
+    def test_item_page(self):
+        related.refresh(k=3, state_path=self.state)
+        Product.query.get(4).price = None
+        db.session.commit()
+        rv = self.client.get('/1')
+        self.assertEqual(rv.status_code, 200)
+        self.assertIn('С этим товаром смотрят', rv.get_data(as_text=True))
+
+
+class CatalogCase(ShopCase):
+    def setUp(self):
+        super().setUp()
+        self.add_products({'id_category': 1, 'price': 10.0, 'in_stock': 5, 'created_at': datetime(2024, 1, 1)},
+                          {'id_category': 1, 'price': 30.0, 'in_action': True, 'created_at': datetime(2024, 1, 3)},
+                          {'id_category': 2, 'price': 20.0, 'in_action': True, 'in_stock': 1, 'created_at': datetime(2024, 1, 2)},
+                          {'id_category': 2, 'price': 40.0, 'new': True, 'in_stock': 2, 'created_at': datetime(2024, 1, 4)},
+                          {'id_category': 1, 'price': None, 'created_at': datetime(2024, 1, 5)})
+
+    def test_search(self):
+        search = shop.catalog.search
+        self.assertEqual(search(), [5, 4, 2, 3, 1])
+        self.assertEqual(search(sort='price'), [5, 1, 3, 2, 4])
+        self.assertEqual(search(price_min=15, price_max=35, sort='price'), [3, 2])
+        self.assertEqual(search(price_min=20, price_max=20), [3])
+        self.assertEqual(search(category=1, sort='-price'), [2, 1, 5])
+        self.assertEqual(search(category=1, price_min=5), [2, 1])
+        self.assertEqual(search(in_action=True, sort='price'), [3, 2])
+        self.assertEqual(search(in_action=True, in_stock=True), [3])
+        self.assertEqual(search(category=2, in_stock=True, price_max=30), [3])
+        self.assertEqual(search(category=2, new=True, in_action=True), [])
+        self.assertEqual(search(category=9), [])
+
+        rv = self.client.get('/?category=1&price_min=5&sort=price')
+        html = rv.get_data(as_text=True)
+        self.assertIn('Товар номер 1', html)
+        self.assertNotIn('Товар номер 4', html)  # другая категория и не в блоке акций
+
+    def test_invalidation(self):
+        search = shop.catalog.search
+        self.assertEqual(search(category=2, sort='price'), [3, 4])
+        Product.query.get(4).price = 5.0
+        db.session.commit()
+        self.assertEqual(search(category=2, sort='price'), [4, 3])
+
+        # массовое изменение в обход ORM, как из другого процесса
+        db.session.execute(db.text('UPDATE product SET id_category = 2 WHERE id = 1'))
+        db.session.commit()
+        self.assertEqual(search(category=2, sort='price'), [4, 1, 3])
+        db.session.execute(db.text('DELETE FROM product WHERE id = 3'))
+        db.session.commit()
+        self.assertEqual(search(category=2, sort='price'), [4, 1])
+
+        # без изменений индекс не перестраивается
+        with mock.patch.object(shop.catalog, '_build') as build:
+            search()
+        build.assert_not_called()
+
+
+class CartCase(ShopCase):
+    def setUp(self):
+        super().setUp()
+        self.add_products({'id_category': 1, 'price': 10.0}, {'id_category': 1, 'price': 25.0})
+
+    def test_add(self):
+        self.assertEqual(self.client.get('/add/1?add_quantity=2').status_code, 200)
+        self.assertEqual(self.client.get('/add/99?add_quantity=1').status_code, 404)
+        with self.client.session_transaction() as session:
+            self.assertEqual(shop.carts.get('s:' + session['cart_id']), {1: 2})
+        self.assertEqual(Cart.query.count(), 0)  # корзина посетителя живет только в хранилище
+
+    def check_ttl(self, store, clock):
+        with mock.patch(clock) as now:
+            now.return_value = 1000.0
+            store.update('s:a', lambda cart: cart.update({1: 1}))
+            store.update('s:b', lambda cart: cart.update({2: 1}))
+            now.return_value = 1000.0 + 50
+            self.assertEqual(store.get('s:a'), {1: 1})  # обращение продлевает жизнь корзины
+            now.return_value = 1000.0 + 120
+            self.assertEqual(store.get('s:a'), {1: 1})
+            self.assertEqual(store.get('s:b'), {})
+            now.return_value = 1000.0 + 1000
+            self.assertEqual(store.get('s:a'), {})
+            self.assertEqual(len(store), 0)
+
+    def test_memory_store_ttl(self):
+        self.check_ttl(MemoryCartStore(ttl=100, sweep_interval=0), 'cart_store.time.monotonic')
+
+    def test_sqlite_store_ttl(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'carts.db')
+        try:
+            self.check_ttl(SQLiteCartStore(path, ttl=100, sweep_interval=0), 'cart_store.time.time')
+        finally:
+            for name in os.listdir(directory):
+                os.remove(os.path.join(directory, name))
+            os.rmdir(directory)
+
+    def test_login_merge(self):
+        db.session.add_all([Cart(id_user=1, id_product=1, quantity=1), Cart(id_user=1, id_product=2, quantity=1)])
+        db.session.commit()
+        self.client.get('/add/1?add_quantity=2')
+        with self.client.session_transaction() as session:
+            guest = 's:' + session['cart_id']
+        with app.test_request_context():
+            shop.session['cart_id'] = guest[2:]
+            shop.login_cart(1)
+            self.assertEqual(shop.session['id_user'], 1)
+            self.assertNotIn('cart_id', shop.session)
+        self.assertEqual(shop.carts.get('u:1'), {1: 3, 2: 1})
+        self.assertEqual(shop.carts.get(guest), {})
+
+        # при следующем входе сохраненные строки уже в корзине и второй раз не добавляются
+        with app.test_request_context():
+            shop.session['cart_id'] = 'next'
+            shop.carts.update('s:next', lambda cart: cart.update({2: 1}))
+            shop.login_cart(1)
+        self.assertEqual(shop.carts.get('u:1'), {1: 3, 2: 2})
+
+
+class ReportCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'shop.db')
+        engine = sa.create_engine('sqlite:///' + self.path)
+        db.metadata.create_all(engine)
+        tables = db.metadata.tables
+        with engine.begin() as conn:
+            conn.execute(tables['category'].insert(), [{'id': 1, 'category': 'Телефоны'}, {'id': 2, 'category': 'Ноутбуки'}])
+            conn.execute(tables['creator'].insert(), [{'id': 1, 'brand': 'Acme'}, {'id': 2, 'brand': 'Globex'}])
+            conn.execute(tables['product'].insert(), [
+                {'id': 1, 'name': 'Телефон', 'id_creator': 1, 'id_category': 1, 'price': 10.0, 'in_stock': 10},
+                {'id': 2, 'name': 'Ноутбук', 'id_creator': 2, 'id_category': 2, 'price': 20.0, 'in_stock': 0},
+                {'id': 3, 'name': 'Планшет', 'id_creator': 1, 'id_category': 1, 'price': 30.0, 'in_stock': 4}])
+            conn.execute(tables['order'].insert(), [
+                {'id': 1, 'id_user': 1, 'created_at': datetime(2024, 1, 1), 'total': 20, 'paid_for': True},
+                {'id': 2, 'id_user': 1, 'created_at': datetime(2024, 1, 10), 'total': 35, 'paid_for': True},
+                {'id': 3, 'id_user': 1, 'created_at': datetime(2024, 1, 10), 'total': 1000, 'paid_for': False}])
+            conn.execute(tables['order_line'].insert(), [
+                {'id_order': 1, 'id_product': 1, 'quantity': 2, 'price': 10.0, 'discount': None},
+                {'id_order': 2, 'id_product': 1, 'quantity': 3, 'price': 10.0, 'discount': 0.5},
+                {'id_order': 2, 'id_product': 2, 'quantity': 1, 'price': 20.0, 'discount': None},
+                {'id_order': 3, 'id_product': 1, 'quantity': 100, 'price': 10.0, 'discount': None}])  # не оплачен - не продажа
+            conn.execute(tables['cart'].insert(), [
+                {'id_user': 1, 'id_product': 2, 'quantity': 1, 'discount': 0.25, 'paid_for': True},  # оплачен до архива, без даты
+                {'id_user': 1, 'id_product': 3, 'quantity': 7, 'discount': None, 'paid_for': False}])
+        engine.dispose()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def build(self, window, today=datetime(2024, 1, 10).date()):
+        conn = report.snapshot(self.path, os.path.join(self.directory, 'snapshot.db'))
+        try:
+            return report.build(report.load(conn), window, today)
+        finally:
+            conn.close()
+
+    def columns(self, tables, name):
+        header, columns = tables[name]
+        return dict(zip(header, (np.asarray(c).tolist() for c in columns)))
+
+    def test_columns(self):
+        tables = self.build(30)
+        self.assertEqual(self.columns(tables, 'revenue_by_category'), {'category': ['Телефоны', 'Ноутбуки'], 'revenue': [35.0, 35.0]})
+        self.assertEqual(self.columns(tables, 'revenue_by_creator'), {'creator': ['Acme', 'Globex'], 'revenue': [35.0, 35.0]})
+        self.assertEqual(self.columns(tables, 'revenue_by_day'), {'day': ['2024-01-01', '2024-01-10'], 'revenue': [20.0, 35.0]})
+        products = self.columns(tables, 'products')
+        self.assertEqual(products['id_product'], [1, 2, 3])
+        self.assertEqual(products['sold'], [5.0, 2.0, 0.0])
+        self.assertEqual(products['in_stock'], [10.0, 0.0, 4.0])
+        self.assertEqual(products['sell_through'], [0.3333, 1.0, 0.0])
+
+        out = os.path.join(self.directory, 'reports')
+        report.write(tables, out, 'csv')
+        with open(os.path.join(out, 'products.csv'), encoding='utf-8') as f:
+            rows = list(csv.reader(f))
+        self.assertEqual(rows[0], ['id_product', 'sold', 'in_stock', 'sell_through', 'daily_rate', 'days_to_stock_out'])
+        self.assertEqual(len(rows), 4)
+
+    def test_forecast(self):
+        # продажи с датой идут 10 дней: 5 телефонов и 1 ноутбук
+        products = self.columns(self.build(30), 'products')
+        self.assertEqual(products['daily_rate'], [0.5, 0.1, 0.0])
+        self.assertEqual(products['days_to_stock_out'], [20.0, 0.0, float('inf')])
+        # за последние 5 дней - только заказ от 10 января
+        products = self.columns(self.build(5), 'products')
+        self.assertEqual(products['daily_rate'], [0.6, 0.2, 0.0])
+        self.assertEqual(products['days_to_stock_out'], [16.7, 0.0, float('inf')])
+        # окно кончается датой отчета: через два месяца без продаж товар уже не ходовой
+        products = self.columns(self.build(30, datetime(2024, 3, 10).date()), 'products')
+        self.assertEqual(products['daily_rate'], [0.0, 0.0, 0.0])
+        self.assertEqual(products['days_to_stock_out'], [float('inf'), float('inf'), float('inf')])
+        # 10 января в окне 30 дней, окончившихся 20 января: 3 телефона и ноутбук за 20 дней истории
+        products = self.columns(self.build(30, datetime(2024, 1, 20).date()), 'products')
+        self.assertEqual(products['daily_rate'], [0.25, 0.05, 0.0])
+
+
+class FakeCheckout:
+    """Подменяет Checkout из cloudipsp: ссылка на оплату без обращения к платежной системе."""
+    requests = []
+
+    def __init__(self, api):
+        self.api = api
+
+    def url(self, data):
+        self.requests.append(data)
+        return {'checkout_url': 'https://pay.example.com/' + data['order_id']}
+
+
+class OrderCase(ShopCase):
+    def setUp(self):
+        super().setUp()
+        self.add_products({'id_category': 1, 'price': 10.0}, {'id_category': 1, 'price': 25.0})
+        FakeCheckout.requests = []
+
+    def gateway_post(self, endpoint, status='approved', sign=True, **fields):
+        request = FakeCheckout.requests[-1]
+        data = {'order_id': request['order_id'], 'order_status': status, 'merchant_data': request['merchant_data'],
+                'amount': request['amount'], 'currency': request['currency'], **fields}
+        if sign:
+            data['signature'] = get_signature(app.config['PAYMENT_SECRET_KEY'], data, '1.0')
+        return self.client.post(endpoint, data=data)
+
+    def cart(self):
+        with self.client.session_transaction() as session:
+            return shop.carts.get('s:' + session['cart_id'])
+
+    def test_payment(self):
+        self.client.get('/add/1?add_quantity=2')
+        self.client.get('/add/2?add_quantity=1')
+        with mock.patch.object(shop, 'Checkout', FakeCheckout):
+            rv = self.client.get('/payment?amount=1')  # сумма из запроса не используется
+        self.assertEqual(rv.status_code, 302)
+        self.assertTrue(rv.headers['Location'].startswith('https://pay.example.com/'))
+        order = Order.query.one()
+        self.assertFalse(order.paid_for)
+        self.assertEqual(order.total, 45.0)
+        self.assertEqual((FakeCheckout.requests[-1]['amount'], FakeCheckout.requests[-1]['currency']), (4500, 'BYN'))
+        self.assertEqual(self.cart(), {1: 2, 2: 1})  # до подтверждения оплаты корзина цела
+
+        self.assertEqual(self.gateway_post('/payment/result', sign=False).status_code, 400)
+        self.assertEqual(self.gateway_post('/payment/result', order_desc='подделка', sign=False,
+                                           signature='0' * 40).status_code, 400)
+        # подписанный ответ о другой сумме или валюте заказ не оплачивает
+        self.assertEqual(self.gateway_post('/payment/callback', amount=100).status_code, 400)
+        self.assertEqual(self.gateway_post('/payment/callback', currency='USD').status_code, 400)
+        self.assertEqual(self.gateway_post('/payment/callback', amount='').status_code, 400)
+        self.assertFalse(Order.query.get(order.id).paid_for)
+        rv = self.gateway_post('/payment/result', status='declined')
+        self.assertTrue(rv.headers['Location'].endswith('/shop_cart'))
+        self.assertFalse(Order.query.get(order.id).paid_for)
+        self.assertEqual(self.cart(), {1: 2, 2: 1})
+
+        self.client.get('/add/2?add_quantity=3')  # добавлено после оформления
+        self.assertEqual(self.gateway_post('/payment/callback').status_code, 200)
+        db.session.expire_all()
+        self.assertTrue(Order.query.get(order.id).paid_for)
+        self.assertEqual(self.cart(), {2: 3})
+        # браузер возвращается после уведомления сервера - второй раз товары не списываются
+        rv = self.gateway_post('/payment/result')
+        self.assertTrue(rv.headers['Location'].endswith('/orders'))
+        self.assertEqual(self.cart(), {2: 3})
+        self.assertIn('(оплачен)', self.client.get('/orders').get_data(as_text=True))
+
+    def test_guest_orders(self):
+        guests = [app.test_client(), app.test_client()]
+        with mock.patch.object(shop, 'Checkout', FakeCheckout):
+            for client, id_product in zip(guests, (1, 2)):
+                client.get(f'/add/{id_product}?add_quantity=1')
+                client.get('/payment')
+        first, second = Order.query.order_by(Order.id).all()
+        # заказы оформлены на одного гостя, но каждая сессия видит только свой
+        self.assertEqual(first.id_user, second.id_user)
+        page = guests[0].get('/orders').get_data(as_text=True)
+        self.assertIn(f'Заказ №{first.id} ', page)
+        self.assertNotIn(f'Заказ №{second.id} ', page)
+        self.assertNotIn('Заказ №', self.client.get('/orders').get_data(as_text=True))
+
+        # после входа заказ сессии переходит к пользователю
+        db.session.add(User(id=2, email='user2@example.com', nickname='user2', password='x'))
+        db.session.commit()
+        with guests[1].session_transaction() as session:
+            cart_id = session['cart_id']
+        with app.test_request_context():
+            shop.session['cart_id'] = cart_id
+            shop.login_cart(2)
+        self.assertEqual(Order.query.get(second.id).id_user, 2)
+
+    def test_payment_logged_in(self):
+        db.session.add(Cart(id_user=1, id_product=1, quantity=1))
+        db.session.commit()
+        with self.client.session_transaction() as session:
+            session['id_user'] = 1
+        shop.carts.update('u:1', lambda cart: cart.update({1: 1}))
+        with mock.patch.object(shop, 'Checkout', FakeCheckout):
+            self.client.get('/payment')
+        self.assertEqual(Cart.query.count(), 1)
+        self.gateway_post('/payment/callback')
+        self.assertEqual(Cart.query.count(), 0)
+        self.assertEqual(shop.carts.get('u:1'), {})
+
+    def test_archive(self):
+        rows = [(1, 1, True, False), (1, 2, True, False), (2, 1, True, False), (1, 2, True, True),
+                (2, 2, True, False), (1, 1, False, False), (3, 1, True, False), (3, 2, True, False)]
+        db.session.add_all([Cart(id_user=u, id_product=p, quantity=1, paid_for=paid, received=received)
+                            for u, p, paid, received in rows])
+        db.session.commit()
+        archived, orders = archive.archive_paid(chunk=2)
+        self.assertEqual((archived, orders), (7, 4))
+        # серия строк пользователя 1 с received=False - один заказ, хотя порция меньше серии
+        by_user = {}
+        for order in Order.query.order_by(Order.id):
+            by_user.setdefault(order.id_user, []).append(
+                (order.received, sorted(line.id_product for line in order.lines)))
+            self.assertTrue(order.paid_for)
+            self.assertIsNone(order.created_at)
+        self.assertEqual(by_user, {1: [(False, [1, 2]), (True, [2])], 2: [(False, [1, 2])], 3: [(False, [1, 2])]})
+        self.assertEqual([(c.id_user, c.paid_for) for c in Cart.query], [(1, False)])
+        self.assertEqual(OrderLine.query.count(), 7)
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=2)
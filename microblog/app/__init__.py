@@ -1,6 +1,3 @@
-import logging
-from logging.handlers import SMTPHandler, RotatingFileHandler
-import os
 from flask import Flask, request, current_app
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
@@ -9,8 +6,9 @@ from flask_mail import Mail
 from flask_bootstrap import Bootstrap
 from flask_moment import Moment
 from flask_babel import Babel, lazy_gettext as _l
-from elasticsearch import Elasticsearch
 from config import Config
+from app.search import make_backend
+from app.events import make_broker
 
 db = SQLAlchemy()
 migrate = Migrate()
@@ -34,8 +32,41 @@ def create_app(config_class=Config):
     bootstrap.init_app(app)
     moment.init_app(app)
     babel.init_app(app)
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-        if app.config['ELASTICSEARCH_URL'] else None
+    app.search = make_backend(app)
+    app.events = make_broker(app)
+
+    from app.indexer import SearchIndexer
+    SearchIndexer(app)
+
+    from app.passwords import PasswordHasher
+    PasswordHasher(app)
+
+    from app.query_budget import QueryBudget
+    QueryBudget(app)
+
+    from app.email import MailDispatcher
+    MailDispatcher(app)
+
+    from app.translate import Translator
+    Translator(app)
+
+    from app.language import LanguageDetector
+    LanguageDetector(app)
+
+    from app.timeline import TimelineFanout
+    TimelineFanout(app)
+
+    from app.graph import FollowGraph
+    FollowGraph(app)
+
+    from app.presence import LastSeenTracker
+    LastSeenTracker(app)
+
+    from app.fragments import FragmentCache
+    FragmentCache(app)
+
+    from app.metrics import MetricsLog
+    MetricsLog(app)
 
     from app.errors import bp as errors_bp
     app.register_blueprint(errors_bp)
@@ -46,39 +77,12 @@ def create_app(config_class=Config):
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.api import bp as api_bp
+    app.register_blueprint(api_bp, url_prefix='/api')
+
     if not app.debug and not app.testing:
-        if app.config['MAIL_SERVER']:
-            auth = None
-            if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
-                auth = (app.config['MAIL_USERNAME'],
-                        app.config['MAIL_PASSWORD'])
-            secure = None
-            if app.config['MAIL_USE_TLS']:
-                secure = ()
-            mail_handler = SMTPHandler(
-                mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
-                fromaddr='no-reply@' + app.config['MAIL_SERVER'],
-                toaddrs=app.config['ADMINS'], subject='Microblog Failure',
-                credentials=auth, secure=secure)
-            mail_handler.setLevel(logging.ERROR)
-            app.logger.addHandler(mail_handler)
-
-        if app.config['LOG_TO_STDOUT']:
-            stream_handler = logging.StreamHandler()
-            stream_handler.setLevel(logging.INFO)
-            app.logger.addHandler(stream_handler)
-        else:
-            if not os.path.exists('logs'):
-                os.mkdir('logs')
-            file_handler = RotatingFileHandler('logs/microblog.log',
-                                               maxBytes=10240, backupCount=10)
-            file_handler.setFormatter(logging.Formatter(
-                '%(asctime)s %(levelname)s: %(message)s '
-                '[in %(pathname)s:%(lineno)d]'))
-            file_handler.setLevel(logging.INFO)
-            app.logger.addHandler(file_handler)
-
-        app.logger.setLevel(logging.INFO)
+        from app.logs import setup_logging
+        setup_logging(app)
         app.logger.info('Microblog startup')
 
     return app
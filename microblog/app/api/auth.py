@@ -0,0 +1,23 @@
+from functools import wraps
+from flask import g, request
+from app.models import User
+from app.api.errors import error_response
+
+
+def token_auth_required(f):
+    """Let requests with a valid bearer token through, and store the id
+    of its user in g.api_user_id. The token is checked without a query,
+    views load the user only if they need more than the id."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        scheme, _, token = request.headers.get('Authorization', '').partition(
+            ' ')
+        user_id = User.verify_api_token(token.strip()) \
+            if scheme.lower() == 'bearer' else None
+        if user_id is None:
+            response = error_response(401)
+            response.headers['WWW-Authenticate'] = 'Bearer'
+            return response
+        g.api_user_id = user_id
+        return f(*args, **kwargs)
+    return decorated
@@ -0,0 +1,25 @@
+from hashlib import md5
+from flask import current_app, jsonify, request
+
+
+def make_etag(*parts):
+    return md5('|'.join(str(part) for part in parts).encode(
+        'utf-8')).hexdigest()
+
+
+def conditional(etag, build):
+    """A JSON response tagged with a weak ETag.
+
+    When the client already holds etag the answer is a 304 and build,
+    which returns the body and runs the expensive queries, is not called.
+    The ETag is made from a few cheap indexed lookups that change whenever
+    the body would.
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = current_app.response_class(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag, weak=True)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
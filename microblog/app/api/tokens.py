@@ -0,0 +1,21 @@
+from flask import current_app, jsonify, request
+from app import db
+from app.models import User
+from app.api import bp
+from app.api.errors import error_response
+
+
+@bp.route('/tokens', methods=['POST'])
+def get_token():
+    auth = request.authorization
+    user = User.query.filter_by(username=auth.username).first() \
+        if auth and auth.username else None
+    if user is None or not user.check_password(auth.password or ''):
+        response = error_response(401)
+        response.headers['WWW-Authenticate'] = \
+            'Basic realm="Authentication Required"'
+        return response
+    # the password may have been rehashed
+    db.session.commit()
+    return jsonify({'token': user.get_api_token(),
+                    'expires_in': current_app.config['API_TOKEN_EXPIRATION']})
@@ -0,0 +1,194 @@
+from flask import abort, current_app, g, request, url_for
+from app import db
+from app.avatars import avatar_url
+from app.models import User, Post, Timeline, followers
+from app.pagination import InvalidCursor, decode_cursor, encode_cursor, \
+    paginate_posts
+from app.api import bp
+from app.api.auth import token_auth_required
+from app.api.etags import conditional, make_etag
+
+# the API reads plain rows of these columns instead of loading models
+USER_COLUMNS = (User.id, User.username, User.email, User.about_me,
+                User.followers_count, User.following_count,
+                User.avatar_digest)
+POST_COLUMNS = (Post.id, Post.body, Post.timestamp, Post.language,
+                Post.user_id)
+
+
+def isoformat(value):
+    return value.isoformat() + 'Z' if value else None
+
+
+def user_dict(row):
+    return {
+        'id': row.id,
+        'username': row.username,
+        'about_me': row.about_me,
+        'follower_count': row.followers_count,
+        'followed_count': row.following_count,
+        '_links': {
+            'self': url_for('api.get_user', id=row.id),
+            'posts': url_for('api.get_user_posts', id=row.id),
+            'followers': url_for('api.get_followers', id=row.id),
+            'followed': url_for('api.get_followed', id=row.id),
+            'avatar': avatar_url(row.avatar_digest, 128)
+        }
+    }
+
+
+def post_dict(row, usernames):
+    return {
+        'id': row.id,
+        'body': row.body,
+        'timestamp': isoformat(row.timestamp),
+        'language': row.language or None,
+        'author': {'id': row.user_id,
+                   'username': usernames.get(row.user_id)},
+        '_links': {
+            'author': url_for('api.get_user', id=row.user_id)
+        }
+    }
+
+
+def per_page_arg():
+    per_page = request.args.get('per_page', type=int) or \
+        current_app.config['POSTS_PER_PAGE']
+    return max(1, min(per_page, current_app.config['API_MAX_PER_PAGE']))
+
+
+def user_version(id):
+    version = db.session.query(User.version).filter(User.id == id).scalar()
+    if version is None:
+        abort(404)
+    return version
+
+
+def post_page(query, endpoint, **kwargs):
+    per_page = per_page_arg()
+    try:
+        page = paginate_posts(query, per_page,
+                              after=request.args.get('after'),
+                              before=request.args.get('before'))
+    except InvalidCursor:
+        abort(400)
+    usernames = {}
+    if page.items:
+        usernames = dict(db.session.query(User.id, User.username).filter(
+            User.id.in_({row.user_id for row in page.items})))
+    return {
+        'items': [post_dict(row, usernames) for row in page.items],
+        '_meta': {'per_page': per_page},
+        '_links': {
+            'self': url_for(endpoint, per_page=per_page,
+                            after=request.args.get('after'),
+                            before=request.args.get('before'), **kwargs),
+            'next': url_for(endpoint, per_page=per_page,
+                            after=page.next_cursor, **kwargs)
+            if page.next_cursor else None,
+            'prev': url_for(endpoint, per_page=per_page,
+                            before=page.prev_cursor, **kwargs)
+            if page.prev_cursor else None
+        }
+    }
+
+
+def user_page(query, endpoint, **kwargs):
+    per_page = per_page_arg()
+    after = request.args.get('after')
+    if after is not None:
+        try:
+            query = query.filter(User.id > int(decode_cursor(after)))
+        except (InvalidCursor, TypeError, ValueError):
+            abort(400)
+    rows = query.order_by(User.id).limit(per_page + 1).all()
+    items = rows[:per_page]
+    return {
+        'items': [user_dict(row) for row in items],
+        '_meta': {'per_page': per_page},
+        '_links': {
+            'self': url_for(endpoint, per_page=per_page, after=after,
+                            **kwargs),
+            'next': url_for(endpoint, per_page=per_page,
+                            after=encode_cursor(items[-1].id), **kwargs)
+            if len(rows) > per_page else None
+        }
+    }
+
+
+def newest(column, *criteria):
+    """The newest timestamp in column among the rows matching criteria,
+    read from the end of a (user_id, timestamp) index. Changes that do not
+    add a newer row bump the user's version instead."""
+    return db.session.query(column).filter(*criteria).order_by(
+        column.desc()).limit(1).scalar()
+
+
+def version_totals(query):
+    """The number of users in a query and the sum of their versions, which
+    changes when any of them changes."""
+    return query.with_entities(db.func.count(User.id),
+                               db.func.sum(User.version)).one()
+
+
+@bp.route('/users/<int:id>')
+@token_auth_required
+def get_user(id):
+    row = db.session.query(*USER_COLUMNS, User.version).filter(
+        User.id == id).first()
+    if row is None:
+        abort(404)
+    return conditional(make_etag('user', id, row.version),
+                       lambda: user_dict(row))
+
+
+@bp.route('/users/<int:id>/posts')
+@token_auth_required
+def get_user_posts(id):
+    version = user_version(id)
+    return conditional(
+        make_etag('posts', id, version,
+                  newest(Post.timestamp, Post.user_id == id)),
+        lambda: post_page(db.session.query(*POST_COLUMNS).filter(
+            Post.user_id == id), 'api.get_user_posts', id=id))
+
+
+@bp.route('/users/<int:id>/followers')
+@token_auth_required
+def get_followers(id):
+    version = user_version(id)
+    query = db.session.query(*USER_COLUMNS).join(
+        followers, followers.c.follower_id == User.id).filter(
+        followers.c.followed_id == id)
+    return conditional(
+        make_etag('followers', id, version, *version_totals(query)),
+        lambda: user_page(query, 'api.get_followers', id=id))
+
+
+@bp.route('/users/<int:id>/followed')
+@token_auth_required
+def get_followed(id):
+    version = user_version(id)
+    query = db.session.query(*USER_COLUMNS).join(
+        followers, followers.c.followed_id == User.id).filter(
+        followers.c.follower_id == id)
+    return conditional(
+        make_etag('followed', id, version, *version_totals(query)),
+        lambda: user_page(query, 'api.get_followed', id=id))
+
+
+@bp.route('/timeline')
+@token_auth_required
+def get_timeline():
+    id = g.api_user_id
+    version = user_version(id)
+    pushed = newest(Timeline.timestamp, Timeline.user_id == id)
+    # accounts that are not fanned out bump their version with every post
+    # instead, and there are few of them
+    pulled = version_totals(db.session.query(User.id).join(
+        followers, followers.c.followed_id == User.id).filter(
+        followers.c.follower_id == id, User.fanout_on_read))
+    return conditional(
+        make_etag('timeline', id, version, pushed, *pulled),
+        lambda: post_page(User.query.get(id).timeline_posts().with_entities(
+            *POST_COLUMNS), 'api.get_timeline'))
@@ -21,6 +21,7 @@ def login():
             flash(_('Invalid username or password'), category="warning")
             return redirect(url_for('auth.login'))
         login_user(user, remember=form.remember_me.data)
+        db.session.commit()
         next_page = request.args.get('next')
         if not next_page or url_parse(next_page).netloc != '':
             next_page = url_for('main.index')
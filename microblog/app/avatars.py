@@ -0,0 +1,78 @@
+import os
+import struct
+import tempfile
+import zlib
+from hashlib import md5
+from flask import current_app, url_for
+
+GRID = 5
+BACKGROUND = b'\xf0\xf0\xf0'
+# raised whenever identicon() draws differently, so that neither the saved
+# files nor the browsers' copies of the old images are used any more
+VERSION = 1
+
+
+def avatar_digest(email):
+    return md5(email.lower().encode('utf-8')).hexdigest()
+
+
+def png(width, height, rows):
+    """Encode rows of RGB bytes as a PNG file."""
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + \
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+    raw = b''.join(b'\x00' + row for row in rows)
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + \
+        chunk(b'IDAT', zlib.compress(raw, 9)) + chunk(b'IEND', b'')
+
+
+def identicon(digest, size):
+    """A symmetric 5x5 identicon for a hex digest, as PNG bytes."""
+    data = bytes.fromhex(digest)
+    # darker colors, so they stand out on the light background
+    color = bytes(64 + b // 2 for b in data[:3])
+    half = (GRID + 1) // 2
+    filled = [[data[(y * half + min(x, GRID - 1 - x)) % len(data)] & 1
+               for x in range(GRID)] for y in range(GRID)]
+    margin = size // 10
+    inner = max(size - 2 * margin, 1)
+    cells = [(i - margin) * GRID // inner if margin <= i < margin + inner
+             else None for i in range(size)]
+    blank = BACKGROUND * size
+    rows = []
+    for y in range(size):
+        if cells[y] is None:
+            rows.append(blank)
+            continue
+        row = filled[cells[y]]
+        rows.append(b''.join(color if x is not None and row[x] else BACKGROUND
+                             for x in cells))
+    return png(size, size, rows)
+
+
+def avatar_url(digest, size):
+    return url_for('main.avatar', version=VERSION, digest=digest, size=size)
+
+
+def avatar_path(digest, size):
+    """The file of an avatar, which may not have been saved yet.
+
+    The file name is derived from the drawing version, the digest and the
+    size, which are all the image depends on, so a name never refers to
+    different content.
+    """
+    return os.path.join(current_app.config['AVATAR_DIR'],
+                        '{}-{}-v{}.png'.format(digest, size, VERSION))
+
+
+def save_avatar(digest, size):
+    """Generate the file of an avatar and return its path."""
+    path = avatar_path(digest, size)
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as f:
+        f.write(identicon(digest, size))
+    os.replace(tmp, path)
+    return path
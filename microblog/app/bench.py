@@ -0,0 +1,245 @@
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+from itertools import accumulate
+from werkzeug.security import generate_password_hash
+from app import db
+from app.avatars import avatar_digest
+from app.models import User, Post, Timeline, followers
+
+user_table = User.__table__
+post_table = Post.__table__
+timeline_table = Timeline.__table__
+
+WORDS = ('the be to of and a in that have it for not on with he as you do at '
+         'this but his by from they we say her she or an will my one all '
+         'would there their what so up out if about who get which go me '
+         'when make can like time no just him know take people into year '
+         'your good some could them see other than then now look only come '
+         'its over think also back after use two how our work first well '
+         'way even new want because any these give day most us').split()
+
+
+def summarize(latencies):
+    """Latency percentiles and mean of a list of seconds, in milliseconds."""
+    latencies = sorted(latencies)
+    summary = {'runs': len(latencies)}
+    if not latencies:
+        return summary
+    for p in (50, 95, 99):
+        index = min(len(latencies) - 1, len(latencies) * p // 100)
+        summary['p{}_ms'.format(p)] = round(latencies[index] * 1000, 3)
+    summary['mean_ms'] = round(sum(latencies) / len(latencies) * 1000, 3)
+    return summary
+
+
+def throwaway_app(app, database, **config):
+    """A copy of an app on another database, for measurements."""
+    from app import create_app
+    config = dict(app.config, TESTING=True, WTF_CSRF_ENABLED=False,
+                  SQLALCHEMY_DATABASE_URI='sqlite:///' + database,
+                  QUERY_BUDGET=None, **config)
+    return create_app(type('BenchConfig', (object,), config))
+
+
+def power_law(n, exponent):
+    """Cumulative weights for picking ids 1..n, the lower ids far more
+    often, as with the most followed and most active accounts."""
+    return list(accumulate(1 / (rank ** exponent)
+                           for rank in range(1, n + 1)))
+
+
+def chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def seed(conn, users, posts, follows=20, exponent=1.1, days=365,
+         fanout_limit=10000, batch_size=10000, rng=None, progress=None):
+    """Fill an empty database with users, posts and a follow graph.
+
+    Rows go in with executemany inserts of batch_size, bypassing the ORM
+    and its events. Both the accounts that are followed and the ones that
+    post are picked with a power law, and the number of accounts a user
+    follows is Pareto distributed around follows. Follower counts and
+    timelines are filled in SQL afterwards, as the fan-out would have left
+    them. The search index is not updated. Returns the number of follows.
+    """
+    rng = rng or random.Random(0)
+    ids = range(1, users + 1)
+    weights = power_law(users, exponent)
+    pwhash = generate_password_hash('password')
+    now = datetime.utcnow()
+
+    def report(step, count):
+        if progress:
+            progress(step, count)
+
+    user_rows = ({'id': id, 'username': 'user{}'.format(id),
+                  'email': 'user{}@example.com'.format(id),
+                  'avatar_digest': avatar_digest(
+                      'user{}@example.com'.format(id)),
+                  'password_hash': pwhash, 'last_seen': now,
+                  'fanout_on_read': False, 'followers_count': 0,
+                  'following_count': 0, 'version': 1} for id in ids)
+    for chunk in chunks(user_rows, batch_size):
+        conn.execute(user_table.insert(), chunk)
+        report('users', chunk[-1]['id'])
+
+    def follow_rows():
+        for follower in ids:
+            wanted = min(users - 1, int(rng.paretovariate(1.5) *
+                                        follows / 3))
+            followed = set()
+            # the most popular accounts come up again and again, give up
+            # on the rest rather than draw forever
+            for _ in range(4 * wanted):
+                if len(followed) == wanted:
+                    break
+                id = rng.choices(ids, cum_weights=weights)[0]
+                if id != follower:
+                    followed.add(id)
+            for id in followed:
+                yield {'follower_id': follower, 'followed_id': id}
+
+    follow_count = 0
+    for chunk in chunks(follow_rows(), batch_size):
+        conn.execute(followers.insert(), chunk)
+        follow_count += len(chunk)
+        report('follows', follow_count)
+    conn.execute(db.text('UPDATE "user" SET '
+                         'followers_count = (SELECT count(*) FROM followers '
+                         'WHERE followers.followed_id = "user".id), '
+                         'following_count = (SELECT count(*) FROM followers '
+                         'WHERE followers.follower_id = "user".id)'))
+    conn.execute(user_table.update().where(
+        user_table.c.followers_count > fanout_limit).values(
+        fanout_on_read=True))
+
+    # how much users post is not tied to how popular they are
+    authors = list(ids)
+    rng.shuffle(authors)
+    seconds = days * 24 * 3600
+    post_rows = ({'body': ' '.join(rng.choices(WORDS, k=rng.randint(
+                      3, 20)))[:140],
+                  'timestamp': now - timedelta(seconds=rng.random() * seconds),
+                  'user_id': rng.choices(authors, cum_weights=weights)[0],
+                  'language': 'en'} for _ in range(posts))
+    count = 0
+    for chunk in chunks(post_rows, batch_size):
+        conn.execute(post_table.insert(), chunk)
+        count += len(chunk)
+        report('posts', count)
+
+    # every post in its author's timeline and in those of the followers,
+    # except for the accounts that are read at read time
+    fanned_out = db.select([user_table.c.id]).where(
+        db.not_(user_table.c.fanout_on_read))
+    conn.execute(timeline_table.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([post_table.c.user_id, post_table.c.id,
+                   post_table.c.timestamp])))
+    conn.execute(timeline_table.insert().from_select(
+        ['user_id', 'post_id', 'timestamp'],
+        db.select([followers.c.follower_id, post_table.c.id,
+                   post_table.c.timestamp]).select_from(post_table.join(
+            followers, followers.c.followed_id == post_table.c.user_id)).where(
+            post_table.c.user_id.in_(fanned_out)).order_by(
+            followers.c.follower_id)))
+    report('timelines', posts)
+    return follow_count
+
+
+def run(app, users, posts, follows=20, repeat=20, rng=None, progress=None):
+    """Seed a throwaway database and time the main operations on it.
+
+    Returns a dict of results, with latency summaries per operation.
+    """
+    from app.indexer import reindex
+    rng = rng or random.Random(0)
+    directory = tempfile.mkdtemp()
+    database = os.path.join(directory, 'bench.db')
+    bench_app = throwaway_app(
+        app, database, SEARCH_BACKEND='sqlite',
+        SEARCH_SQLITE_PATH=os.path.join(directory, 'search.db'),
+        TIMELINE_ASYNC=False, LANGUAGE_ASYNC=False, SEARCH_QUEUE_ASYNC=False)
+    result = {'users': users, 'posts': posts}
+    try:
+        with bench_app.app_context():
+            db.create_all()
+            started = time.perf_counter()
+            with db.engine.begin() as conn:
+                result['follows'] = seed(
+                    conn, users, posts, follows=follows, rng=rng,
+                    fanout_limit=bench_app.config['TIMELINE_FANOUT_LIMIT'],
+                    progress=progress)
+            result['seed_seconds'] = round(time.perf_counter() - started, 3)
+            started = time.perf_counter()
+            reindex(bench_app, Post, workers=1)
+            result['index_seconds'] = round(time.perf_counter() - started, 3)
+        result['operations'] = measure(bench_app, users, repeat, rng)
+    finally:
+        bench_app.extensions['last_seen'].stop()
+        bench_app.extensions['passwords'].shutdown()
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+    return result
+
+
+def measure(app, users, repeat, rng):
+    weights = power_law(users, 1.1)
+    ids = range(1, users + 1)
+    per_page = app.config['POSTS_PER_PAGE']
+    client = app.test_client()
+    timings = {name: [] for name in ('followed_posts', 'index', 'explore',
+                                     'user', 'follow', 'unfollow', 'search')}
+
+    def timed(name, func, *args, **kwargs):
+        started = time.perf_counter()
+        rv = func(*args, **kwargs)
+        timings[name].append(time.perf_counter() - started)
+        return rv
+
+    def get(url):
+        rv = client.get(url)
+        if rv.status_code != 200:
+            raise RuntimeError('{} answered {}'.format(url, rv.status_code))
+        return rv
+
+    def followed_posts(user_id):
+        with app.app_context():
+            User.query.get(user_id).followed_posts().limit(per_page).all()
+
+    def following(user_id, followed_id):
+        with app.app_context():
+            return db.session.query(db.exists().where(
+                followers.c.follower_id == user_id).where(
+                followers.c.followed_id == followed_id)).scalar()
+
+    # no application context is kept between the operations, so each
+    # starts with a new session, as a request in production would
+    for _ in range(repeat):
+        user_id = rng.choice(ids)
+        popular = rng.choices(ids, cum_weights=weights)[0]
+        timed('followed_posts', followed_posts, user_id)
+        with client.session_transaction() as session:
+            session['_user_id'] = str(user_id)
+        timed('index', get, '/index')
+        timed('explore', get, '/explore')
+        timed('user', get, '/user/user{}'.format(popular))
+        timed('search', get, '/search?q=' + rng.choice(WORDS))
+        if popular != user_id and not following(user_id, popular):
+            timed('follow', client.post, '/follow/user{}'.format(popular))
+            timed('unfollow', client.post,
+                  '/unfollow/user{}'.format(popular))
+    return {name: summarize(latencies)
+            for name, latencies in timings.items()}
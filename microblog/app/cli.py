@@ -1,5 +1,14 @@
+import json
 import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import click
+from app.indexer import reindex, searchable_tables
 
 
 def register(app):
@@ -33,3 +42,262 @@ def register(app):
         """Compile all languages."""
         if os.system('pybabel compile -d app/translations'):
             raise RuntimeError('compile command failed')
+
+    @app.cli.group()
+    def search():
+        """Search index commands."""
+        pass
+
+    @search.command('reindex')
+    @click.argument('index', required=False)
+    @click.option('--chunk-size', default=1000, show_default=True,
+                  help='Documents per bulk request.')
+    @click.option('--workers', default=4, show_default=True,
+                  help='Bulk requests sent in parallel.')
+    @click.option('--fresh', is_flag=True,
+                  help='Build a new index and swap it in when complete.')
+    @click.option('--restart', is_flag=True,
+                  help='Ignore the checkpoint of an interrupted run.')
+    def reindex_command(index, chunk_size, workers, fresh, restart):
+        """Rebuild the search index of one or all searchable models.
+
+        An interrupted run resumes from its checkpoint file
+        (reindex-<index>.json in the current directory). Objects changed
+        while a --fresh index is being built, other than new ones, may
+        need another run without --fresh."""
+        if app.search is None:
+            raise click.ClickException('No search backend is configured.')
+        tables = searchable_tables()
+        if index and index not in tables:
+            raise click.BadParameter('not a searchable index: ' + index)
+        for name in [index] if index else sorted(tables):
+            checkpoint = 'reindex-{}.json'.format(name)
+            if restart and os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            last = [0]
+
+            def progress(sent, rate):
+                if sent - last[0] >= 10 * chunk_size:
+                    last[0] = sent
+                    click.echo('{}: {} documents, {:.0f} docs/sec'.format(
+                        name, sent, rate))
+
+            started = time.monotonic()
+            sent = reindex(app, tables[name], chunk_size=chunk_size,
+                           workers=workers, fresh=fresh,
+                           checkpoint=checkpoint, progress=progress)
+            elapsed = max(time.monotonic() - started, 1e-6)
+            click.echo('{}: {} documents in {:.1f}s, {:.0f} docs/sec'.format(
+                name, sent, elapsed, sent / elapsed))
+
+    @search.command('status')
+    def status_command():
+        """Show the search queue backlog and lag."""
+        metrics = app.extensions['search_queue'].metrics()
+        click.echo('pending: {}'.format(metrics['pending']))
+        click.echo('dead: {}'.format(metrics['dead']))
+        click.echo('lag: {:.1f}s'.format(metrics['lag']))
+
+    @app.cli.group()
+    def bench():
+        """Performance measurement commands."""
+        pass
+
+    @bench.command()
+    @click.option('--budget', type=float,
+                  help='Seconds allowed for a cold start '
+                       '(default STARTUP_TIME_BUDGET).')
+    @click.option('--top', default=15, show_default=True,
+                  help='How many of the slowest imports to list.')
+    def importtime(budget, top):
+        """Time a cold start of the application.
+
+        Imports the app package and calls create_app() in a fresh
+        interpreter under python -X importtime, lists the slowest imports
+        and fails when the start took longer than the budget."""
+        if budget is None:
+            budget = app.config['STARTUP_TIME_BUDGET']
+        code = ('import time\n'
+                'started = time.perf_counter()\n'
+                'from app import create_app\n'
+                'create_app()\n'
+                'print(time.perf_counter() - started)\n')
+        env = dict(os.environ, LOG_TO_STDOUT='1')
+        result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', code],
+            cwd=os.path.dirname(app.root_path), env=env,
+            capture_output=True, text=True)
+        if result.returncode:
+            raise click.ClickException('the app failed to start:\n' +
+                                       result.stderr)
+        imports = []
+        for line in result.stderr.splitlines():
+            if not line.startswith('import time:'):
+                continue
+            fields = line[len('import time:'):].split('|')
+            if fields[0].strip().isdigit():
+                imports.append((int(fields[1]), fields[2].strip()))
+        for cumulative, name in sorted(imports, reverse=True)[:top]:
+            click.echo('{:8.1f} ms  {}'.format(cumulative / 1000, name))
+        elapsed = float(result.stdout.split()[-1])
+        click.echo('cold start: {:.3f}s (budget {:.3f}s)'.format(elapsed,
+                                                                budget))
+        if elapsed > budget:
+            raise click.ClickException('cold start is over budget')
+
+    @bench.command()
+    @click.option('--users', default=20, show_default=True,
+                  help='Accounts to log in to.')
+    @click.option('--requests', 'count', default=200, show_default=True,
+                  help='Logins in total.')
+    @click.option('--concurrency', default=8, show_default=True,
+                  help='Logins in flight at the same time.')
+    @click.option('--inline', is_flag=True,
+                  help='Hash on the request threads instead of in the '
+                       'worker processes, for comparison.')
+    def login(users, count, concurrency, inline):
+        """Measure login latency under concurrent load.
+
+        Runs a copy of the app against a throwaway database, with
+        accounts whose passwords are hashed with PASSWORD_METHOD, and
+        reports latency percentiles and throughput."""
+        from app import db
+        from app.bench import summarize, throwaway_app
+        from app.models import User
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        bench_app = throwaway_app(app, path, SEARCH_BACKEND='none',
+                                  PASSWORD_ASYNC=not inline)
+        try:
+            with bench_app.app_context():
+                db.create_all()
+                pwhash = bench_app.extensions['passwords'].hash('secret')
+                db.session.add_all([User(username='bench{}'.format(i),
+                                         email='bench{}@example.com'.format(i),
+                                         password_hash=pwhash)
+                                    for i in range(users)])
+                db.session.commit()
+            latencies = []
+            failures = [0]
+            lock = threading.Lock()
+
+            def worker(n):
+                # without cookies every request is a fresh sign in
+                client = bench_app.test_client(use_cookies=False)
+                for i in range(n, count, concurrency):
+                    started = time.perf_counter()
+                    rv = client.post('/auth/login', data={
+                        'username': 'bench{}'.format(i % users),
+                        'password': 'secret'})
+                    elapsed = time.perf_counter() - started
+                    with lock:
+                        latencies.append(elapsed)
+                        if rv.status_code != 302 or \
+                                '/auth/login' in rv.location:
+                            failures[0] += 1
+
+            threads = [threading.Thread(target=worker, args=(n,))
+                       for n in range(concurrency)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.perf_counter() - started
+        finally:
+            bench_app.extensions['passwords'].shutdown()
+            os.remove(path)
+        click.echo('{} logins, {} concurrent, {} ({})'.format(
+            count, concurrency, bench_app.config['PASSWORD_METHOD'],
+            'inline' if inline else '{} worker processes'.format(
+                bench_app.config['PASSWORD_WORKERS'])))
+        summary = summarize(latencies)
+        for p in (50, 95, 99):
+            click.echo('p{}: {:.1f} ms'.format(p, summary['p{}_ms'.format(p)]))
+        click.echo('{:.1f} logins/sec, {} failed'.format(count / elapsed,
+                                                          failures[0]))
+
+    def echo_progress():
+        last = {}
+
+        def progress(step, count):
+            # at most once a second for each step
+            now = time.monotonic()
+            if now - last.get(step, 0) >= 1:
+                last[step] = now
+                click.echo('{}: {}'.format(step, count), err=True)
+        return progress
+
+    @bench.command()
+    @click.option('--users', default=100000, show_default=True,
+                  help='Accounts to create.')
+    @click.option('--posts', default=1000000, show_default=True,
+                  help='Posts to create.')
+    @click.option('--follows', default=20, show_default=True,
+                  help='Accounts followed by a user, on average.')
+    @click.option('--exponent', default=1.1, show_default=True,
+                  help='Power law exponent of how popular accounts are.')
+    @click.option('--batch-size', default=10000, show_default=True,
+                  help='Rows per insert.')
+    @click.option('--seed', 'random_seed', default=0, show_default=True,
+                  help='Seed of the random generator.')
+    def seed(users, posts, follows, exponent, batch_size, random_seed):
+        """Fill an empty database with synthetic data.
+
+        Creates users, a power law follow graph, posts and their timelines
+        with bulk inserts. The search index is not updated, run flask
+        search reindex afterwards."""
+        from app import db
+        from app.bench import seed as seed_database
+        from app.models import User
+        if db.session.query(User.id).first() is not None:
+            raise click.ClickException('the database is not empty')
+        started = time.monotonic()
+        with db.engine.begin() as conn:
+            follow_count = seed_database(
+                conn, users, posts, follows=follows, exponent=exponent,
+                fanout_limit=app.config['TIMELINE_FANOUT_LIMIT'],
+                batch_size=batch_size, rng=random.Random(random_seed),
+                progress=echo_progress())
+        click.echo('{} users, {} follows and {} posts in {:.1f}s'.format(
+            users, follow_count, posts, time.monotonic() - started))
+
+    @bench.command('run')
+    @click.option('--scales', default='1000:10000,10000:100000',
+                  show_default=True,
+                  help='Comma separated USERS:POSTS sizes to measure.')
+    @click.option('--follows', default=20, show_default=True,
+                  help='Accounts followed by a user, on average.')
+    @click.option('--repeat', default=20, show_default=True,
+                  help='Times each operation is timed at each scale.')
+    @click.option('--seed', 'random_seed', default=0, show_default=True,
+                  help='Seed of the random generator.')
+    @click.option('--output', type=click.File('w'), default='-',
+                  help='File for the JSON results (default stdout).')
+    def run_command(scales, follows, repeat, random_seed, output):
+        """Time the main operations at several scales.
+
+        Every scale is seeded into a throwaway SQLite database and search
+        index. The timeline queries, the explore, user and search pages
+        and follow/unfollow are then timed, and the latencies written out
+        as JSON."""
+        from app.bench import run
+        sizes = []
+        for scale in scales.split(','):
+            try:
+                users, posts = (int(n) for n in scale.split(':'))
+            except ValueError:
+                raise click.BadParameter('not USERS:POSTS: ' + scale,
+                                         param_hint='--scales')
+            sizes.append((users, posts))
+        results = []
+        for users, posts in sizes:
+            click.echo('{} users, {} posts'.format(users, posts), err=True)
+            results.append(run(app, users, posts, follows=follows,
+                               repeat=repeat, rng=random.Random(random_seed),
+                               progress=echo_progress()))
+        json.dump({'python': platform.python_version(),
+                   'database': 'sqlite', 'follows': follows,
+                   'repeat': repeat, 'seed': random_seed,
+                   'results': results}, output, indent=2)
+        output.write('\n')
@@ -1,17 +1,143 @@
-from threading import Thread
+import atexit
+import queue
+import smtplib
+import threading
 from flask import current_app
 from flask_mail import Message
 from app import mail
 
+# put in the queue once per worker to make it exit
+STOP = object()
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+
+class MailDispatcher(object):
+    """Sends mail from a fixed pool of worker threads.
+
+    Every worker keeps its SMTP connection open between messages and only
+    closes it after MAIL_IDLE_TIMEOUT seconds without mail, reconnecting
+    once if the server has dropped it. The queue holds at most
+    MAIL_QUEUE_SIZE messages; when it is full send_email() waits up to
+    MAIL_QUEUE_TIMEOUT seconds for room and then gives up on the message.
+    At shutdown the workers finish the messages already queued.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = None
+        self.threads = []
+        self.lock = threading.Lock()
+        self.sent = self.failed = self.rejected = self.connections = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['MAIL_QUEUE_SIZE'])
+        app.extensions['mail_dispatcher'] = self
+        atexit.register(self.shutdown)
+
+    def submit(self, msg):
+        with self.lock:
+            # start the workers, or replace any that have died
+            self.threads = [t for t in self.threads if t.is_alive()]
+            for i in range(len(self.threads),
+                           self.app.config['MAIL_WORKERS']):
+                thread = threading.Thread(target=self.worker,
+                                          name='mail-{}'.format(i),
+                                          daemon=True)
+                thread.start()
+                self.threads.append(thread)
+        try:
+            self.queue.put(msg, timeout=self.app.config['MAIL_QUEUE_TIMEOUT'])
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            self.app.logger.error('Mail queue is full, dropped "%s" to %s',
+                                  msg.subject, ', '.join(msg.recipients))
+            return False
+        return True
+
+    def worker(self):
+        conn = None
+        with self.app.app_context():
+            while True:
+                try:
+                    msg = self.queue.get(
+                        timeout=self.app.config['MAIL_IDLE_TIMEOUT']
+                        if conn else None)
+                except queue.Empty:
+                    conn = self.close(conn)
+                    continue
+                try:
+                    if msg is STOP:
+                        self.close(conn)
+                        return
+                    conn = self.deliver(conn, msg)
+                finally:
+                    self.queue.task_done()
+
+    def deliver(self, conn, msg):
+        for attempt in range(2):
+            try:
+                if conn is None:
+                    conn = mail.connect()
+                    conn.__enter__()
+                    with self.lock:
+                        self.connections += 1
+                conn.send(msg)
+                with self.lock:
+                    self.sent += 1
+                return conn
+            except (smtplib.SMTPException, OSError):
+                conn = self.close(conn)
+                if attempt:
+                    with self.lock:
+                        self.failed += 1
+                    self.app.logger.exception('Could not send "%s" to %s',
+                                              msg.subject,
+                                              ', '.join(msg.recipients))
+            except Exception:
+                # a bad message, not a bad connection: retrying won't help,
+                # but the worker must survive it
+                conn = self.close(conn)
+                with self.lock:
+                    self.failed += 1
+                self.app.logger.exception('Could not send "%s" to %s',
+                                          msg.subject,
+                                          ', '.join(msg.recipients))
+                return conn
+
+    def close(self, conn):
+        if conn is not None:
+            try:
+                conn.__exit__(None, None, None)
+            except Exception:
+                pass
+        return None
+
+    def shutdown(self, timeout=None):
+        """Stop the workers once the queued messages are sent."""
+        if timeout is None:
+            timeout = self.app.config['MAIL_DRAIN_TIMEOUT']
+        with self.lock:
+            threads, self.threads = self.threads, []
+        for thread in threads:
+            try:
+                self.queue.put(STOP, timeout=timeout)
+            except queue.Full:
+                break
+        for thread in threads:
+            thread.join(timeout)
+
+    def metrics(self):
+        with self.lock:
+            return {'queued': self.queue.qsize(), 'sent': self.sent,
+                    'failed': self.failed, 'rejected': self.rejected,
+                    'connections': self.connections}
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    Thread(target=send_async_email,
-           args=(current_app._get_current_object(), msg)).start()
+    return current_app.extensions['mail_dispatcher'].submit(msg)
@@ -0,0 +1,74 @@
+import queue
+import threading
+
+
+class Subscription(object):
+    """The messages of a set of channels, for one listener."""
+
+    def __init__(self, broker, channels, size):
+        self.broker = broker
+        self.channels = channels
+        self.queue = queue.Queue(size)
+
+    def put(self, message):
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # a listener that does not keep up loses messages; a stream
+            # only needs one to know there is something new
+            pass
+
+    def get(self, timeout=None):
+        """The next message, or None when none came within timeout."""
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class LocalBroker(object):
+    """Publishes messages to the subscribers in this process.
+
+    Messages are strings. A broker shared between processes, such as Redis
+    pub/sub, can take its place by providing subscribe(), unsubscribe()
+    and publish() with the same meaning.
+    """
+
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.subscribers = {}
+        self.lock = threading.Lock()
+
+    def subscribe(self, channels):
+        subscription = Subscription(self, list(channels), self.queue_size)
+        with self.lock:
+            for channel in subscription.channels:
+                self.subscribers.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            for channel in subscription.channels:
+                subscribers = self.subscribers.get(channel)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self.subscribers[channel]
+
+    def publish(self, channel, message):
+        with self.lock:
+            subscribers = list(self.subscribers.get(channel, ()))
+        for subscription in subscribers:
+            subscription.put(message)
+        return len(subscribers)
+
+
+def make_broker(app):
+    """The event broker named by EVENT_BROKER."""
+    broker = app.config['EVENT_BROKER']
+    if broker == 'local':
+        return LocalBroker(app.config['EVENT_QUEUE_SIZE'])
+    raise ValueError('Unknown event broker: {}'.format(broker))
@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+from flask import g, render_template
+from markupsafe import Markup
+
+
+class FragmentCache(object):
+    """Keeps the rendered HTML of posts, so that a page of posts is mostly
+    put together from strings rendered for earlier pages.
+
+    A post's HTML depends on the locale, on its language, which is set after
+    it is saved, and on the author's username and avatar, which are covered
+    by the author's version, so a changed author is rendered again under a
+    new key. The least recently used fragments are dropped once they add up
+    to more than FRAGMENT_CACHE_BYTES.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['fragments'] = self
+        app.jinja_env.globals['render_post'] = self.render_post
+
+    def get(self, key):
+        with self.lock:
+            html = self.cache.get(key)
+            if html is not None:
+                self.cache.move_to_end(key)
+                self.hits += 1
+            else:
+                self.misses += 1
+            return html
+
+    def put(self, key, html):
+        with self.lock:
+            old = self.cache.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            self.cache[key] = html
+            self.size += len(html)
+            while self.size > self.app.config['FRAGMENT_CACHE_BYTES']:
+                self.size -= len(self.cache.popitem(last=False)[1])
+
+    def render_post(self, post):
+        key = (post.id, g.locale, post.author.id, post.author.version,
+               post.language)
+        html = self.get(key)
+        if html is not None:
+            return html
+        html = Markup(render_template('_post.html', post=post))
+        self.put(key, html)
+        return html
@@ -0,0 +1,95 @@
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+from app import db
+from app.models import User, followers
+
+
+class FollowGraph(object):
+    """Answers "does A follow B" from an LRU cache of followed-id sets.
+
+    On a miss the answer comes from an EXISTS query, and the user's full set
+    is loaded for next time when it is small enough to be worth keeping.
+    Entries expire after FOLLOW_CACHE_TTL seconds, so changes made by other
+    processes are picked up, and are dropped locally as soon as this process
+    commits a follow or unfollow.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['graph'] = self
+
+    def get(self, user_id):
+        with self.lock:
+            entry = self.cache.get(user_id)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.cache[user_id]
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.cache.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, ids):
+        with self.lock:
+            self.cache[user_id] = (
+                time.monotonic() + self.app.config['FOLLOW_CACHE_TTL'],
+                frozenset(ids))
+            self.cache.move_to_end(user_id)
+            while len(self.cache) > self.app.config['FOLLOW_CACHE_SIZE']:
+                self.cache.popitem(last=False)
+
+    def invalidate(self, user_ids):
+        with self.lock:
+            for user_id in user_ids:
+                self.cache.pop(user_id, None)
+
+    def is_following(self, follower_id, followed_id):
+        ids = self.get(follower_id)
+        if ids is not None:
+            return followed_id in ids
+        found = exists(follower_id, followed_id)
+        count = db.session.query(User.following_count).filter(
+            User.id == follower_id).scalar() or 0
+        if count <= self.app.config['FOLLOW_CACHE_MAX_SET']:
+            self.put(follower_id, followed_ids(follower_id))
+        return found
+
+
+def exists(follower_id, followed_id):
+    return db.session.query(db.exists().where(
+        followers.c.follower_id == follower_id).where(
+        followers.c.followed_id == followed_id)).scalar()
+
+
+def followed_ids(user_id):
+    return [r[0] for r in db.session.query(followers.c.followed_id).filter(
+        followers.c.follower_id == user_id)]
+
+
+def invalidate(session):
+    changed = session.info.pop('graph_changed', None)
+    if changed:
+        graph = current_app.extensions.get('graph')
+        if graph is not None:
+            graph.invalidate(changed)
+
+
+def discard(session, previous_transaction):
+    # a rolled back change may already have been cached inside the transaction
+    invalidate(session)
+
+
+db.event.listen(db.session, 'after_commit', invalidate)
+db.event.listen(db.session, 'after_soft_rollback', discard)
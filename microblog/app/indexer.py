@@ -0,0 +1,286 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from app import db
+from app.models import SearchableMixin, SearchQueue
+from app.search import bulk_index
+
+queue_table = SearchQueue.__table__
+
+
+def searchable_tables():
+    return {mapper.class_.__tablename__: mapper.class_
+            for mapper in db.Model.registry.mappers
+            if issubclass(mapper.class_, SearchableMixin)}
+
+
+class SearchIndexer(object):
+    """Sends the changes recorded in the search_queue table to the search
+    backend in bulk requests.
+
+    Several changes to the same object are sent as one, with the latest
+    operation winning. The documents a bulk request failed on, or all of
+    them when the request itself failed, are sent again with exponential
+    backoff; the rows of the others are deleted. A row that still fails
+    counts an attempt, and after SEARCH_QUEUE_MAX_ATTEMPTS failed rounds it
+    is left in the table and skipped, so one bad document cannot stall the
+    queue.
+    The worker thread starts with the first queued commit, wakes up on
+    every commit after that and otherwise polls every SEARCH_QUEUE_INTERVAL
+    seconds. With SEARCH_QUEUE_ASYNC disabled nothing runs on its own and
+    process() has to be called directly.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.indexed = self.removed = self.failures = 0
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['search_queue'] = self
+        atexit.register(self.stop)
+
+    def wake(self):
+        if not self.app.config['SEARCH_QUEUE_ASYNC']:
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run,
+                                               name='search-indexer',
+                                               daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def process(self):
+        """Send one batch of queued changes, return how many rows it had."""
+        config = self.app.config
+        engine = db.get_engine(self.app)
+        with engine.connect() as conn:
+            rows = conn.execute(db.select([queue_table]).where(
+                queue_table.c.attempts < config['SEARCH_QUEUE_MAX_ATTEMPTS'])
+                .order_by(queue_table.c.id)
+                .limit(config['SEARCH_QUEUE_BATCH_SIZE'])).fetchall()
+            if not rows:
+                return 0
+            latest = {}
+            for row in rows:
+                latest[(row.index_name, row.object_id)] = row.op
+            batches = self.build(conn, latest)
+        delay = config['SEARCH_QUEUE_BACKOFF']
+        pending = batches
+        for attempt in range(config['SEARCH_QUEUE_RETRIES'] + 1):
+            error = None
+            failed = {}
+            try:
+                for index, (payloads, removed) in pending.items():
+                    for object_id, reason in bulk_index(
+                            index, payloads, removed).items():
+                        failed[(index, object_id)] = reason
+            except Exception as exc:
+                # the whole request is in doubt, send all of it again
+                error = exc
+                failed = {(index, object_id): exc
+                          for index, (payloads, removed) in pending.items()
+                          for object_id in list(payloads) + removed}
+            if not failed or attempt == config['SEARCH_QUEUE_RETRIES']:
+                break
+            time.sleep(delay)
+            delay *= 2
+            pending = self.subset(pending, failed)
+
+        # the rows of the documents that went through are done, only the
+        # ones that failed count an attempt
+        done = [row.id for row in rows
+                if (row.index_name, row.object_id) not in failed]
+        retry = [row.id for row in rows
+                 if (row.index_name, row.object_id) in failed]
+        with engine.begin() as conn:
+            if done:
+                conn.execute(queue_table.delete().where(
+                    queue_table.c.id.in_(done)))
+            if retry:
+                conn.execute(queue_table.update().where(
+                    queue_table.c.id.in_(retry)).values(
+                    attempts=queue_table.c.attempts + 1))
+        for index, (payloads, removed) in batches.items():
+            self.indexed += sum((index, id) not in failed for id in payloads)
+            self.removed += sum((index, id) not in failed for id in removed)
+        if failed:
+            self.failures += 1
+            if error is not None:
+                raise error
+            self.app.logger.warning(
+                'Search indexing failed for %d documents, first: %s',
+                len(failed), next(iter(failed.values())))
+        return len(rows)
+
+    @staticmethod
+    def subset(batches, failed):
+        """The part of batches for the (index, id) keys in failed."""
+        subset = {}
+        for index, (payloads, removed) in batches.items():
+            payloads = {id: payload for id, payload in payloads.items()
+                        if (index, id) in failed}
+            removed = [id for id in removed if (index, id) in failed]
+            if payloads or removed:
+                subset[index] = (payloads, removed)
+        return subset
+
+    def build(self, conn, latest):
+        """Group the latest operations by index into payloads and deletes."""
+        tables = searchable_tables()
+        batches = {}
+        for (index, object_id), op in latest.items():
+            payloads, removed = batches.setdefault(index, ({}, []))
+            if op == 'delete' or index not in tables:
+                removed.append(object_id)
+            else:
+                payloads[object_id] = None
+        for index, (payloads, removed) in batches.items():
+            if not payloads:
+                continue
+            model = tables[index]
+            table = model.__table__
+            columns = [table.c[field] for field in model.__searchable__]
+            found = {row[0]: dict(zip(model.__searchable__, row[1:]))
+                     for row in conn.execute(
+                         db.select([table.c.id] + columns).where(
+                             table.c.id.in_(list(payloads))))}
+            for object_id in list(payloads):
+                if object_id in found:
+                    payloads[object_id] = found[object_id]
+                else:
+                    # deleted again before the worker got to it
+                    del payloads[object_id]
+                    removed.append(object_id)
+        return batches
+
+    def lag(self):
+        """Seconds the oldest pending change has been waiting."""
+        with db.get_engine(self.app).connect() as conn:
+            oldest = conn.execute(db.select([queue_table.c.created_at]).where(
+                queue_table.c.attempts <
+                self.app.config['SEARCH_QUEUE_MAX_ATTEMPTS']).order_by(
+                queue_table.c.id).limit(1)).scalar()
+        if oldest is None:
+            return 0.0
+        return max((datetime.utcnow() - oldest).total_seconds(), 0.0)
+
+    def metrics(self):
+        max_attempts = self.app.config['SEARCH_QUEUE_MAX_ATTEMPTS']
+        with db.get_engine(self.app).connect() as conn:
+            pending = conn.execute(db.select([db.func.count()]).select_from(
+                queue_table).where(
+                queue_table.c.attempts < max_attempts)).scalar()
+            dead = conn.execute(db.select([db.func.count()]).select_from(
+                queue_table).where(
+                queue_table.c.attempts >= max_attempts)).scalar()
+        return {'pending': pending, 'dead': dead, 'lag': self.lag(),
+                'indexed': self.indexed, 'removed': self.removed,
+                'failures': self.failures}
+
+    def run(self):
+        batch_size = self.app.config['SEARCH_QUEUE_BATCH_SIZE']
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    handled = self.process()
+                except Exception:
+                    self.app.logger.exception('Search indexing failed')
+                    handled = 0
+            if handled < batch_size:
+                self.wakeup.wait(self.app.config['SEARCH_QUEUE_INTERVAL'])
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def reindex(app, model, chunk_size=1000, workers=4, fresh=False,
+            checkpoint=None, progress=None):
+    """Send every object of a searchable model to the search backend.
+
+    Ids are read in keyset chunks and every chunk goes out as one bulk
+    request from a pool of workers, with at most twice as many chunks in
+    flight as there are workers. The highest id below which all chunks are
+    done is saved to the checkpoint file, so an interrupted run resumes from
+    there. With fresh the documents go to a new index that replaces the old
+    one once it is complete, after a last pass over the posts added in the
+    meantime. Returns the number of documents sent.
+    """
+    index = model.__tablename__
+    table = model.__table__
+    columns = [table.c.id] + [table.c[f] for f in model.__searchable__]
+    state = {}
+    if checkpoint and os.path.exists(checkpoint):
+        with open(checkpoint) as f:
+            state = json.load(f)
+        if state.get('index') != index or state.get('fresh') != fresh:
+            state = {}
+    if not state:
+        state = {'index': index, 'fresh': fresh, 'last_id': 0, 'sent': 0,
+                 'target': app.search.create_index(index) if fresh else index}
+
+    def save():
+        if checkpoint:
+            with open(checkpoint + '.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(checkpoint + '.tmp', checkpoint)
+
+    def copy(target, last_id):
+        started = time.monotonic()
+        sent = 0
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=workers) as pool, \
+                db.get_engine(app).connect() as conn:
+            while True:
+                rows = conn.execute(db.select(columns).where(
+                    table.c.id > last_id).order_by(table.c.id).limit(
+                    chunk_size)).fetchall()
+                if rows:
+                    last_id = rows[-1][0]
+                    payloads = {row[0]: dict(zip(model.__searchable__, row[1:]))
+                                for row in rows}
+                    pending.append((pool.submit(app.search.bulk, target,
+                                                payloads, []),
+                                    last_id, len(rows)))
+                # record the chunks that are done, oldest first, and wait
+                # for the oldest while too many are in flight
+                while pending and (pending[0][0].done() or not rows or
+                                   len(pending) >= 2 * workers):
+                    future, chunk_last_id, count = pending.popleft()
+                    failed = future.result()
+                    if failed:
+                        raise RuntimeError(
+                            'bulk indexing failed for {} documents: {}'.format(
+                                len(failed), next(iter(failed.values()))))
+                    sent += count
+                    if target == state['target']:
+                        state['last_id'] = chunk_last_id
+                        state['sent'] += count
+                        save()
+                    if progress:
+                        progress(sent, sent / max(time.monotonic() - started,
+                                                  1e-6))
+                if not rows:
+                    return sent, last_id
+
+    sent, last_id = copy(state['target'], state['last_id'])
+    if fresh:
+        app.search.swap(index, state['target'])
+        sent += copy(index, last_id)[0]
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+    return sent
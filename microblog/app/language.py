@@ -0,0 +1,112 @@
+import queue
+import threading
+from functools import lru_cache
+from flask import current_app
+from app import db
+from app.models import Post, bump_post_versions
+
+post_table = Post.__table__
+
+
+@lru_cache(maxsize=4096)
+def detect_language(text, min_length=0):
+    """The language code of a text, or '' when it cannot be told."""
+    # too short to tell reliably, and not worth the detector's time
+    if len(text.strip()) < min_length or not any(c.isalpha() for c in text):
+        return ''
+    from langdetect import LangDetectException, detect
+    try:
+        return detect(text)
+    except LangDetectException:
+        return ''
+
+
+class LanguageDetector(object):
+    """Sets the language of new posts after they are committed, on a
+    background thread, or inline when LANGUAGE_ASYNC is disabled.
+
+    langdetect is imported and its language profiles are loaded with the
+    first posts, on the worker thread, away from any request. With LANGUAGE_PRELOAD
+    they are loaded when the app is created instead, so that a preloading
+    server loads them once before the workers fork. The detector is seeded
+    with LANGDETECT_SEED, so the same text always gets the same language.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['language'] = self
+        if app.config['LANGUAGE_PRELOAD']:
+            self.load()
+
+    def load(self):
+        from langdetect import DetectorFactory
+        from langdetect.detector_factory import init_factory
+        DetectorFactory.seed = self.app.config['LANGDETECT_SEED']
+        init_factory()
+
+    def submit(self, posts):
+        if not self.app.config['LANGUAGE_ASYNC']:
+            self.run(posts)
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker,
+                                               name='language', daemon=True)
+                self.thread.start()
+        self.queue.put(posts)
+
+    def run(self, posts):
+        self.load()
+        min_length = self.app.config['LANGUAGE_MIN_LENGTH']
+        rows = [{'post_id': post_id,
+                 'language': detect_language(body, min_length)}
+                for post_id, body in posts]
+        stmt = post_table.update().where(
+            post_table.c.id == db.bindparam('post_id')).values(
+            language=db.bindparam('language'))
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(stmt, rows)
+            bump_post_versions(conn, [post_id for post_id, body in posts])
+
+    def worker(self):
+        while True:
+            posts = self.queue.get()
+            while True:
+                try:
+                    posts = posts + self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.run(posts)
+            except Exception:
+                self.app.logger.exception('Language detection failed')
+
+
+def collect(session, flush_context):
+    for obj in session.new:
+        if isinstance(obj, Post) and obj.language is None:
+            session.info.setdefault('language_posts', []).append(
+                (obj.id, obj.body or ''))
+
+
+def dispatch(session):
+    posts = session.info.pop('language_posts', None)
+    if posts and 'language' in current_app.extensions:
+        current_app.extensions['language'].submit(posts)
+
+
+def discard(session, previous_transaction):
+    session.info.pop('language_posts', None)
+
+
+db.event.listen(db.session, 'after_flush', collect)
+db.event.listen(db.session, 'after_commit', dispatch)
+db.event.listen(db.session, 'after_soft_rollback', discard)
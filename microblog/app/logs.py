@@ -0,0 +1,171 @@
+import atexit
+import copy
+import json
+import logging
+import os
+import queue
+import smtplib
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from email.message import EmailMessage
+from logging.handlers import QueueHandler, QueueListener, \
+    RotatingFileHandler, SMTPHandler
+
+
+class JSONFormatter(logging.Formatter):
+    """Formats records as one JSON object per line."""
+
+    def format(self, record):
+        data = {'time': datetime.utcfromtimestamp(record.created).isoformat(),
+                'level': record.levelname, 'logger': record.name,
+                'message': record.getMessage(),
+                'path': record.pathname, 'line': record.lineno}
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        return json.dumps(data)
+
+
+class RecordQueueHandler(QueueHandler):
+    """Queues records as they are, where the stock prepare() would format
+    them and drop exc_info, msg and args, leaving JSONFormatter nothing but
+    the text. The queue stays in the process, so nothing has to pickle."""
+
+    def prepare(self, record):
+        return copy.copy(record)
+
+
+class DigestSMTPHandler(SMTPHandler):
+    """Mails error records in digests, at most one every interval seconds.
+
+    Records with the same message from the same line are sent once, with
+    the number of times they happened. Up to capacity distinct records are
+    kept per digest, the rest are only counted.
+    """
+
+    def __init__(self, *args, interval=300, capacity=100, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.interval = interval
+        self.capacity = capacity
+        self.records = OrderedDict()
+        self.dropped = 0
+        self.last_sent = 0
+        self.timer = None
+
+    def emit(self, record):
+        key = (record.pathname, record.lineno, record.getMessage())
+        with self.lock:
+            if key in self.records:
+                self.records[key][1] += 1
+            elif len(self.records) < self.capacity:
+                self.records[key] = [record, 1]
+            else:
+                self.dropped += 1
+            wait = self.last_sent + self.interval - time.monotonic()
+            if wait > 0:
+                if self.timer is None:
+                    self.timer = threading.Timer(wait, self.flush)
+                    self.timer.daemon = True
+                    self.timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        with self.lock:
+            records, self.records = self.records, OrderedDict()
+            dropped, self.dropped = self.dropped, 0
+            self.timer = None
+            if not records:
+                return
+            self.last_sent = time.monotonic()
+        try:
+            self.send(list(records.values()), dropped)
+        except Exception:
+            self.handleError(next(iter(records.values()))[0])
+
+    def send(self, records, dropped):
+        total = sum(count for record, count in records) + dropped
+        msg = EmailMessage()
+        msg['From'] = self.fromaddr
+        msg['To'] = ','.join(self.toaddrs)
+        msg['Subject'] = '{} ({} error{})'.format(
+            self.subject, total, '' if total == 1 else 's')
+        parts = []
+        for record, count in records:
+            parts.append(('[{} times] '.format(count) if count > 1 else '') +
+                         self.format(record))
+        if dropped:
+            parts.append('{} more errors not shown'.format(dropped))
+        msg.set_content(('\n\n' + '-' * 70 + '\n\n').join(parts))
+        smtp = smtplib.SMTP(self.mailhost, self.mailport or smtplib.SMTP_PORT,
+                            timeout=self.timeout)
+        try:
+            if self.username:
+                if self.secure is not None:
+                    smtp.ehlo()
+                    smtp.starttls(*self.secure)
+                    smtp.ehlo()
+                smtp.login(self.username, self.password)
+            smtp.send_message(msg)
+        finally:
+            smtp.quit()
+
+    def close(self):
+        timer = self.timer
+        if timer is not None:
+            timer.cancel()
+        self.flush()
+        super().close()
+
+
+def setup_logging(app):
+    """Log through a queue, so that request threads never wait on disk or
+    SMTP; a listener thread passes the records on to the real handlers."""
+    handlers = []
+    if app.config['MAIL_SERVER']:
+        auth = None
+        if app.config['MAIL_USERNAME'] or app.config['MAIL_PASSWORD']:
+            auth = (app.config['MAIL_USERNAME'],
+                    app.config['MAIL_PASSWORD'])
+        secure = None
+        if app.config['MAIL_USE_TLS']:
+            secure = ()
+        mail_handler = DigestSMTPHandler(
+            mailhost=(app.config['MAIL_SERVER'], app.config['MAIL_PORT']),
+            fromaddr='no-reply@' + app.config['MAIL_SERVER'],
+            toaddrs=app.config['ADMINS'], subject='Microblog Failure',
+            credentials=auth, secure=secure,
+            interval=app.config['LOG_MAIL_INTERVAL'])
+        mail_handler.setLevel(logging.ERROR)
+        handlers.append(mail_handler)
+
+    if app.config['LOG_JSON']:
+        formatter = JSONFormatter()
+    else:
+        formatter = logging.Formatter(
+            '%(asctime)s %(levelname)s: %(message)s '
+            '[in %(pathname)s:%(lineno)d]')
+    if app.config['LOG_TO_STDOUT']:
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(formatter)
+        stream_handler.setLevel(logging.INFO)
+        handlers.append(stream_handler)
+    else:
+        if not os.path.exists('logs'):
+            os.mkdir('logs')
+        file_handler = RotatingFileHandler(
+            'logs/microblog.log', maxBytes=app.config['LOG_MAX_BYTES'],
+            backupCount=app.config['LOG_BACKUP_COUNT'])
+        file_handler.setFormatter(formatter)
+        file_handler.setLevel(logging.INFO)
+        handlers.append(file_handler)
+
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, *handlers,
+                             respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    app.logger.addHandler(RecordQueueHandler(log_queue))
+    app.logger.setLevel(logging.INFO)
+    return listener
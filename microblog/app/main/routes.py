@@ -1,63 +1,129 @@
+import os
+import time
 from datetime import datetime
 from flask import render_template, flash, redirect, url_for, request, g, \
-    jsonify, current_app
+    jsonify, current_app, send_file, abort
 from flask_login import current_user, login_required
 from flask_babel import _, get_locale
-from langdetect import detect, LangDetectException
 from app import db
 from app.main.forms import EditProfileForm, EmptyForm, PostForm, SearchForm
 from app.models import User, Post
-from app.translate import translate
+from app.translate import translate, translate_batch
+from app.avatars import VERSION as AVATAR_VERSION, avatar_path, \
+    save_avatar
+from app.graph import followed_ids
+from app.pagination import InvalidCursor, decode_cursor, encode_cursor, \
+    paginate_posts, post_cursor
+from app.timeline import user_channel
 from app.main import bp
 
 
 @bp.before_app_request
 def before_request():
     if current_user.is_authenticated:
-        current_user.last_seen = datetime.utcnow()
-        db.session.commit()
+        current_app.extensions['last_seen'].seen(current_user.id)
         g.search_form = SearchForm()
     g.locale = str(get_locale())
 
 
+def cursor_page(query):
+    try:
+        return paginate_posts(query, current_app.config['POSTS_PER_PAGE'],
+                              after=request.args.get('after'),
+                              before=request.args.get('before'))
+    except InvalidCursor:
+        abort(400)
+
+
 @bp.route('/', methods=['GET', 'POST'])
 @bp.route('/index', methods=['GET', 'POST'])
 @login_required
 def index():
     form = PostForm()
     if form.validate_on_submit():
-        try:
-            language = detect(form.post.data)
-        except LangDetectException:
-            language = ''
-        post = Post(body=form.post.data, author=current_user,
-                    language=language)
+        # the language is detected in the background after the commit
+        post = Post(body=form.post.data, author=current_user)
         db.session.add(post)
         db.session.commit()
         flash(_('Your post is now live!'))
         return redirect(url_for('main.index'))
-    page = request.args.get('page', 1, type=int)
-    posts = current_user.followed_posts().paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.index', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.index', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts = cursor_page(current_user.timeline_posts().options(
+        db.selectinload(Post.author)))
+    next_url = url_for('main.index', after=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.index', before=posts.prev_cursor) \
+        if posts.prev_cursor else None
+    # the newest page follows the stream of new posts from this position
+    stream_cursor = None
+    if not prev_url:
+        stream_cursor = post_cursor(posts.items[0]) if posts.items else \
+            encode_cursor([datetime.min.isoformat(), 0])
     return render_template('index.html', title=_('Home'), form=form,
                            posts=posts.items, next_url=next_url,
-                           prev_url=prev_url)
+                           prev_url=prev_url, stream_cursor=stream_cursor)
+
+
+@bp.route('/index/new')
+@login_required
+def new_posts():
+    """The posts of the timeline just newer than the before cursor,
+    rendered, for the index page to add at the top."""
+    if 'before' not in request.args:
+        abort(400)
+    posts = cursor_page(current_user.timeline_posts().options(
+        db.selectinload(Post.author)))
+    render_post = current_app.extensions['fragments'].render_post
+    return jsonify({
+        'html': ''.join(render_post(post) for post in posts.items),
+        'cursor': post_cursor(posts.items[0]) if posts.items
+        else request.args['before'],
+        'more': posts.prev_cursor is not None})
+
+
+@bp.route('/stream')
+@login_required
+def stream():
+    """The ids of new posts of the timeline, as server-sent events.
+
+    A connection mostly sits idle, so a server with many listeners should
+    run an async worker, such as gunicorn's gevent. The stream ends after
+    STREAM_MAX_AGE seconds, and the browser reconnects with the follows
+    of the time."""
+    channels = [user_channel(id) for id in
+                followed_ids(current_user.id) + [current_user.id]]
+    subscription = current_app.events.subscribe(channels)
+    config = current_app.config
+    heartbeat = config['STREAM_HEARTBEAT']
+    deadline = time.monotonic() + config['STREAM_MAX_AGE']
+
+    def events():
+        try:
+            yield 'retry: {}\n\n'.format(config['STREAM_RETRY'])
+            while time.monotonic() < deadline:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    # a comment, to keep proxies from closing the connection
+                    yield ': keepalive\n\n'
+                else:
+                    yield 'event: post\ndata: {}\n\n'.format(message)
+        finally:
+            subscription.close()
+
+    response = current_app.response_class(events(),
+                                          mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @bp.route('/explore')
 @login_required
 def explore():
-    page = request.args.get('page', 1, type=int)
-    posts = Post.query.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
-    next_url = url_for('main.explore', page=posts.next_num) \
-        if posts.has_next else None
-    prev_url = url_for('main.explore', page=posts.prev_num) \
-        if posts.has_prev else None
+    posts = cursor_page(Post.query.options(db.selectinload(Post.author)))
+    next_url = url_for('main.explore', after=posts.next_cursor) \
+        if posts.next_cursor else None
+    prev_url = url_for('main.explore', before=posts.prev_cursor) \
+        if posts.prev_cursor else None
     return render_template('index.html', title=_('Explore'),
                            posts=posts.items, next_url=next_url,
                            prev_url=prev_url)
@@ -67,13 +133,11 @@ def explore():
 @login_required
 def user(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    posts = user.posts.order_by(Post.timestamp.desc()).paginate(
-        page=page, per_page=current_app.config['POSTS_PER_PAGE'], error_out=False)
+    posts = cursor_page(user.posts)
     next_url = url_for('main.user', username=user.username,
-                       page=posts.next_num) if posts.has_next else None
+                       after=posts.next_cursor) if posts.next_cursor else None
     prev_url = url_for('main.user', username=user.username,
-                       page=posts.prev_num) if posts.has_prev else None
+                       before=posts.prev_cursor) if posts.prev_cursor else None
     form = EmptyForm()
     return render_template('user.html', user=user, posts=posts.items,
                            next_url=next_url, prev_url=prev_url, form=form)
@@ -144,17 +208,90 @@ def translate_text():
                                       request.form['dest_language'])})
 
 
+@bp.route('/translate/batch', methods=['POST'])
+@login_required
+def translate_posts():
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict) or not isinstance(data.get('posts', []),
+                                                    list):
+        abort(400)
+    dest = data.get('dest_language') or g.locale
+    try:
+        ids = [int(id) for id in data.get('posts', [])][:100]
+    except (TypeError, ValueError):
+        abort(400)
+    by_language = {}
+    for post in Post.query.filter(Post.id.in_(ids)):
+        if post.language and post.language != dest:
+            by_language.setdefault(post.language, []).append(post)
+    translations = {}
+    for language, posts in by_language.items():
+        texts = translate_batch([p.body for p in posts], language, dest)
+        for post, text in zip(posts, texts):
+            translations[post.id] = text
+    return jsonify({'translations': translations})
+
+
+def is_search_position(after):
+    """Whether a cursor entry is a [score, id] pair as returned by
+    Post.search_after."""
+    return isinstance(after, list) and len(after) == 2 and \
+        isinstance(after[0], (int, float)) and \
+        not isinstance(after[0], bool) and \
+        isinstance(after[1], int) and not isinstance(after[1], bool)
+
+
 @bp.route('/search')
 @login_required
 def search():
     if not g.search_form.validate():
         return redirect(url_for('main.explore'))
-    page = request.args.get('page', 1, type=int)
-    posts, total = Post.search(g.search_form.q.data, page,
-                               current_app.config['POSTS_PER_PAGE'])
-    next_url = url_for('main.search', q=g.search_form.q.data, page=page + 1) \
-        if total > page * current_app.config['POSTS_PER_PAGE'] else None
-    prev_url = url_for('main.search', q=g.search_form.q.data, page=page - 1) \
-        if page > 1 else None
-    return render_template('search.html', title=_('Search'), posts=posts,
-                           next_url=next_url, prev_url=prev_url)
+    # the cursor holds the position of every page so far, so that there
+    # is a way back; only the last SEARCH_CURSOR_DEPTH are kept
+    try:
+        stack = decode_cursor(request.args['cursor']) \
+            if 'cursor' in request.args else []
+    except InvalidCursor:
+        abort(400)
+    if not isinstance(stack, list) or \
+            not all(is_search_position(a) for a in stack):
+        abort(400)
+    q = g.search_form.q.data
+    posts, after = Post.search_after(q, current_app.config['POSTS_PER_PAGE'],
+                                     stack[-1] if stack else None)
+    depth = current_app.config['SEARCH_CURSOR_DEPTH']
+    next_url = url_for('main.search', q=q, cursor=encode_cursor(
+        (stack + [after])[-depth:])) if after else None
+    prev_url = None
+    if len(stack) > 1:
+        prev_url = url_for('main.search', q=q,
+                           cursor=encode_cursor(stack[:-1]))
+    elif stack:
+        prev_url = url_for('main.search', q=q)
+    return render_template('search.html', title=_('Search'),
+                           posts=posts.options(
+                               db.selectinload(Post.author)).all(),
+                           next_url=next_url,
+                           prev_url=prev_url)
+
+
+@bp.route('/avatar/v<int:version>/<string(length=32):digest>-<int:size>.png')
+def avatar(version, digest, size):
+    if version != AVATAR_VERSION or \
+            size not in current_app.config['AVATAR_SIZES'] or \
+            digest.strip('0123456789abcdef'):
+        abort(404)
+    path = avatar_path(digest, size)
+    if not os.path.exists(path):
+        # only the avatars of users are drawn and saved, any other digest
+        # would fill the disk
+        if not db.session.query(User.query.filter_by(
+                avatar_digest=digest).exists()).scalar():
+            abort(404)
+        path = save_avatar(digest, size)
+    # the name says everything the image depends on, so it never changes
+    response = send_file(path, mimetype='image/png',
+                         max_age=current_app.config['AVATAR_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
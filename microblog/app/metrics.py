@@ -0,0 +1,58 @@
+import atexit
+import threading
+
+
+class MetricsLog(object):
+    """Logs the metrics() of the app's extensions, such as the search queue
+    lag and the mail dispatcher counters, every METRICS_LOG_INTERVAL seconds.
+
+    The thread starts with the first request, so CLI commands do not log.
+    A METRICS_LOG_INTERVAL of 0 turns the log off.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['metrics_log'] = self
+        app.before_request(self.start)
+        atexit.register(self.stop)
+
+    def start(self):
+        if self.thread is not None or \
+                not self.app.config['METRICS_LOG_INTERVAL']:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='metrics-log', daemon=True)
+                self.thread.start()
+
+    def report(self):
+        for name in sorted(self.app.extensions):
+            metrics = getattr(self.app.extensions[name], 'metrics', None)
+            if not callable(metrics):
+                continue
+            try:
+                values = metrics()
+            except Exception:
+                self.app.logger.exception('Could not read %s metrics', name)
+                continue
+            self.app.logger.info('%s metrics: %s', name, ' '.join(
+                '{}={}'.format(key, round(value, 1)
+                               if isinstance(value, float) else value)
+                for key, value in sorted(values.items())))
+
+    def run(self):
+        while not self.stopped.wait(self.app.config['METRICS_LOG_INTERVAL']):
+            with self.app.app_context():
+                self.report()
+
+    def stop(self):
+        self.stopped.set()
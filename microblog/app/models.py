@@ -1,12 +1,11 @@
 from datetime import datetime
-from hashlib import md5
 from time import time
 from flask import current_app
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
 import jwt
 from app import db, login
-from app.search import add_to_index, remove_from_index, query_index
+from app import avatars
+from app.search import query_index, query_index_after
 
 
 class SearchableMixin(object):
@@ -22,40 +21,67 @@ class SearchableMixin(object):
             db.case(when, value=cls.id)), total
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def search_after(cls, expression, per_page, after=None):
+        """Like search(), paged by the sort values of the last hit of the
+        previous page instead of a page number. Returns the query and the
+        sort values to continue from, or None on the last page."""
+        hits = query_index_after(cls.__tablename__, expression, per_page + 1,
+                                 after)
+        next_after = hits[per_page - 1][1] if len(hits) > per_page else None
+        ids = [id for id, sort in hits[:per_page]]
+        if not ids:
+            return cls.query.filter_by(id=0), None
+        when = [(id, i) for i, id in enumerate(ids)]
+        return cls.query.filter(cls.id.in_(ids)).order_by(
+            db.case(when, value=cls.id)), next_after
+
+    @classmethod
+    def after_flush(cls, session, flush_context):
+        # the queue rows are written in the same transaction as the changes,
+        # so they are committed or rolled back together with them
+        if not current_app.search:
+            return
+        now = datetime.utcnow()
+        rows = []
+        for op, objs in (('index', session.new), ('index', session.dirty),
+                         ('delete', session.deleted)):
+            for obj in objs:
+                if isinstance(obj, SearchableMixin):
+                    rows.append({'index_name': obj.__tablename__,
+                                 'object_id': obj.id, 'op': op,
+                                 'created_at': now, 'attempts': 0})
+        if rows:
+            session.connection().execute(SearchQueue.__table__.insert(), rows)
+            session.info['search_queued'] = True
 
     @classmethod
     def after_commit(cls, session):
-        for obj in session._changes['add']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
-            if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
-            if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+        if session.info.pop('search_queued', None) and \
+                'search_queue' in current_app.extensions:
+            current_app.extensions['search_queue'].wake()
+
+    @classmethod
+    def after_soft_rollback(cls, session, previous_transaction):
+        session.info.pop('search_queued', None)
 
     @classmethod
     def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+        from app.indexer import reindex
+        return reindex(current_app._get_current_object(), cls)
 
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_soft_rollback',
+                SearchableMixin.after_soft_rollback)
 
 
 followers = db.Table(
     'followers',
-    db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('follower_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True),
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'),
+              primary_key=True, index=True)
 )
 
 
@@ -63,10 +89,18 @@ class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(120), index=True, unique=True)
-    password_hash = db.Column(db.String(128))
+    # of the email, kept with it by set_email(), so the avatar route can
+    # tell the digests of users from made-up ones
+    avatar_digest = db.Column(db.String(32), index=True)
+    password_hash = db.Column(db.String(256))
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime, default=datetime.utcnow)
+    fanout_on_read = db.Column(db.Boolean, default=False)
+    followers_count = db.Column(db.Integer, default=0, nullable=False)
+    following_count = db.Column(db.Integer, default=0, nullable=False)
+    # raised on every change to the row, for the ETags of the API
+    version = db.Column(db.Integer, default=1, nullable=False)
     followed = db.relationship(
         'User', secondary=followers,
         primaryjoin=(followers.c.follower_id == id),
@@ -77,27 +111,54 @@ class User(UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = current_app.extensions['passwords'].hash(
+            password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Check a password, and rehash it when the stored hash was made
+        with an older PASSWORD_METHOD; the caller commits the new hash."""
+        if self.password_hash is None:
+            return False
+        hasher = current_app.extensions['passwords']
+        if not hasher.verify(self.password_hash, password):
+            return False
+        if hasher.needs_rehash(self.password_hash):
+            self.password_hash = hasher.hash(password)
+        return True
+
+    @db.validates('email')
+    def set_email(self, key, email):
+        self.avatar_digest = avatars.avatar_digest(email) if email else None
+        return email
 
     def avatar(self, size):
-        digest = md5(self.email.lower().encode('utf-8')).hexdigest()
-        return 'https://www.gravatar.com/avatar/{}?d=identicon&s={}'.format(
-            digest, size)
+        return avatars.avatar_url(self.avatar_digest, size)
 
     def follow(self, user):
-        if not self.is_following(user):
+        if not self._follows(user):
             self.followed.append(user)
+            self._follow_changed(user, 1)
 
     def unfollow(self, user):
-        if self.is_following(user):
+        if self._follows(user):
             self.followed.remove(user)
+            self._follow_changed(user, -1)
+
+    def _follows(self, user):
+        # checked in the database, the change must see this transaction
+        return db.session.query(db.exists().where(
+            followers.c.follower_id == self.id).where(
+            followers.c.followed_id == user.id)).scalar()
+
+    def _follow_changed(self, user, delta):
+        self.following_count = _increment(self, User.following_count, delta)
+        user.followers_count = _increment(user, User.followers_count, delta)
+        db.session.info.setdefault('graph_changed', set()).add(self.id)
+        db.session.info.setdefault('timeline_follows', []).append(
+            (self, user, delta > 0))
 
     def is_following(self, user):
-        return self.followed.filter(
-            followers.c.followed_id == user.id).count() > 0
+        return current_app.extensions['graph'].is_following(self.id, user.id)
 
     def followed_posts(self):
         followed = Post.query.join(
@@ -106,6 +167,20 @@ class User(UserMixin, db.Model):
         own = Post.query.filter_by(user_id=self.id)
         return followed.union(own).order_by(Post.timestamp.desc())
 
+    def timeline_posts(self):
+        timeline = Post.query.join(
+            Timeline, (Timeline.post_id == Post.id)).filter(
+                Timeline.user_id == self.id)
+        if not self.followed.filter(User.fanout_on_read).first():
+            return timeline.order_by(Post.timestamp.desc())
+        # accounts with too many followers are not fanned out, their posts
+        # are merged in at read time
+        pulled = Post.query.join(
+            followers, (followers.c.followed_id == Post.user_id)).join(
+                User, (User.id == Post.user_id)).filter(
+                    followers.c.follower_id == self.id, User.fanout_on_read)
+        return timeline.union(pulled).order_by(Post.timestamp.desc())
+
     def get_reset_password_token(self, expires_in=600):
         return jwt.encode(
             {'reset_password': self.id, 'exp': time() + expires_in},
@@ -120,6 +195,56 @@ class User(UserMixin, db.Model):
             return
         return User.query.get(id)
 
+    def get_api_token(self, expires_in=None):
+        expires_in = expires_in or current_app.config['API_TOKEN_EXPIRATION']
+        return jwt.encode(
+            {'api': self.id, 'exp': time() + expires_in},
+            current_app.config['SECRET_KEY'], algorithm='HS256')
+
+    @staticmethod
+    def verify_api_token(token):
+        """The id of the user a token was issued to, or None.
+
+        The token is checked with the secret key alone, without a query;
+        it stays valid until it expires."""
+        try:
+            return int(jwt.decode(token, current_app.config['SECRET_KEY'],
+                                  algorithms=['HS256'])['api'])
+        except (jwt.InvalidTokenError, KeyError, TypeError, ValueError):
+            return
+
+
+def bump_versions(session, flush_context, instances):
+    for obj in session.dirty:
+        if isinstance(obj, User) and \
+                session.is_modified(obj, include_collections=False):
+            # in SQL, so that concurrent changes each count
+            obj.version = User.version + 1
+            if obj.id is not None and \
+                    db.inspect(obj).attrs.username.history.has_changes():
+                # the name is shown with the posts in the followers'
+                # timelines
+                session.connection().execute(User.__table__.update().where(
+                    User.__table__.c.id.in_(db.select(
+                        [followers.c.follower_id]).where(
+                        followers.c.followed_id == obj.id))).where(
+                    User.__table__.c.id != obj.id).values(
+                    version=User.__table__.c.version + 1))
+    gone = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if gone:
+        # before the flush, while the timelines still have them
+        bump_post_versions(session.connection(), gone)
+
+
+def _increment(obj, column, delta):
+    if obj.id is None:
+        return (getattr(obj, column.key) or 0) + delta
+    # updated in SQL, so concurrent follows do not lose counts
+    return column + delta
+
+
+db.event.listen(db.session, 'before_flush', bump_versions)
+
 
 @login.user_loader
 def load_user(id):
@@ -133,6 +258,72 @@ class Post(SearchableMixin, db.Model):
     timestamp = db.Column(db.DateTime, index=True, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     language = db.Column(db.String(5))
+    __table_args__ = (db.Index('ix_post_user_id_timestamp',
+                               'user_id', 'timestamp'),)
 
     def __repr__(self):
         return '<Post {}>'.format(self.body)
+
+
+class Timeline(db.Model):
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    post_id = db.Column(db.Integer, db.ForeignKey('post.id'), primary_key=True)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('ix_timeline_user_id_timestamp',
+                               'user_id', 'timestamp'),
+                      db.Index('ix_timeline_post_id', 'post_id'))
+
+
+def bump_post_versions(conn, post_ids):
+    """Bump the versions of the authors of posts and of the users that
+    have them in their timelines, for changes to posts that are already
+    out, so that the ETags of their post lists change."""
+    user_table = User.__table__
+    conn.execute(user_table.update().where(db.or_(
+        user_table.c.id.in_(db.select([Post.user_id]).where(
+            Post.id.in_(post_ids))),
+        user_table.c.id.in_(db.select([Timeline.user_id]).where(
+            Timeline.post_id.in_(post_ids))))).values(
+        version=user_table.c.version + 1))
+
+
+class TimelineQueue(db.Model):
+    """Timeline changes waiting for the fan-out worker."""
+    id = db.Column(db.Integer, primary_key=True)
+    op = db.Column(db.String(8), nullable=False)
+    post_id = db.Column(db.Integer)
+    follower_id = db.Column(db.Integer)
+    followed_id = db.Column(db.Integer)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<TimelineQueue {} {}>'.format(
+            self.op, self.post_id or (self.follower_id, self.followed_id))
+
+
+class SearchQueue(db.Model):
+    """Search index changes waiting for the indexing worker."""
+    id = db.Column(db.Integer, primary_key=True)
+    index_name = db.Column(db.String(64), nullable=False)
+    object_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return '<SearchQueue {} {} {}>'.format(self.op, self.index_name,
+                                               self.object_id)
+
+
+class Translation(db.Model):
+    text_hash = db.Column(db.String(64), primary_key=True)
+    source = db.Column(db.String(5), primary_key=True)
+    dest = db.Column(db.String(5), primary_key=True)
+    text = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return '<Translation {} {}>'.format(self.source, self.dest)
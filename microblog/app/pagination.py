@@ -0,0 +1,80 @@
+import base64
+import json
+from datetime import datetime
+from app import db
+from app.models import Post
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(value):
+    """An opaque URL-safe token for a JSON-serializable cursor value."""
+    data = json.dumps(value, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(
+            token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except (ValueError, TypeError) as e:
+        raise InvalidCursor(str(e))
+
+
+def post_cursor(post):
+    return encode_cursor([post.timestamp.isoformat(), post.id])
+
+
+def post_position(token):
+    try:
+        timestamp, id = decode_cursor(token)
+        return datetime.fromisoformat(timestamp), int(id)
+    except (TypeError, ValueError) as e:
+        raise InvalidCursor(str(e))
+
+
+class CursorPage(object):
+    """A page of posts, newest first, with the cursors of its neighbours."""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+
+def paginate_posts(query, per_page, after=None, before=None):
+    """One page of a post query ordered on (timestamp, id), newest first.
+
+    after and before are cursors from a previous page; the page holds the
+    posts just older than after, or just newer than before. Unlike an
+    OFFSET, a cursor finds its place through the timestamp index, so deep
+    pages cost the same as the first, and posts added in the meantime do
+    not shift the pages.
+    """
+    query = query.order_by(None)
+    if before is not None:
+        timestamp, id = post_position(before)
+        rows = query.filter(db.or_(
+            Post.timestamp > timestamp,
+            db.and_(Post.timestamp == timestamp, Post.id > id))).order_by(
+            Post.timestamp.asc(), Post.id.asc()).limit(per_page + 1).all()
+        more = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        return CursorPage(
+            items, next_cursor=post_cursor(items[-1]) if items else None,
+            prev_cursor=post_cursor(items[0]) if more else None)
+    if after is not None:
+        timestamp, id = post_position(after)
+        query = query.filter(db.or_(
+            Post.timestamp < timestamp,
+            db.and_(Post.timestamp == timestamp, Post.id < id)))
+    rows = query.order_by(Post.timestamp.desc(), Post.id.desc()).limit(
+        per_page + 1).all()
+    items = rows[:per_page]
+    return CursorPage(
+        items,
+        next_cursor=post_cursor(items[-1]) if len(rows) > per_page else None,
+        prev_cursor=post_cursor(items[0]) if after is not None and items
+        else None)
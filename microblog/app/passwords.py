@@ -0,0 +1,94 @@
+import atexit
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, \
+    generate_password_hash, check_password_hash
+
+# what werkzeug uses for the parameters a method leaves out
+SCRYPT_DEFAULTS = (2 ** 15, 8, 1)
+
+
+def parse_method(method):
+    """The algorithm of a werkzeug hash method and all of its parameters,
+    with the ones the method leaves out at their defaults, so that
+    'pbkdf2:sha256' and the 'pbkdf2:sha256:260000' it stores compare equal.
+    Raises ValueError for parameters that are not numbers.
+    """
+    parts = method.split(':')
+    if parts[0] == 'pbkdf2' and len(parts) in (2, 3):
+        iterations = int(parts[2] or 0) if len(parts) == 3 else \
+            DEFAULT_PBKDF2_ITERATIONS
+        return ('pbkdf2', parts[1], iterations)
+    if parts[0] == 'scrypt' and len(parts) in (1, 4):
+        return ('scrypt',) + (tuple(int(p) for p in parts[1:]) or
+                              SCRYPT_DEFAULTS)
+    return tuple(parts)
+
+
+class PasswordHasher(object):
+    """Hashes and checks passwords in a pool of worker processes.
+
+    Key stretching is CPU bound and holds the GIL, so on the request
+    thread a burst of logins starves every other page. At most
+    PASSWORD_QUEUE_SIZE hashes can be waiting for the PASSWORD_WORKERS
+    processes; a request that cannot get a place within
+    PASSWORD_QUEUE_TIMEOUT seconds gets a 503. With PASSWORD_ASYNC
+    disabled the work is done inline.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.pool = None
+        self.slots = None
+        self.lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        self.slots = threading.BoundedSemaphore(
+            app.config['PASSWORD_QUEUE_SIZE'])
+        app.extensions['passwords'] = self
+        atexit.register(self.shutdown)
+
+    def run(self, func, *args):
+        if not self.app.config['PASSWORD_ASYNC']:
+            return func(*args)
+        with self.lock:
+            if self.pool is None:
+                # forkserver children do not inherit the threads and
+                # sockets of the web server process
+                methods = multiprocessing.get_all_start_methods()
+                context = multiprocessing.get_context(
+                    'forkserver' if 'forkserver' in methods else 'spawn')
+                self.pool = ProcessPoolExecutor(
+                    self.app.config['PASSWORD_WORKERS'], mp_context=context)
+        if not self.slots.acquire(
+                timeout=self.app.config['PASSWORD_QUEUE_TIMEOUT']):
+            raise ServiceUnavailable()
+        try:
+            return self.pool.submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(generate_password_hash, password,
+                        self.app.config['PASSWORD_METHOD'])
+
+    def verify(self, pwhash, password):
+        return self.run(check_password_hash, pwhash, password)
+
+    def needs_rehash(self, pwhash):
+        """Whether a hash was made with another algorithm or other
+        parameters than the configured method."""
+        try:
+            stored = parse_method(pwhash.split('$', 1)[0])
+        except ValueError:
+            return True
+        return stored != parse_method(self.app.config['PASSWORD_METHOD'])
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
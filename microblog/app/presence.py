@@ -0,0 +1,66 @@
+import atexit
+import threading
+from datetime import datetime
+from app import db
+from app.models import User
+
+
+class LastSeenTracker(object):
+    """Keeps users' last_seen times in memory and writes them in batches.
+
+    Requests only record the time. A background thread writes everything
+    recorded every LAST_SEEN_INTERVAL seconds with a single executemany, so
+    each user is written at most once per interval no matter how many
+    requests they make. Pending times are also written at shutdown.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['last_seen'] = self
+        app.add_template_global(self.last_seen, 'last_seen')
+        atexit.register(self.stop)
+
+    def seen(self, user_id, when=None):
+        with self.lock:
+            self.pending[user_id] = when or datetime.utcnow()
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run,
+                                               name='last-seen', daemon=True)
+                self.thread.start()
+
+    def last_seen(self, user):
+        """The most recent time for a user, including a not yet written one."""
+        return self.pending.get(user.id) or user.last_seen
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, {}
+        if not batch:
+            return 0
+        stmt = User.__table__.update().where(
+            User.__table__.c.id == db.bindparam('user_id')).values(
+            last_seen=db.bindparam('seen'))
+        with db.get_engine(self.app).begin() as conn:
+            conn.execute(stmt, [{'user_id': user_id, 'seen': seen}
+                                for user_id, seen in batch.items()])
+        return len(batch)
+
+    def run(self):
+        while not self.stopped.wait(self.app.config['LAST_SEEN_INTERVAL']):
+            try:
+                self.flush()
+            except Exception:
+                self.app.logger.exception('Could not save last_seen times')
+
+    def stop(self):
+        self.stopped.set()
+        self.flush()
@@ -0,0 +1,43 @@
+from flask import current_app, g, has_request_context, request
+from sqlalchemy.engine import Engine
+from app import db
+
+
+class QueryBudget(object):
+    """Fails requests that run more than QUERY_BUDGET SQL statements.
+
+    Only active in testing, where it catches N+1 query patterns, such as
+    a template loading a relationship once per row, before they ship.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        if not app.testing or not app.config['QUERY_BUDGET']:
+            return
+        app.extensions['query_budget'] = self
+        app.before_request(self.reset)
+        app.after_request(self.check)
+
+    def reset(self):
+        # g outlives a request when a test has pushed an app context
+        g.query_count = 0
+
+    def check(self, response):
+        count = g.get('query_count', 0)
+        budget = current_app.config['QUERY_BUDGET']
+        assert count <= budget, '{} ran {} SQL queries, the budget is {}'.format(
+            request.path, count, budget)
+        return response
+
+
+def count(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and 'query_budget' in current_app.extensions:
+        g.query_count = g.get('query_count', 0) + 1
+
+
+db.event.listen(Engine, 'before_cursor_execute', count)
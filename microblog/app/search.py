@@ -1,27 +1,264 @@
+import re
+import sqlite3
+import threading
+import time
 from flask import current_app
 
 
+class ElasticsearchBackend(object):
+    def __init__(self, client=None, url=None):
+        self._client = client
+        self.url = url
+
+    @property
+    def client(self):
+        # the client library is slow to import, so only on first use
+        if self._client is None:
+            from elasticsearch import Elasticsearch
+            self._client = Elasticsearch([self.url])
+        return self._client
+
+    def index(self, index, id, payload):
+        self.client.index(index=index, id=id, body=payload)
+
+    def delete(self, index, id):
+        self.client.delete(index=index, id=id)
+
+    def bulk(self, index, payloads, removed):
+        """Send a bulk request, return {id: error} for the documents it
+        failed on. Deleting a document that is not there is no failure."""
+        body = []
+        ids = []
+        for id, payload in payloads.items():
+            body.append({'index': {'_index': index, '_id': id}})
+            body.append(payload)
+            ids.append(id)
+        for id in removed:
+            body.append({'delete': {'_index': index, '_id': id}})
+            ids.append(id)
+        if not body:
+            return {}
+        response = self.client.bulk(body=body)
+        failed = {}
+        if response.get('errors'):
+            # the items come back in the order of the actions
+            for id, item in zip(ids, response['items']):
+                for op, result in item.items():
+                    if result.get('status', 200) >= 300 and \
+                            not (op == 'delete' and result.get('status') == 404):
+                        failed[id] = result.get('error', result.get('status'))
+        return failed
+
+    def create_index(self, index):
+        name = '{}-{}'.format(index, int(time.time()))
+        self.client.indices.create(index=name)
+        return name
+
+    def swap(self, index, name):
+        """Point the alias index at the index name, dropping the old one."""
+        actions = [{'add': {'index': name, 'alias': index}}]
+        old = []
+        if self.client.indices.exists_alias(name=index):
+            old = list(self.client.indices.get_alias(name=index))
+            actions[:0] = [{'remove': {'index': i, 'alias': index}} for i in old]
+        elif self.client.indices.exists(index=index):
+            # an index from before aliases were used, it goes in the same call
+            actions.insert(0, {'remove_index': {'index': index}})
+        self.client.indices.update_aliases(body={'actions': actions})
+        for i in old:
+            if i != name:
+                self.client.indices.delete(index=i)
+
+    def query(self, index, query, page, per_page):
+        search = self.client.search(
+            index=index,
+            body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                  'from': (page - 1) * per_page, 'size': per_page})
+        ids = [int(hit['_id']) for hit in search['hits']['hits']]
+        return ids, search['hits']['total']['value']
+
+    def query_after(self, index, query, size, after=None):
+        body = {'query': {'multi_match': {'query': query, 'fields': ['*']}},
+                'size': size, 'sort': [{'_score': 'desc'}, {'_id': 'asc'}]}
+        if after:
+            body['search_after'] = [after[0], str(after[1])]
+        search = self.client.search(index=index, body=body)
+        # _id sorts as a string; positions carry it as a number, like the
+        # rowid of the SQLite backend
+        return [(int(hit['_id']), [hit['sort'][0], int(hit['_id'])])
+                for hit in search['hits']['hits']]
+
+
+class SQLiteBackend(object):
+    """Full-text search in an SQLite FTS5 database, for single-node
+    deployments without an Elasticsearch cluster.
+
+    Every index is an FTS5 table with the searchable fields as columns and
+    the object id as rowid; results are ranked with bm25. Words of the
+    expression are matched with OR, like a multi_match query.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._conn = None
+        self.lock = threading.Lock()
+        self.tables = set()
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        return self._conn
+
+    def table(self, index, fields=None):
+        name = index + '_fts'
+        if name in self.tables:
+            return name
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (name,)).fetchone()
+        if not exists:
+            if fields is None:
+                return None
+            self.conn.execute(
+                'CREATE VIRTUAL TABLE "{}" USING fts5({}, tokenize = '
+                '"unicode61 remove_diacritics 2")'.format(
+                    name, ', '.join('"{}"'.format(f) for f in fields)))
+        self.tables.add(name)
+        return name
+
+    def index(self, index, id, payload):
+        self.bulk(index, {id: payload}, [])
+
+    def delete(self, index, id):
+        self.bulk(index, {}, [id])
+
+    def bulk(self, index, payloads, removed):
+        """Index and delete in one transaction, all or nothing, so no
+        document fails on its own."""
+        if not payloads and not removed:
+            return {}
+        with self.lock, self.conn:
+            fields = list(next(iter(payloads.values()))) if payloads else None
+            name = self.table(index, fields)
+            if name is None:
+                return {}
+            ids = list(payloads) + list(removed)
+            self.conn.executemany('DELETE FROM "{}" WHERE rowid = ?'.format(
+                name), [(id,) for id in ids])
+            if payloads:
+                self.conn.executemany(
+                    'INSERT INTO "{}" (rowid, {}) VALUES (?, {})'.format(
+                        name, ', '.join('"{}"'.format(f) for f in fields),
+                        ', '.join('?' for f in fields)),
+                    [[id] + [payload[f] for f in fields]
+                     for id, payload in payloads.items()])
+        return {}
+
+    def create_index(self, index):
+        name = index + '__rebuild'
+        with self.lock, self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS "{}_fts"'.format(name))
+            self.tables.discard(name + '_fts')
+        return name
+
+    def swap(self, index, name):
+        with self.lock, self.conn:
+            self.conn.execute('DROP TABLE IF EXISTS "{}_fts"'.format(index))
+            self.tables.discard(index + '_fts')
+            if self.table(name) is not None:
+                self.conn.execute(
+                    'ALTER TABLE "{}_fts" RENAME TO "{}_fts"'.format(name, index))
+                self.tables.discard(name + '_fts')
+
+    def match(self, query):
+        # quoted words, so punctuation in the expression is not taken as
+        # FTS5 query syntax
+        words = re.findall(r'\w+', query)
+        return ' OR '.join('"{}"'.format(w) for w in words)
+
+    def query(self, index, query, page, per_page):
+        match = self.match(query)
+        if not match:
+            return [], 0
+        with self.lock:
+            name = self.table(index)
+            if name is None:
+                return [], 0
+            total = self.conn.execute(
+                'SELECT count(*) FROM "{0}" WHERE "{0}" MATCH ?'.format(name),
+                (match,)).fetchone()[0]
+            ids = [r[0] for r in self.conn.execute(
+                'SELECT rowid FROM "{0}" WHERE "{0}" MATCH ? '
+                'ORDER BY bm25("{0}") LIMIT ? OFFSET ?'.format(name),
+                (match, per_page, (page - 1) * per_page))]
+        return ids, total
+
+    def query_after(self, index, query, size, after=None):
+        match = self.match(query)
+        if not match:
+            return []
+        sql = 'SELECT rowid, bm25("{0}") FROM "{0}" WHERE "{0}" MATCH ?'
+        params = [match]
+        if after:
+            sql += ' AND (bm25("{0}") > ? OR (bm25("{0}") = ? AND rowid > ?))'
+            params += [after[0], after[0], after[1]]
+        sql += ' ORDER BY bm25("{0}"), rowid LIMIT ?'
+        with self.lock:
+            name = self.table(index)
+            if name is None:
+                return []
+            rows = self.conn.execute(sql.format(name),
+                                     params + [size]).fetchall()
+        return [(id, [rank, id]) for id, rank in rows]
+
+
+def make_backend(app):
+    """The search backend named by SEARCH_BACKEND, or by default
+    Elasticsearch when ELASTICSEARCH_URL is set and SQLite otherwise."""
+    backend = app.config['SEARCH_BACKEND'] or \
+        ('elasticsearch' if app.config['ELASTICSEARCH_URL'] else 'sqlite')
+    if backend == 'elasticsearch':
+        return ElasticsearchBackend(url=app.config['ELASTICSEARCH_URL'])
+    if backend == 'sqlite':
+        return SQLiteBackend(app.config['SEARCH_SQLITE_PATH'])
+    if backend == 'none':
+        return None
+    raise ValueError('Unknown search backend: {}'.format(backend))
+
+
 def add_to_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return
     payload = {}
     for field in model.__searchable__:
         payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+    current_app.search.index(index, model.id, payload)
 
 
 def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
+    current_app.search.delete(index, model.id)
+
+
+def bulk_index(index, payloads, removed):
+    """Index {id: payload} and delete ids with a single bulk request.
+    Returns {id: error} for the documents that failed."""
+    if not current_app.search:
+        return {}
+    return current_app.search.bulk(index, payloads, removed)
 
 
 def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
+    if not current_app.search:
         return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-              'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    return current_app.search.query(index, query, page, per_page)
+
+
+def query_index_after(index, query, size, after=None):
+    """Up to size (id, sort values) hits following the hit whose sort
+    values are after, for search_after style paging."""
+    if not current_app.search:
+        return []
+    return current_app.search.query_after(index, query, size, after)
@@ -0,0 +1,265 @@
+import atexit
+import json
+import threading
+from datetime import datetime
+from flask import current_app
+from app import db
+from app.models import User, Post, Timeline, TimelineQueue, followers
+
+post_table = Post.__table__
+user_table = User.__table__
+timeline_table = Timeline.__table__
+queue_table = TimelineQueue.__table__
+
+
+def fan_out(conn, config, post_id):
+    """Copy a new post into the timeline of every follower of its author,
+    whose own timeline got it when it was saved. Followers that have it
+    already, from the backfill of a follow queued before the post, are
+    skipped. Returns the id of the author."""
+    post = conn.execute(db.select([post_table.c.user_id, post_table.c.timestamp])
+                        .where(post_table.c.id == post_id)).first()
+    if post is None:
+        return
+    row = {'user_id': post.user_id, 'post_id': post_id,
+           'timestamp': post.timestamp}
+    author = conn.execute(db.select([user_table.c.fanout_on_read,
+                                     user_table.c.followers_count]).where(
+        user_table.c.id == post.user_id)).first()
+    if author.fanout_on_read or \
+            author.followers_count > config['TIMELINE_FANOUT_LIMIT']:
+        # too many followers to copy the post around, they will read it
+        # straight from the author's posts instead; the author's version
+        # tells their timelines that there is a new one
+        conn.execute(user_table.update().where(
+            user_table.c.id == post.user_id).values(
+            fanout_on_read=True, version=user_table.c.version + 1))
+        return post.user_id
+    last_id = 0
+    while True:
+        ids = [r[0] for r in conn.execute(
+            db.select([followers.c.follower_id]).where(
+                followers.c.followed_id == post.user_id).where(
+                followers.c.follower_id > last_id).order_by(
+                followers.c.follower_id).limit(config['TIMELINE_BATCH_SIZE']))]
+        if not ids:
+            break
+        existing = {r[0] for r in conn.execute(
+            db.select([timeline_table.c.user_id]).where(
+                timeline_table.c.post_id == post_id).where(
+                timeline_table.c.user_id.in_(ids)))}
+        rows = [dict(row, user_id=user_id) for user_id in ids
+                if user_id not in existing]
+        if rows:
+            conn.execute(timeline_table.insert(), rows)
+        last_id = ids[-1]
+    return post.user_id
+
+
+def user_channel(user_id):
+    """The event channel of the posts of a user."""
+    return 'user:{}'.format(user_id)
+
+
+def backfill(conn, config, follower_id, followed_id):
+    """Add the most recent posts of a newly followed user to a timeline."""
+    fanout_on_read = conn.execute(db.select([user_table.c.fanout_on_read]).where(
+        user_table.c.id == followed_id)).scalar()
+    if fanout_on_read:
+        return
+    recent = conn.execute(
+        db.select([post_table.c.id, post_table.c.timestamp]).where(
+            post_table.c.user_id == followed_id).order_by(
+            post_table.c.timestamp.desc()).limit(
+            config['TIMELINE_BACKFILL'])).fetchall()
+    existing = {r[0] for r in conn.execute(
+        db.select([timeline_table.c.post_id]).where(
+            timeline_table.c.user_id == follower_id).where(
+            timeline_table.c.post_id.in_([r.id for r in recent])))}
+    rows = [{'user_id': follower_id, 'post_id': r.id, 'timestamp': r.timestamp}
+            for r in recent if r.id not in existing]
+    if rows:
+        conn.execute(timeline_table.insert(), rows)
+        bump_version(conn, follower_id)
+
+
+def trim(conn, config, follower_id, followed_id):
+    """Remove the posts of an unfollowed user from a timeline."""
+    conn.execute(timeline_table.delete().where(
+        timeline_table.c.user_id == follower_id).where(
+        timeline_table.c.post_id.in_(db.select([post_table.c.id]).where(
+            post_table.c.user_id == followed_id))))
+    bump_version(conn, follower_id)
+
+
+def bump_version(conn, user_id):
+    """Change the ETag of a timeline whose older posts have changed, which
+    its newest timestamp does not show."""
+    conn.execute(user_table.update().where(user_table.c.id == user_id).values(
+        version=user_table.c.version + 1))
+
+
+class TimelineFanout(object):
+    """Applies the timeline changes recorded in the timeline_queue table.
+
+    Jobs are committed with the posts and follows that cause them, so a
+    restart or a failure does not lose them. A batch of up to
+    TIMELINE_BATCH_SIZE jobs is applied in one transaction that also
+    deletes them; when the batch fails each job is tried on its own, and a
+    job that keeps failing is skipped after TIMELINE_QUEUE_MAX_ATTEMPTS
+    tries. The worker thread starts with the first queued commit, wakes up
+    on every commit after that and otherwise polls every
+    TIMELINE_QUEUE_INTERVAL seconds. With TIMELINE_ASYNC disabled the
+    queue is processed inline after every commit.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['timeline'] = self
+        atexit.register(self.stop)
+
+    def wake(self):
+        if not self.app.config['TIMELINE_ASYNC']:
+            while self.process():
+                pass
+            return
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.worker,
+                                               name='timeline', daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+
+    def process(self):
+        """Apply one batch of queued jobs, return how many rows it had."""
+        config = self.app.config
+        # a separate connection, so this also works from the session's
+        # after_commit hook, where the session itself cannot run SQL
+        engine = db.get_engine(self.app)
+        with engine.connect() as conn:
+            rows = conn.execute(db.select([queue_table]).where(
+                queue_table.c.attempts < config['TIMELINE_QUEUE_MAX_ATTEMPTS'])
+                .order_by(queue_table.c.id)
+                .limit(config['TIMELINE_BATCH_SIZE'])).fetchall()
+        if not rows:
+            return 0
+        try:
+            posts = self.run(rows)
+        except Exception:
+            # find the jobs that fail, the others go through
+            posts = []
+            for row in rows:
+                try:
+                    posts += self.run([row])
+                except Exception:
+                    self.app.logger.exception('Timeline job %s failed',
+                                              row.id)
+                    with engine.begin() as conn:
+                        conn.execute(queue_table.update().where(
+                            queue_table.c.id == row.id).values(
+                            attempts=queue_table.c.attempts + 1))
+        # announced once the timelines are committed, so that the posts are
+        # there when the streams' listeners come to fetch them
+        for author_id, post_id in posts:
+            self.app.events.publish(user_channel(author_id),
+                                    json.dumps({'id': post_id}))
+        return len(rows)
+
+    def run(self, rows):
+        """Apply jobs and delete them in one transaction. Returns the
+        (author id, post id) of the posts fanned out."""
+        posts = []
+        with db.get_engine(self.app).begin() as conn:
+            for row in rows:
+                if row.op == 'fan_out':
+                    author_id = fan_out(conn, self.app.config, row.post_id)
+                    if author_id is not None:
+                        posts.append((author_id, row.post_id))
+                else:
+                    job = backfill if row.op == 'backfill' else trim
+                    job(conn, self.app.config, row.follower_id,
+                        row.followed_id)
+            conn.execute(queue_table.delete().where(
+                queue_table.c.id.in_([row.id for row in rows])))
+        return posts
+
+    def pending(self):
+        with db.get_engine(self.app).connect() as conn:
+            return conn.execute(db.select([db.func.count()]).select_from(
+                queue_table).where(
+                queue_table.c.attempts <
+                self.app.config['TIMELINE_QUEUE_MAX_ATTEMPTS'])).scalar()
+
+    def worker(self):
+        batch_size = self.app.config['TIMELINE_BATCH_SIZE']
+        while not self.stopped.is_set():
+            self.wakeup.clear()
+            with self.app.app_context():
+                try:
+                    handled = self.process()
+                except Exception:
+                    self.app.logger.exception('Timeline fan-out failed')
+                    handled = 0
+            if handled < batch_size:
+                self.wakeup.wait(self.app.config['TIMELINE_QUEUE_INTERVAL'])
+
+    def stop(self):
+        self.stopped.set()
+        self.wakeup.set()
+
+
+def collect(session, flush_context):
+    # the jobs are written in the same transaction as the changes, so they
+    # are committed or rolled back together with them
+    now = datetime.utcnow()
+    own = []
+    jobs = []
+    for obj in session.new:
+        if isinstance(obj, Post):
+            # the author sees the post as soon as it is saved
+            own.append({'user_id': obj.user_id, 'post_id': obj.id,
+                        'timestamp': obj.timestamp})
+            jobs.append({'op': 'fan_out', 'post_id': obj.id})
+    # follow() and unfollow() leave the users here, by now they have ids
+    for follower, followed, following in session.info.pop('timeline_follows', []):
+        jobs.append({'op': 'backfill' if following else 'trim',
+                     'follower_id': follower.id, 'followed_id': followed.id})
+    gone = [obj.id for obj in session.deleted if isinstance(obj, Post)]
+    if gone:
+        session.connection().execute(timeline_table.delete().where(
+            timeline_table.c.post_id.in_(gone)))
+    if own:
+        session.connection().execute(timeline_table.insert(), own)
+    if jobs:
+        for job in jobs:
+            job.setdefault('post_id', None)
+            job.setdefault('follower_id', None)
+            job.setdefault('followed_id', None)
+            job.update(created_at=now, attempts=0)
+        session.connection().execute(queue_table.insert(), jobs)
+        session.info['timeline_queued'] = True
+
+
+def dispatch(session):
+    if session.info.pop('timeline_queued', None) and \
+            'timeline' in current_app.extensions:
+        current_app.extensions['timeline'].wake()
+
+
+def discard(session, previous_transaction):
+    session.info.pop('timeline_queued', None)
+    session.info.pop('timeline_follows', None)
+
+
+db.event.listen(db.session, 'after_flush', collect)
+db.event.listen(db.session, 'after_commit', dispatch)
+db.event.listen(db.session, 'after_soft_rollback', discard)
@@ -1,21 +1,176 @@
-import json
-import requests
+import hashlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
 from flask import current_app
 from flask_babel import _
+from sqlalchemy.exc import IntegrityError
+from app import db
+from app.models import Translation
+
+# the most texts the translator accepts in one request
+UPSTREAM_BATCH = 100
+
+translation_table = Translation.__table__
+
+
+class TranslationError(Exception):
+    pass
+
+
+class Translator(object):
+    """Translates texts through the translator API, with a cache.
+
+    Translations are looked up in an in-memory LRU first, then in the
+    translation table, and only what is in neither is sent upstream, in
+    as few requests as possible over a pooled HTTP session. The table is
+    read and written on a connection of its own, so translating never
+    commits or rolls back the caller's session.
+    """
+
+    def __init__(self, app=None):
+        self.app = None
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self._session = None
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.app = app
+        app.extensions['translator'] = self
+
+    @property
+    def session(self):
+        # requests is only imported once something needs translating
+        with self.lock:
+            if self._session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_maxsize=self.app.config['TRANSLATOR_POOL_SIZE'])
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self._session = session
+            return self._session
+
+    def get(self, key):
+        with self.lock:
+            text = self.cache.get(key)
+            if text is not None:
+                self.cache.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            self.cache[key] = text
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.app.config['TRANSLATION_CACHE_SIZE']:
+                self.cache.popitem(last=False)
+
+    def translate(self, texts, source_language, dest_language):
+        """Translate a list of texts, returning the translations in order."""
+        keys = [(text_hash(text), source_language, dest_language)
+                for text in texts]
+        found = {}
+        for key in keys:
+            text = self.get(key)
+            if text is not None:
+                found[key] = text
+        missing = {key[0] for key in keys if key not in found}
+        engine = db.get_engine(self.app)
+        if missing:
+            with engine.connect() as conn:
+                for t in conn.execute(translation_table.select().where(
+                        translation_table.c.text_hash.in_(missing)).where(
+                        translation_table.c.source == source_language).where(
+                        translation_table.c.dest == dest_language)):
+                    key = (t.text_hash, t.source, t.dest)
+                    found[key] = t.text
+                    self.put(key, t.text)
+        todo = OrderedDict()
+        for key, text in zip(keys, texts):
+            if key not in found:
+                todo[key] = text
+        if todo:
+            items = list(todo.items())
+            rows = []
+            for i in range(0, len(items), UPSTREAM_BATCH):
+                chunk = items[i:i + UPSTREAM_BATCH]
+                results = self.request([text for key, text in chunk],
+                                       source_language, dest_language)
+                for (key, text), result in zip(chunk, results):
+                    found[key] = result
+                    self.put(key, result)
+                    rows.append({'text_hash': key[0],
+                                 'source': source_language,
+                                 'dest': dest_language, 'text': result,
+                                 'created_at': datetime.utcnow()})
+            self.store(engine, rows)
+        return [found[key] for key in keys]
+
+    @staticmethod
+    def store(engine, rows):
+        try:
+            with engine.begin() as conn:
+                conn.execute(translation_table.insert(), rows)
+        except IntegrityError:
+            # some were translated by another request in the meantime,
+            # keep the rest
+            for row in rows:
+                try:
+                    with engine.begin() as conn:
+                        conn.execute(translation_table.insert(), row)
+                except IntegrityError:
+                    pass
+
+    def request(self, texts, source_language, dest_language):
+        from requests import RequestException
+        config = self.app.config
+        auth = {
+            'Ocp-Apim-Subscription-Key': config['MS_TRANSLATOR_KEY'],
+            'Ocp-Apim-Subscription-Region': config['MS_TRANSLATOR_REGION']}
+        try:
+            r = self.session.post(
+                config['MS_TRANSLATOR_URL'] +
+                '/translate?api-version=3.0&from={}&to={}'.format(
+                    source_language, dest_language), headers=auth,
+                json=[{'Text': text} for text in texts],
+                timeout=(config['TRANSLATOR_CONNECT_TIMEOUT'],
+                         config['TRANSLATOR_READ_TIMEOUT']))
+        except RequestException as e:
+            raise TranslationError(str(e))
+        if r.status_code != 200:
+            raise TranslationError('status {}'.format(r.status_code))
+        return [item['translations'][0]['text'] for item in r.json()]
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def configured():
+    return bool(current_app.config.get('MS_TRANSLATOR_KEY'))
+
 
 def translate(text, source_language, dest_language):
-    if 'MS_TRANSLATOR_KEY' not in current_app.config or \
-            not current_app.config['MS_TRANSLATOR_KEY']:
-        print("key: " + str(current_app.config['MS_TRANSLATOR_KEY']))
+    if not configured():
         return _('Error: the translation service is not configured.')
-    auth = {
-        'Ocp-Apim-Subscription-Key': current_app.config['MS_TRANSLATOR_KEY'],
-        'Ocp-Apim-Subscription-Region': 'westus2'}
-    r = requests.post(
-        'https://api.cognitive.microsofttranslator.com'
-        '/translate?api-version=3.0&from={}&to={}'.format(
-            source_language, dest_language), headers=auth, json=[
-                {'Text': text}])
-    if r.status_code != 200:
+    try:
+        return current_app.extensions['translator'].translate(
+            [text], source_language, dest_language)[0]
+    except TranslationError:
         return _('Error: the translation service failed.')
-    return r.json()[0]['translations'][0]['text']
+
+
+def translate_batch(texts, source_language, dest_language):
+    """Like translate() for a list of texts, in one upstream request."""
+    if not configured():
+        return [_('Error: the translation service is not configured.')] * \
+            len(texts)
+    try:
+        return current_app.extensions['translator'].translate(
+            texts, source_language, dest_language)
+    except TranslationError:
+        return [_('Error: the translation service failed.')] * len(texts)
@@ -12,13 +12,76 @@ class Config(object):
         'sqlite:///' + os.path.join(basedir, 'app.db')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     LOG_TO_STDOUT = os.environ.get('LOG_TO_STDOUT')
+    LOG_JSON = os.environ.get('LOG_JSON') is not None
+    LOG_MAX_BYTES = 10 * 1024 * 1024
+    LOG_BACKUP_COUNT = 10
+    LOG_MAIL_INTERVAL = int(os.environ.get('LOG_MAIL_INTERVAL') or 300)
     MAIL_SERVER = os.environ.get('MAIL_SERVER') or 'smtp.mail.ru'
     MAIL_PORT = int(os.environ.get('MAIL_PORT') or 465)
     MAIL_USE_TLS = os.environ.get('MAIL_USE_TLS') is not None
     MAIL_USERNAME = os.environ.get('MAIL_USERNAME') or 'oleg_ring@mail.ru'
     MAIL_PASSWORD = os.environ.get('MAIL_PASSWORD') or 'EacGca35xr0V1hiSjrRp'
     ADMINS = ['oleg_ring@mail.ru']
+    MAIL_WORKERS = 2
+    MAIL_QUEUE_SIZE = 100
+    MAIL_QUEUE_TIMEOUT = 2
+    MAIL_IDLE_TIMEOUT = 30
+    MAIL_DRAIN_TIMEOUT = 10
+    PASSWORD_METHOD = os.environ.get('PASSWORD_METHOD') or \
+        'pbkdf2:sha256:600000'
+    PASSWORD_ASYNC = True
+    PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS') or
+                           os.cpu_count() or 1)
+    PASSWORD_QUEUE_SIZE = 64
+    PASSWORD_QUEUE_TIMEOUT = 5
     LANGUAGES = ['en', 'ru']
     MS_TRANSLATOR_KEY = os.environ.get('MS_TRANSLATOR_KEY')
+    MS_TRANSLATOR_URL = os.environ.get('MS_TRANSLATOR_URL') or \
+        'https://api.cognitive.microsofttranslator.com'
+    MS_TRANSLATOR_REGION = os.environ.get('MS_TRANSLATOR_REGION') or 'westus2'
+    TRANSLATOR_POOL_SIZE = 10
+    TRANSLATOR_CONNECT_TIMEOUT = 3.05
+    TRANSLATOR_READ_TIMEOUT = 10
+    TRANSLATION_CACHE_SIZE = 10000
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND')
+    SEARCH_SQLITE_PATH = os.environ.get('SEARCH_SQLITE_PATH') or \
+        os.path.join(basedir, 'search.db')
+    LANGUAGE_ASYNC = True
+    LANGUAGE_PRELOAD = os.environ.get('LANGUAGE_PRELOAD') is not None
+    LANGUAGE_MIN_LENGTH = 12
+    LANGDETECT_SEED = 0
+    AVATAR_DIR = os.environ.get('AVATAR_DIR') or \
+        os.path.join(basedir, 'avatars')
+    # the sizes the pages and the API show, the only ones that are served
+    AVATAR_SIZES = (70, 128, 256)
+    AVATAR_MAX_AGE = 365 * 24 * 3600
+    QUERY_BUDGET = None
+    STARTUP_TIME_BUDGET = float(os.environ.get('STARTUP_TIME_BUDGET') or 2.0)
     POSTS_PER_PAGE = 10
+    FRAGMENT_CACHE_BYTES = 32 * 1024 * 1024
+    API_MAX_PER_PAGE = 100
+    API_TOKEN_EXPIRATION = 3600
+    SEARCH_CURSOR_DEPTH = 20
+    TIMELINE_ASYNC = True
+    EVENT_BROKER = os.environ.get('EVENT_BROKER') or 'local'
+    EVENT_QUEUE_SIZE = 100
+    STREAM_HEARTBEAT = 15
+    STREAM_MAX_AGE = 300
+    STREAM_RETRY = 3000
+    TIMELINE_BATCH_SIZE = 500
+    TIMELINE_QUEUE_INTERVAL = 5
+    TIMELINE_QUEUE_MAX_ATTEMPTS = 10
+    TIMELINE_BACKFILL = 100
+    TIMELINE_FANOUT_LIMIT = int(os.environ.get('TIMELINE_FANOUT_LIMIT') or 10000)
+    FOLLOW_CACHE_SIZE = 10000
+    FOLLOW_CACHE_MAX_SET = 5000
+    FOLLOW_CACHE_TTL = 60
+    SEARCH_QUEUE_ASYNC = True
+    SEARCH_QUEUE_BATCH_SIZE = 500
+    SEARCH_QUEUE_INTERVAL = 5
+    SEARCH_QUEUE_RETRIES = 3
+    SEARCH_QUEUE_BACKOFF = 0.5
+    SEARCH_QUEUE_MAX_ATTEMPTS = 10
+    LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL') or 60)
+    METRICS_LOG_INTERVAL = int(os.environ.get('METRICS_LOG_INTERVAL') or 300)
@@ -0,0 +1,24 @@
+"""user version
+
+Revision ID: 0b8e5d3a7c19
+Revises: f2a6c9d1b384
+Create Date: 2026-10-19 18:40:12.306581
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b8e5d3a7c19'
+down_revision = 'f2a6c9d1b384'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('user', 'version')
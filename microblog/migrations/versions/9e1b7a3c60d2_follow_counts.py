@@ -0,0 +1,47 @@
+"""follow counts and followers primary key
+
+Revision ID: 9e1b7a3c60d2
+Revises: 5c4f2d8b91a3
+Create Date: 2026-10-19 12:40:07.902113
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9e1b7a3c60d2'
+down_revision = '5c4f2d8b91a3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the old table has no key and may hold duplicate rows, so it is rebuilt
+    op.create_table('followers_new',
+    sa.Column('follower_id', sa.Integer(), nullable=False),
+    sa.Column('followed_id', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['followed_id'], ['user.id'], ),
+    sa.ForeignKeyConstraint(['follower_id'], ['user.id'], ),
+    sa.PrimaryKeyConstraint('follower_id', 'followed_id')
+    )
+    op.execute('INSERT INTO followers_new (follower_id, followed_id) '
+               'SELECT DISTINCT follower_id, followed_id FROM followers '
+               'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    op.drop_table('followers')
+    op.rename_table('followers_new', 'followers')
+    op.create_index(op.f('ix_followers_followed_id'), 'followers', ['followed_id'], unique=False)
+
+    op.add_column('user', sa.Column('followers_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+    op.execute('UPDATE "user" SET '
+               'followers_count = (SELECT count(*) FROM followers '
+               'WHERE followers.followed_id = "user".id), '
+               'following_count = (SELECT count(*) FROM followers '
+               'WHERE followers.follower_id = "user".id)')
+
+
+def downgrade():
+    op.drop_column('user', 'following_count')
+    op.drop_column('user', 'followers_count')
+    op.drop_index(op.f('ix_followers_followed_id'), table_name='followers')
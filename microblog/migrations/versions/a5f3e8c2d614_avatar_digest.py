@@ -0,0 +1,41 @@
+"""avatar digest
+
+Revision ID: a5f3e8c2d614
+Revises: 7d2c4e9a1f36
+Create Date: 2026-10-19 23:05:31.227408
+
+"""
+from hashlib import md5
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5f3e8c2d614'
+down_revision = '7d2c4e9a1f36'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('user', sa.Column('avatar_digest', sa.String(length=32), nullable=True))
+    op.create_index(op.f('ix_user_avatar_digest'), 'user', ['avatar_digest'], unique=False)
+
+    # the digest is an md5 of the email, which SQL cannot compute everywhere
+    user = sa.table('user', sa.column('id', sa.Integer),
+                    sa.column('email', sa.String),
+                    sa.column('avatar_digest', sa.String))
+    conn = op.get_bind()
+    rows = [{'user_id': id,
+             'digest': md5(email.lower().encode('utf-8')).hexdigest()}
+            for id, email in conn.execute(sa.select(
+                [user.c.id, user.c.email]).where(user.c.email.isnot(None)))]
+    if rows:
+        conn.execute(user.update().where(
+            user.c.id == sa.bindparam('user_id')).values(
+            avatar_digest=sa.bindparam('digest')), rows)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_user_avatar_digest'), table_name='user')
+    op.drop_column('user', 'avatar_digest')
@@ -1,33 +1,231 @@
 #!/usr/bin/env python
-import os
 from datetime import datetime, timedelta
+import base64
+import io
+import json
+import logging
+import os
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import unittest
-from app import app, db
-from app.models import User, Post
-from config import basedir
+from unittest import mock
+from werkzeug.exceptions import ServiceUnavailable
+from werkzeug.security import DEFAULT_PBKDF2_ITERATIONS, generate_password_hash
+from app import create_app, db, cli
+from app.bench import seed
+from app.email import STOP, MailDispatcher, send_email
+from app.indexer import reindex
+from app.logs import DigestSMTPHandler, JSONFormatter, setup_logging
+from app.models import User, Post, SearchQueue, TimelineQueue, Translation, \
+    followers
+from app.pagination import encode_cursor, paginate_posts
+from app.search import ElasticsearchBackend
+from app.translate import translate, translate_batch
+from config import Config
+
+
+class TestConfig(Config):
+    TESTING = True
+    SQLALCHEMY_DATABASE_URI = 'sqlite://'
+    ELASTICSEARCH_URL = None
+    TIMELINE_ASYNC = False
+    SEARCH_QUEUE_ASYNC = False
+    LANGUAGE_ASYNC = False
+    SEARCH_QUEUE_BACKOFF = 0
+    SEARCH_SQLITE_PATH = ':memory:'
+    AVATAR_DIR = tempfile.mkdtemp()
+    QUERY_BUDGET = 10
+    PASSWORD_ASYNC = False
+    PASSWORD_METHOD = 'pbkdf2:sha256:1000'
+    METRICS_LOG_INTERVAL = 0
+
+
+class FakeSearch(object):
+    """Stands in for the Elasticsearch client in the indexing tests."""
+
+    def __init__(self):
+        self.docs = {}
+        self.requests = 0
+        self.fail = 0
+        self.reject = set()
+
+    def bulk(self, body):
+        self.requests += 1
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('search backend is down')
+        items = []
+        actions = iter(body)
+        for action in actions:
+            op, meta = next(iter(action.items()))
+            key = (meta['_index'], meta['_id'])
+            if op == 'index' and meta['_id'] in self.reject:
+                next(actions)
+                items.append({op: {'status': 400, 'error': 'rejected'}})
+            elif op == 'index':
+                self.docs[key] = next(actions)
+                items.append({op: {'status': 200}})
+            else:
+                found = self.docs.pop(key, None) is not None
+                items.append({op: {'status': 200 if found else 404}})
+        return {'errors': any(i[op]['status'] >= 300 for i in items
+                              for op in i), 'items': items}
+
+
+class StubTranslator(BaseHTTPRequestHandler):
+    """Translator API stand-in that "translates" by upper-casing."""
+    requests = []
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        StubTranslator.requests.append(len(body))
+        data = json.dumps([{'translations': [{'text': item['Text'].upper()}]}
+                           for item in body]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubSMTP(socketserver.StreamRequestHandler):
+    """Just enough of an SMTP server to receive messages."""
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 stub\r\n')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command == b'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                data = []
+                for line in self.rfile:
+                    if line == b'.\r\n':
+                        break
+                    data.append(line)
+                self.server.messages.append(b''.join(data))
+            elif command == b'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            self.wfile.write(b'250 ok\r\n')
 
 
 class UserModelCase(unittest.TestCase):
     def setUp(self):
-        app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL') or \
-        'sqlite:///' + os.path.join(basedir, 'test.db')
+        self.app = create_app(TestConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
         db.create_all()
 
     def tearDown(self):
+        self.app.extensions['last_seen'].stop()
         db.session.remove()
         db.drop_all()
+        self.app_context.pop()
 
     def test_password_hashing(self):
         u = User(username='susan')
         u.set_password('cat')
         self.assertFalse(u.check_password('dog'))
         self.assertTrue(u.check_password('cat'))
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+
+    def test_password_rehash(self):
+        u = User(username='susan', email='susan@example.com',
+                 password_hash=generate_password_hash(
+                     'cat', 'pbkdf2:sha256:500'))
+        db.session.add(u)
+        db.session.commit()
+        self.app.config['WTF_CSRF_ENABLED'] = False
+        client = self.app.test_client()
+        client.post('/auth/login', data={'username': 'susan',
+                                          'password': 'dog'})
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:500$'))
+        client.post('/auth/login', data={'username': 'susan',
+                                          'password': 'cat'})
+        db.session.expire_all()
+        u = User.query.filter_by(username='susan').first()
+        self.assertTrue(u.password_hash.startswith('pbkdf2:sha256:1000$'))
+        self.assertTrue(u.check_password('cat'))
+
+        # a method that leaves parameters out means werkzeug's defaults,
+        # which is what the stored hash spells out
+        hasher = self.app.extensions['passwords']
+        self.app.config['PASSWORD_METHOD'] = 'pbkdf2:sha256'
+        stored = 'pbkdf2:sha256:{}$salt$hash'.format(DEFAULT_PBKDF2_ITERATIONS)
+        self.assertFalse(hasher.needs_rehash(stored))
+        self.assertTrue(hasher.needs_rehash('pbkdf2:sha256:1000$salt$hash'))
+        self.assertTrue(hasher.needs_rehash(
+            'pbkdf2:sha512:{}$salt$hash'.format(DEFAULT_PBKDF2_ITERATIONS)))
+        self.assertTrue(hasher.needs_rehash('pbkdf2:sha256:many$salt$hash'))
+        self.app.config['PASSWORD_METHOD'] = 'scrypt'
+        self.assertFalse(hasher.needs_rehash('scrypt:32768:8:1$salt$hash'))
+        self.assertTrue(hasher.needs_rehash('scrypt:16384:8:1$salt$hash'))
+        self.app.config['PASSWORD_METHOD'] = 'pbkdf2:sha256'
+        u.set_password('cat')
+        db.session.commit()
+        pwhash = u.password_hash
+        self.assertTrue(u.check_password('cat'))
+        self.assertEqual(u.password_hash, pwhash)
+
+    def test_password_pool(self):
+        hasher = self.app.extensions['passwords']
+        self.app.config['PASSWORD_ASYNC'] = True
+        u = User(username='susan')
+        u.set_password('cat')
+        self.assertTrue(u.check_password('cat'))
+        self.assertFalse(u.check_password('dog'))
+        self.assertIsNotNone(hasher.pool)
+        # with every place taken, new work is turned away
+        self.app.config['PASSWORD_QUEUE_TIMEOUT'] = 0
+        while hasher.slots.acquire(blocking=False):
+            pass
+        self.assertRaises(ServiceUnavailable, u.check_password, 'cat')
+        hasher.shutdown()
 
     def test_avatar(self):
         u = User(username='john', email='john@example.com')
-        self.assertEqual(u.avatar(128), ('https://www.gravatar.com/avatar/'
-                                         'd4c74594d841139328695756648b6bd6'
-                                         '?d=identicon&s=128'))
+        with self.app.test_request_context():
+            self.assertEqual(u.avatar(128), ('/avatar/v1/'
+                                             'd4c74594d841139328695756648b6bd6'
+                                             '-128.png'))
+            u.email = 'susan@example.com'
+            self.assertNotIn('d4c74594d841139328695756648b6bd6',
+                             u.avatar(128))
+        u.email = 'john@example.com'
+        db.session.add(u)
+        db.session.commit()
+
+        client = self.app.test_client()
+        response = client.get(
+            '/avatar/v1/d4c74594d841139328695756648b6bd6-70.png')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'image/png')
+        self.assertTrue(response.data.startswith(b'\x89PNG'))
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertTrue(os.path.exists(os.path.join(
+            self.app.config['AVATAR_DIR'],
+            'd4c74594d841139328695756648b6bd6-70-v1.png')))
+        response.close()
+
+        # only the avatars of users, in the sizes that are shown, of the
+        # current drawing are served, and nothing else is saved
+        files = set(os.listdir(self.app.config['AVATAR_DIR']))
+        for url in ('/avatar/v1/{}-70.png'.format('x' * 32),
+                    '/avatar/v1/{}-70.png'.format('a' * 32),
+                    '/avatar/v1/d4c74594d841139328695756648b6bd6-71.png',
+                    '/avatar/v1/d4c74594d841139328695756648b6bd6-9999.png',
+                    '/avatar/v0/d4c74594d841139328695756648b6bd6-70.png'):
+            self.assertEqual(client.get(url).status_code, 404)
+        self.assertEqual(set(os.listdir(self.app.config['AVATAR_DIR'])),
+                         files)
 
     def test_follow(self):
         u1 = User(username='john', email='john@example.com')
@@ -51,6 +249,35 @@ class UserModelCase(unittest.TestCase):
         self.assertFalse(u1.is_following(u2))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
+        self.assertEqual(u1.following_count, 0)
+        self.assertEqual(u2.followers_count, 0)
+
+    def test_follow_counts_and_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+        self.assertEqual(u1.following_count, 2)
+        self.assertEqual(u3.followers_count, 2)
+
+        graph = self.app.extensions['graph']
+        self.assertTrue(u1.is_following(u2))
+        self.assertTrue(u1.is_following(u3))
+        self.assertFalse(u1.is_following(u1))
+        self.assertEqual(graph.misses, 1)
+        self.assertEqual(graph.hits, 2)
+
+        # committing an unfollow drops the cached set
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertFalse(u1.is_following(u3))
+        self.assertEqual(graph.misses, 2)
+        self.assertEqual(u3.followers_count, 1)
 
     def test_follow_posts(self):
         # create four users
@@ -90,6 +317,761 @@ class UserModelCase(unittest.TestCase):
         self.assertEqual(f3, [p3, p4])
         self.assertEqual(f4, [p4])
 
+    def test_last_seen(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        before = u.last_seen
+        tracker = self.app.extensions['last_seen']
+        later = before + timedelta(minutes=5)
+        tracker.seen(u.id, before + timedelta(minutes=1))
+        tracker.seen(u.id, later)
+        self.assertEqual(tracker.last_seen(u), later)
+        db.session.expire(u)
+        self.assertEqual(u.last_seen, before)
+
+        self.assertEqual(tracker.flush(), 1)
+        db.session.expire(u)
+        self.assertEqual(u.last_seen, later)
+        self.assertEqual(tracker.flush(), 0)
+
+    def test_timeline(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        u1.follow(u3)
+        db.session.commit()
+
+        # new posts are fanned out to the followers
+        now = datetime.utcnow()
+        p1 = Post(body="post from john", author=u1,
+                  timestamp=now + timedelta(seconds=1))
+        p2 = Post(body="post from susan", author=u2,
+                  timestamp=now + timedelta(seconds=2))
+        p3 = Post(body="post from mary", author=u3,
+                  timestamp=now + timedelta(seconds=3))
+        db.session.add_all([p1, p2, p3])
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p3, p2, p1])
+        self.assertEqual(u2.timeline_posts().all(), [p2])
+
+        # unfollow trims the timeline, follow backfills it
+        u1.unfollow(u3)
+        db.session.commit()
+        self.assertEqual(u1.timeline_posts().all(), [p2, p1])
+        u2.follow(u3)
+        db.session.commit()
+        self.assertEqual(u2.timeline_posts().all(), [p3, p2])
+        self.assertEqual(u1.timeline_posts().all(),
+                         u1.followed_posts().all())
+
+    def test_timeline_queue(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        fanout = self.app.extensions['timeline']
+
+        # the jobs wait in the table, the author's own row does not
+        with mock.patch.object(fanout, 'wake'):
+            p = Post(body='post from susan', author=u2)
+            db.session.add(p)
+            db.session.commit()
+            u3.follow(u2)
+            db.session.commit()
+        self.assertEqual(u2.timeline_posts().all(), [p])
+        self.assertEqual(u1.timeline_posts().all(), [])
+        self.assertEqual(TimelineQueue.query.count(), 2)
+        self.assertEqual(fanout.pending(), 2)
+
+        # a failing job is counted and kept, the others go through
+        with mock.patch('app.timeline.backfill',
+                        side_effect=RuntimeError('timeline is down')):
+            self.assertEqual(fanout.process(), 2)
+        self.assertEqual(u1.timeline_posts().all(), [p])
+        self.assertEqual([(j.op, j.attempts) for j in TimelineQueue.query],
+                         [('backfill', 1)])
+        self.assertEqual(fanout.process(), 1)
+        self.assertEqual(u3.timeline_posts().all(), [p])
+        self.assertEqual(fanout.pending(), 0)
+
+        # a follow queued before a post: its backfill already copies the
+        # post, and the fan-out of the post skips that follower
+        u4 = User(username='david', email='david@example.com')
+        db.session.add(u4)
+        db.session.commit()
+        with mock.patch.object(fanout, 'wake'):
+            u4.follow(u2)
+            db.session.commit()
+            p2 = Post(body='second post from susan', author=u2)
+            db.session.add(p2)
+            db.session.commit()
+        self.assertEqual([j.op for j in TimelineQueue.query.order_by(
+            TimelineQueue.id)], ['backfill', 'fan_out'])
+        self.assertEqual(fanout.process(), 2)
+        self.assertEqual(fanout.pending(), 0)
+        self.assertEqual(TimelineQueue.query.count(), 0)
+        for u in (u1, u3, u4):
+            self.assertEqual(u.timeline_posts().all(), [p2, p])
+
+    def test_timeline_fanout_on_read(self):
+        self.app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        u1.follow(u3)
+        u2.follow(u3)
+        db.session.commit()
+
+        p = Post(body="post from mary", author=u3)
+        db.session.add(p)
+        db.session.commit()
+        self.assertTrue(u3.fanout_on_read)
+        self.assertEqual(u1.timeline_posts().all(), [p])
+        self.assertEqual(u2.timeline_posts().all(), [p])
+
+
+    def test_search_queue(self):
+        search = FakeSearch()
+        self.app.search = ElasticsearchBackend(search)
+        indexer = self.app.extensions['search_queue']
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='first', author=u)
+        p2 = Post(body='second', author=u)
+        db.session.add_all([u, p1, p2])
+        db.session.commit()
+        p1.body = 'first, edited'
+        db.session.commit()
+        db.session.delete(p2)
+        db.session.commit()
+        p3 = Post(body='rolled back', author=u)
+        db.session.add(p3)
+        db.session.flush()
+        db.session.rollback()
+
+        # nothing is sent at commit time, only queued
+        self.assertEqual(search.requests, 0)
+        self.assertEqual(SearchQueue.query.count(), 4)
+        self.assertEqual(indexer.metrics()['pending'], 4)
+        self.assertGreaterEqual(indexer.lag(), 0)
+        cli.register(self.app)
+        result = self.app.test_cli_runner().invoke(args=['search', 'status'])
+        self.assertIn('pending: 4\n', result.output)
+        self.assertIn('lag: ', result.output)
+        with self.assertLogs(self.app.logger) as logs:
+            self.app.extensions['metrics_log'].report()
+        self.assertIn('search_queue metrics: ', '\n'.join(logs.output))
+        self.assertIn('pending=4', '\n'.join(logs.output))
+        self.assertIn('mail_dispatcher metrics: ', '\n'.join(logs.output))
+
+        # the worker coalesces the updates into a single bulk request
+        self.assertEqual(indexer.process(), 4)
+        self.assertEqual(search.requests, 1)
+        self.assertEqual(search.docs, {('post', p1.id): {'body': 'first, edited'}})
+        self.assertEqual(SearchQueue.query.count(), 0)
+        self.assertEqual(indexer.lag(), 0)
+        self.assertEqual(indexer.process(), 0)
+
+        # failures are retried, then left in the queue for the next round
+        self.app.config['SEARCH_QUEUE_RETRIES'] = 1
+        search.fail = 2
+        p1.body = 'edited again'
+        db.session.commit()
+        with self.assertRaises(ConnectionError):
+            indexer.process()
+        self.assertEqual(search.requests, 3)
+        self.assertEqual(SearchQueue.query.first().attempts, 1)
+        self.assertEqual(indexer.process(), 1)
+        self.assertEqual(search.docs[('post', p1.id)], {'body': 'edited again'})
+        self.assertEqual(indexer.metrics()['failures'], 1)
+
+        # a document the backend rejects is retried on its own, and only
+        # its row stays in the queue
+        p4 = Post(body='rejected', author=u)
+        db.session.add(p4)
+        p1.body = 'edited a third time'
+        db.session.commit()
+        search.reject = {p4.id}
+        requests = search.requests
+        self.assertEqual(indexer.process(), 2)
+        self.assertEqual(search.requests, requests + 2)
+        self.assertEqual(search.docs[('post', p1.id)],
+                         {'body': 'edited a third time'})
+        self.assertNotIn(('post', p4.id), search.docs)
+        row = SearchQueue.query.one()
+        self.assertEqual((row.object_id, row.attempts), (p4.id, 1))
+        self.assertEqual(indexer.metrics()['failures'], 2)
+        search.reject = set()
+        self.assertEqual(indexer.process(), 1)
+        self.assertEqual(search.docs[('post', p4.id)], {'body': 'rejected'})
+        self.assertEqual(SearchQueue.query.count(), 0)
+
+
+    def test_search_sqlite(self):
+        indexer = self.app.extensions['search_queue']
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='The quick brown fox', author=u)
+        p2 = Post(body='A lazy dog, a lazy afternoon', author=u)
+        p3 = Post(body='Foxes and dogs', author=u)
+        db.session.add_all([u, p1, p2, p3])
+        db.session.commit()
+        indexer.process()
+
+        posts, total = Post.search('lazy', 1, 10)
+        self.assertEqual((posts.all(), total), ([p2], 1))
+        posts, total = Post.search('fox OR "dog"', 1, 10)
+        self.assertEqual(total, 2)
+        self.assertEqual(set(posts.all()), {p1, p2})
+        posts, total = Post.search('fox dog', 2, 1)
+        self.assertEqual((len(posts.all()), total), (1, 2))
+        self.assertEqual(Post.search('cat', 1, 10)[1], 0)
+        self.assertEqual(Post.search('?!', 1, 10)[1], 0)
+
+        p2.body = 'A sleepy dog'
+        db.session.delete(p1)
+        db.session.commit()
+        indexer.process()
+        self.assertEqual(Post.search('lazy', 1, 10)[1], 0)
+        self.assertEqual(Post.search('fox', 1, 10)[1], 0)
+        self.assertEqual(Post.search('sleepy', 1, 10)[0].all(), [p2])
+
+
+    def test_reindex(self):
+        u = User(username='john', email='john@example.com')
+        posts = [Post(body='post number {}'.format(i), author=u)
+                 for i in range(7)]
+        db.session.add_all([u] + posts)
+        db.session.commit()
+        self.assertEqual(Post.search('number', 1, 10)[1], 0)
+
+        # an interrupted run resumes after the last id in the checkpoint
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'reindex-post.json')
+        with open(checkpoint, 'w') as f:
+            json.dump({'index': 'post', 'fresh': False, 'target': 'post',
+                       'last_id': posts[3].id, 'sent': 4}, f)
+        self.assertEqual(reindex(self.app, Post, chunk_size=2, workers=2,
+                                 checkpoint=checkpoint), 3)
+        self.assertFalse(os.path.exists(checkpoint))
+        self.assertEqual(Post.search('number', 1, 10)[1], 3)
+
+        # a fresh index replaces the old one when complete
+        self.assertEqual(reindex(self.app, Post, chunk_size=2, workers=2,
+                                 fresh=True), 7)
+        results, total = Post.search('number', 1, 10)
+        self.assertEqual(total, 7)
+        self.assertEqual(set(results.all()), set(posts))
+
+
+    def test_translation_cache(self):
+        server = HTTPServer(('127.0.0.1', 0), StubTranslator)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        StubTranslator.requests = []
+        self.app.config['MS_TRANSLATOR_KEY'] = 'key'
+        self.app.config['MS_TRANSLATOR_URL'] = 'http://127.0.0.1:{}'.format(
+            server.server_port)
+        translator = self.app.extensions['translator']
+
+        self.assertEqual(translate_batch(['hola', 'adios', 'hola'], 'es', 'en'),
+                         ['HOLA', 'ADIOS', 'HOLA'])
+        self.assertEqual(StubTranslator.requests, [2])
+        self.assertEqual(Translation.query.count(), 2)
+
+        # served from memory, then from the table once memory is cleared
+        self.assertEqual(translate('hola', 'es', 'en'), 'HOLA')
+        translator.cache.clear()
+        self.assertEqual(translate_batch(['adios', 'gracias'], 'es', 'en'),
+                         ['ADIOS', 'GRACIAS'])
+        self.assertEqual(StubTranslator.requests, [2, 1])
+        self.assertEqual(translate('hola', 'es', 'ru'), 'HOLA')
+        self.assertEqual(StubTranslator.requests, [2, 1, 1])
+
+        # the cache is written apart from the caller's session, which is
+        # neither committed nor rolled back
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        self.assertEqual(translate('nuevo', 'es', 'en'), 'NUEVO')
+        self.assertIn(u, db.session.new)
+        db.session.rollback()
+        self.assertEqual(User.query.count(), 0)
+        self.assertEqual(Translation.query.count(), 5)
+
+        u = User(username='susan', email='susan@example.com')
+        p = Post(body='hola', author=u, language='es')
+        db.session.add_all([u, p])
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u.id)
+        rv = client.post('/translate/batch', json={
+            'posts': [str(p.id)], 'dest_language': 'en'})
+        self.assertEqual(rv.get_json(), {'translations': {str(p.id): 'HOLA'}})
+        for body in ({'posts': ['abc']}, {'posts': [None]}, {'posts': 5},
+                     ['posts']):
+            rv = client.post('/translate/batch', json=body)
+            self.assertEqual(rv.status_code, 400)
+
+        self.app.config['MS_TRANSLATOR_URL'] = 'http://127.0.0.1:1'
+        with self.app.test_request_context():
+            self.assertEqual(translate('otro', 'es', 'en'),
+                             'Error: the translation service failed.')
+
+    def test_query_budget(self):
+        users = [User(username='user{}'.format(i),
+                      email='user{}@example.com'.format(i)) for i in range(10)]
+        db.session.add_all(users)
+        db.session.add_all([Post(body='post', author=u, language='en')
+                            for u in users])
+        db.session.commit()
+        for u in users[1:]:
+            users[0].follow(u)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(users[0].id)
+
+        # the authors of a page of posts are loaded in a single query; the
+        # identity map is cleared first, as the requests share the session
+        # of the test's app context
+        self.app.config['QUERY_BUDGET'] = 6
+        for url in ('/index', '/explore', '/user/user1'):
+            db.session.expunge_all()
+            self.assertEqual(client.get(url).status_code, 200)
+        self.app.config['QUERY_BUDGET'] = 1
+        db.session.expunge_all()
+        with self.assertRaises(AssertionError):
+            client.get('/explore')
+
+    def test_cursor_pagination(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        now = datetime.utcnow()
+        # pairs of posts with the same timestamp
+        posts = [Post(body='post {}'.format(i), author=u1,
+                      timestamp=now + timedelta(seconds=i // 2))
+                 for i in range(25)]
+        db.session.add_all([u1, u2] + posts)
+        db.session.commit()
+        expected = sorted(posts, key=lambda p: (p.timestamp, p.id),
+                          reverse=True)
+
+        pages = [paginate_posts(Post.query, 10)]
+        while pages[-1].next_cursor:
+            # a post added while paging does not shift the pages
+            db.session.add(Post(body='new', author=u2,
+                                timestamp=now + timedelta(days=1)))
+            db.session.commit()
+            pages.append(paginate_posts(Post.query.filter_by(user_id=u1.id),
+                                        10, after=pages[-1].next_cursor))
+        self.assertEqual([len(p.items) for p in pages], [10, 10, 5])
+        self.assertEqual(sum([p.items for p in pages], []), expected)
+        self.assertIsNone(pages[0].prev_cursor)
+        back = paginate_posts(Post.query.filter_by(user_id=u1.id), 10,
+                              before=pages[2].prev_cursor)
+        self.assertEqual(back.items, pages[1].items)
+        self.assertEqual(back.next_cursor, pages[1].next_cursor)
+        back = paginate_posts(Post.query.filter_by(user_id=u1.id), 10,
+                              before=back.prev_cursor)
+        self.assertEqual(back.items, pages[0].items)
+        self.assertIsNone(back.prev_cursor)
+
+        # search pages continue after the last hit
+        self.app.extensions['search_queue'].process()
+        seen = []
+        after = None
+        while True:
+            results, after = Post.search_after('post', 10, after)
+            seen += results.all()
+            if after is None:
+                break
+        self.assertEqual(sorted(p.id for p in seen),
+                         sorted(p.id for p in posts))
+
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        self.assertEqual(client.get('/explore?after=nonsense').status_code,
+                         400)
+        self.assertEqual(client.get('/user/john?after={}'.format(
+            pages[0].next_cursor)).status_code, 200)
+        self.assertEqual(client.get('/search?q=post&cursor={}'.format(
+            encode_cursor([after or [0, 0]]))).status_code, 200)
+        for stack in ([['x', 1]], [[0, 'x']], [[0, 1.5]], [[None, 1]],
+                      [[0, [1]]], [[True, 1]]):
+            self.assertEqual(client.get('/search?q=post&cursor={}'.format(
+                encode_cursor(stack))).status_code, 400)
+
+    def test_language(self):
+        u = User(username='john', email='john@example.com')
+        p1 = Post(body='This is a post written in plain English', author=u)
+        p2 = Post(body='Это сообщение написано по-русски', author=u)
+        p3 = Post(body='ok!', author=u)
+        p4 = Post(body='Already known', author=u, language='es')
+        db.session.add_all([u, p1, p2, p3, p4])
+        db.session.commit()
+        self.assertEqual([p.language for p in (p1, p2, p3, p4)],
+                         ['en', 'ru', '', 'es'])
+
+    def test_api(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u1.set_password('cat')
+        now = datetime.utcnow()
+        db.session.add_all([u1, u2] + [
+            Post(body='post {}'.format(i), author=u2,
+                 timestamp=now + timedelta(seconds=i)) for i in range(3)])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        client = self.app.test_client()
+
+        self.assertEqual(client.get('/api/timeline').status_code, 401)
+        rv = client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(
+                b'john:dog').decode()})
+        self.assertEqual(rv.status_code, 401)
+        rv = client.post('/api/tokens', headers={
+            'Authorization': 'Basic ' + base64.b64encode(
+                b'john:cat').decode()})
+        auth = {'Authorization': 'Bearer ' + rv.get_json()['token']}
+        self.assertEqual(User.verify_api_token(rv.get_json()['token']),
+                         u1.id)
+
+        rv = client.get('/api/timeline?per_page=2', headers=auth)
+        data = rv.get_json()
+        self.assertEqual([p['body'] for p in data['items']],
+                         ['post 2', 'post 1'])
+        self.assertEqual(data['items'][0]['author']['username'], 'susan')
+        rv = client.get(data['_links']['next'], headers=auth)
+        self.assertEqual([p['body'] for p in rv.get_json()['items']],
+                         ['post 0'])
+        self.assertIsNone(rv.get_json()['_links']['next'])
+
+        # an unchanged timeline is answered from the ETag lookups alone
+        rv = client.get('/api/timeline', headers=auth)
+        etag = rv.headers['ETag']
+        self.assertTrue(etag.startswith('W/'))
+        self.app.config['QUERY_BUDGET'] = 3
+        rv = client.get('/api/timeline',
+                        headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 304)
+        self.app.config['QUERY_BUDGET'] = 10
+
+        # new posts and renamed authors change it
+        db.session.add(Post(body='post 3', author=u2,
+                            timestamp=now + timedelta(seconds=3)))
+        db.session.commit()
+        rv = client.get('/api/timeline',
+                        headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        etag = rv.headers['ETag']
+        u2.username = 'sue'
+        db.session.commit()
+        rv = client.get('/api/timeline',
+                        headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(rv.status_code, 200)
+        self.assertEqual(rv.get_json()['items'][0]['author']['username'],
+                         'sue')
+
+        # and so does the language of a post, which is set after it is saved
+        post_table = Post.__table__
+        newest = Post.query.order_by(Post.timestamp.desc()).first().id
+        with db.engine.begin() as conn:
+            conn.execute(post_table.update().where(
+                post_table.c.id == newest).values(language=None))
+        urls = ('/api/timeline', '/api/users/{}/posts'.format(u2.id))
+        etags = {}
+        for url in urls:
+            rv = client.get(url, headers=auth)
+            self.assertIsNone(rv.get_json()['items'][0]['language'])
+            etags[url] = rv.headers['ETag']
+            rv = client.get(url, headers=dict(auth, **{
+                'If-None-Match': etags[url]}))
+            self.assertEqual(rv.status_code, 304)
+        with mock.patch('app.language.detect_language', return_value='en'):
+            self.app.extensions['language'].run([(newest, 'post 3')])
+        for url in urls:
+            rv = client.get(url, headers=dict(auth, **{
+                'If-None-Match': etags[url]}))
+            self.assertEqual(rv.status_code, 200)
+            self.assertEqual(rv.get_json()['items'][0]['language'], 'en')
+            etags[url] = rv.headers['ETag']
+
+        # as does deleting a post that is not the newest
+        db.session.delete(Post.query.filter_by(body='post 0').one())
+        db.session.commit()
+        for url in urls:
+            rv = client.get(url, headers=dict(auth, **{
+                'If-None-Match': etags[url]}))
+            self.assertEqual(rv.status_code, 200)
+            self.assertNotIn('post 0',
+                             [p['body'] for p in rv.get_json()['items']])
+
+        rv = client.get('/api/users/{}'.format(u2.id), headers=auth)
+        self.assertEqual(rv.get_json()['follower_count'], 1)
+        etag = rv.headers['ETag']
+        u2.about_me = 'hello'
+        db.session.commit()
+        rv = client.get('/api/users/{}'.format(u2.id),
+                        headers=dict(auth, **{'If-None-Match': etag}))
+        self.assertEqual(rv.get_json()['about_me'], 'hello')
+        rv = client.get('/api/users/{}/followers'.format(u2.id),
+                        headers=auth)
+        self.assertEqual([u['username'] for u in rv.get_json()['items']],
+                         ['john'])
+        rv = client.get('/api/users/{}/posts?per_page=1'.format(u2.id),
+                        headers=auth)
+        self.assertEqual([p['body'] for p in rv.get_json()['items']],
+                         ['post 3'])
+        rv = client.get('/api/users/999', headers=auth)
+        self.assertEqual(rv.status_code, 404)
+        self.assertEqual(rv.get_json()['error'], 'Not Found')
+        self.assertEqual(client.get('/api/timeline?after=x',
+                                    headers=auth).status_code, 400)
+
+    def test_stream(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3, Post(body='old', author=u2)])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+        rv = client.get('/index')
+        cursor = rv.get_data(as_text=True).split('data-cursor="')[1].split(
+            '"')[0]
+
+        self.app.config['STREAM_HEARTBEAT'] = 0.01
+        rv = client.get('/stream')
+        self.assertEqual(rv.mimetype, 'text/event-stream')
+        events = iter(rv.response)
+        self.assertTrue(next(events).startswith(b'retry: '))
+        self.assertEqual(next(events), b': keepalive\n\n')
+        db.session.add(Post(body='not followed', author=u3))
+        db.session.commit()
+        post = Post(body='new post', author=u2)
+        db.session.add(post)
+        db.session.commit()
+        self.assertEqual(next(events), 'event: post\ndata: {}\n\n'.format(
+            json.dumps({'id': post.id})).encode())
+        self.assertEqual(next(events), b': keepalive\n\n')
+        rv.close()
+        self.assertEqual(self.app.events.subscribers, {})
+
+        # the index page fetches only the posts newer than it has
+        data = client.get('/index/new?before=' + cursor).get_json()
+        self.assertIn('new post', data['html'])
+        self.assertNotIn('old', data['html'])
+        self.assertFalse(data['more'])
+        data = client.get('/index/new?before=' + data['cursor']).get_json()
+        self.assertEqual(data['html'], '')
+
+    def test_fragment_cache(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add_all([u1, u2] + [Post(body='post {}'.format(i),
+                                            author=u2) for i in range(3)])
+        db.session.commit()
+        u1.follow(u2)
+        db.session.commit()
+        fragments = self.app.extensions['fragments']
+        client = self.app.test_client()
+        with client.session_transaction() as session:
+            session['_user_id'] = str(u1.id)
+
+        client.get('/index')
+        self.assertEqual((fragments.hits, fragments.misses), (0, 3))
+        page = client.get('/index').get_data(as_text=True)
+        self.assertEqual((fragments.hits, fragments.misses), (3, 3))
+        self.assertIn('susan', page)
+        client.get('/index', headers={'Accept-Language': 'ru'})
+        self.assertEqual(fragments.misses, 6)
+
+        # a renamed author gets new fragments
+        u2.username = 'sue'
+        db.session.commit()
+        page = client.get('/index').get_data(as_text=True)
+        self.assertEqual(fragments.misses, 9)
+        self.assertIn('/user/sue', page)
+        self.assertNotIn('susan', page)
+
+        # the least recently used fragments go when the cache is full
+        limit = self.app.config['FRAGMENT_CACHE_BYTES'] = fragments.size // 2
+        u2.about_me = 'hi'
+        db.session.commit()
+        client.get('/index')
+        self.assertLessEqual(fragments.size, limit)
+        hits = fragments.hits
+        client.get('/index')
+        self.assertEqual(fragments.hits, hits + 3)
+
+    def test_bench_seed(self):
+        with db.engine.begin() as conn:
+            follows = seed(conn, 50, 300, follows=5, batch_size=64)
+        self.assertEqual(User.query.count(), 50)
+        self.assertEqual(Post.query.count(), 300)
+        self.assertEqual(db.session.query(followers).count(), follows)
+        self.assertEqual(db.session.query(
+            db.func.sum(User.followers_count)).scalar(), follows)
+        # the most popular accounts are followed the most
+        counts = [u.followers_count for u in User.query.order_by(User.id)]
+        self.assertGreater(sum(counts[:5]), sum(counts[-25:]))
+        u = User.query.get(7)
+        self.assertEqual(u.timeline_posts().count(),
+                         u.followed_posts().count())
+
+
+class MailCase(unittest.TestCase):
+    def setUp(self):
+        self.server = socketserver.ThreadingTCPServer(('127.0.0.1', 0),
+                                                      StubSMTP)
+        self.server.daemon_threads = True
+        self.server.connections = 0
+        self.server.messages = []
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        port = self.server.server_address[1]
+
+        class MailConfig(TestConfig):
+            MAIL_SERVER = '127.0.0.1'
+            MAIL_PORT = port
+            MAIL_USE_TLS = False
+            MAIL_USERNAME = None
+            MAIL_PASSWORD = None
+            MAIL_SUPPRESS_SEND = False
+
+        self.app = create_app(MailConfig)
+        self.app_context = self.app.app_context()
+        self.app_context.push()
+
+    def tearDown(self):
+        self.app_context.pop()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_dispatcher(self):
+        for i in range(10):
+            self.assertTrue(send_email('message {}'.format(i),
+                                       'admin@example.com',
+                                       ['user@example.com'], 'text', 'html'))
+        dispatcher = self.app.extensions['mail_dispatcher']
+        dispatcher.shutdown()
+        self.assertEqual(len(self.server.messages), 10)
+        metrics = dispatcher.metrics()
+        self.assertEqual((metrics['sent'], metrics['failed']), (10, 0))
+        # the connections are reused, one per worker at most
+        self.assertLessEqual(self.server.connections, 2)
+        self.assertEqual(metrics['connections'], self.server.connections)
+
+    def test_bad_message(self):
+        self.app.config['MAIL_WORKERS'] = 1
+        dispatcher = MailDispatcher(self.app)
+        # flask-mail refuses headers with newlines with BadHeaderError, which
+        # is not an SMTP error; the worker logs it and carries on
+        with self.assertLogs(self.app.logger, logging.ERROR):
+            send_email('bad\nsubject', 'admin@example.com',
+                       ['user@example.com'], 'text', 'html')
+            send_email('good', 'admin@example.com', ['user@example.com'],
+                       'text', 'html')
+            dispatcher.queue.join()
+        self.assertEqual(len(self.server.messages), 1)
+        self.assertEqual((dispatcher.metrics()['sent'],
+                          dispatcher.metrics()['failed']), (1, 1))
+
+        # a worker that has exited is replaced on the next submit
+        dispatcher.queue.put(STOP)
+        dispatcher.threads[0].join()
+        send_email('again', 'admin@example.com', ['user@example.com'],
+                   'text', 'html')
+        dispatcher.shutdown()
+        self.assertEqual(len(self.server.messages), 2)
+
+    def test_backpressure(self):
+        self.app.config.update(MAIL_WORKERS=0, MAIL_QUEUE_SIZE=2,
+                               MAIL_QUEUE_TIMEOUT=0)
+        dispatcher = MailDispatcher(self.app)
+        results = [send_email('message', 'admin@example.com',
+                              ['user@example.com'], 'text', 'html')
+                   for i in range(3)]
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(dispatcher.metrics()['queued'], 2)
+        self.assertEqual(dispatcher.metrics()['rejected'], 1)
+
+    def test_error_digest(self):
+        handler = DigestSMTPHandler(
+            mailhost=self.server.server_address, fromaddr='app@example.com',
+            toaddrs=['admin@example.com'], subject='Failure', interval=60)
+        logger = logging.getLogger('test_error_digest')
+        logger.propagate = False
+        logger.addHandler(handler)
+        self.addCleanup(logger.removeHandler, handler)
+        logger.error('first')
+        self.assertEqual(len(self.server.messages), 1)
+
+        # within the interval errors are collected and counted
+        for i in range(3):
+            logger.error('again')
+        logger.error('different')
+        self.assertEqual(len(self.server.messages), 1)
+        handler.close()
+        self.assertEqual(len(self.server.messages), 2)
+        digest = self.server.messages[1].decode()
+        self.assertIn('Subject: Failure (4 errors)', digest)
+        self.assertIn('[3 times] again', digest)
+        self.assertIn('different', digest)
+
+    def test_json_logs(self):
+        record = logging.LogRecord('app', logging.INFO, 'app/x.py', 7,
+                                   'hello %s', ('world',), None)
+        data = json.loads(JSONFormatter().format(record))
+        self.assertEqual((data['level'], data['message'], data['line']),
+                         ('INFO', 'hello world', 7))
+
+        # through the queue the exception still reaches the formatter
+        self.app.config.update(MAIL_SERVER=None, LOG_JSON=True,
+                               LOG_TO_STDOUT=True)
+        stream = io.StringIO()
+        self.addCleanup(self.app.logger.setLevel, self.app.logger.level)
+        with mock.patch('sys.stderr', stream), \
+                mock.patch('app.logs.atexit.register'):
+            listener = setup_logging(self.app)
+        handler = self.app.logger.handlers[-1]
+        self.addCleanup(self.app.logger.removeHandler, handler)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            self.app.logger.exception('failed for %s', 'susan')
+        listener.stop()
+        data = json.loads(stream.getvalue().splitlines()[-1])
+        self.assertEqual(data['message'], 'failed for susan')
+        self.assertIn('ZeroDivisionError', data['exception'])
+
+
+class StartupCase(unittest.TestCase):
+    def test_heavy_clients_are_lazy(self):
+        code = ('import sys\n'
+                'from app import create_app\n'
+                'create_app()\n'
+                'print(sorted(m for m in ("elasticsearch", "requests", '
+                '"langdetect") if m in sys.modules))\n')
+        result = subprocess.run(
+            [sys.executable, '-c', code], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            env=dict(os.environ, LOG_TO_STDOUT='1',
+                     ELASTICSEARCH_URL='http://localhost:9200'))
+        self.assertEqual(result.stdout.strip(), '[]', result.stderr)
+
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)